@@ -0,0 +1,39 @@
+"""
+Benchmark of the per-request cost of dmutils.logging's request access logging when DM_LOG_LEVEL=WARNING, comparing
+skipping the log context when the record would be discarded against always building it.
+
+    python benchmarks/after_request_logging.py
+"""
+import timeit
+from unittest import mock
+
+from flask import Flask
+
+from dmutils import logging as dm_logging
+
+
+def _requests_per_second(app, number):
+    client = app.test_client()
+    return number / timeit.timeit(lambda: client.get("/some/path?with=a&query=string"), number=number)
+
+
+def main(number=5000):
+    app = Flask(__name__)
+    app.config["DM_LOG_LEVEL"] = "WARNING"
+    dm_logging.init_app(app)
+
+    @app.route("/some/path")
+    def view():
+        return "ok"
+
+    with mock.patch.object(app.logger, "isEnabledFor", return_value=True):
+        before = _requests_per_second(app, number)
+    after = _requests_per_second(app, number)
+
+    print(f"always building context:  {before:10.0f} requests/s")
+    print(f"skipping when disabled:   {after:10.0f} requests/s")
+    print(f"speedup:                  {after / before:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Benchmark of the per-call overhead of logged_duration_for_external_request wrapping a no-op call without a
+description, comparing the caller's name being found through inspect.stack() (as it used to be) against the current
+implementation.
+
+    python benchmarks/external_request_timing.py
+"""
+import inspect
+import timeit
+
+from dmutils.timing import logged_duration_for_external_request
+
+
+def _inspect_stack_wrapped_call():
+    with logged_duration_for_external_request("Mailchimp", inspect.stack()[1].function):
+        pass
+
+
+def _wrapped_call():
+    with logged_duration_for_external_request("Mailchimp"):
+        pass
+
+
+def _microseconds_per_call(func, number):
+    return timeit.timeit(func, number=number) * 1e6 / number
+
+
+def main(number=5000):
+    before = _microseconds_per_call(_inspect_stack_wrapped_call, number)
+    after = _microseconds_per_call(_wrapped_call, number)
+
+    print(f"inspect.stack():           {before:10.2f} us/call")
+    print(f"current:                   {after:10.2f} us/call")
+    print(f"speedup:                   {before / after:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Benchmark of trace & span id generation, comparing the original SystemRandom().randrange based generation (a
+getrandom syscall for every id) against RandomIdGenerator's buffered os.urandom approach.
+
+    python benchmarks/id_generation.py
+"""
+from random import SystemRandom
+import timeit
+
+from dmutils.request_id import RandomIdGenerator
+
+
+_system_random = SystemRandom()
+_random_id_generator = RandomIdGenerator()
+
+
+def _system_random_ids():
+    _system_random_hex_id(128)
+    _system_random_hex_id(64)
+
+
+def _system_random_hex_id(bitlen):
+    return hex(_system_random.randrange(1 << bitlen))[2:].rjust(bitlen // 4, "0")
+
+
+def _random_id_generator_ids():
+    _random_id_generator.get_hex_id(128)
+    _random_id_generator.get_hex_id(64)
+
+
+def _microseconds_per_call(func, number):
+    return timeit.timeit(func, number=number) * 1e6 / number
+
+
+def main(number=200000):
+    before = _microseconds_per_call(_system_random_ids, number)
+    after = _microseconds_per_call(_random_id_generator_ids, number)
+
+    print(f"SystemRandom.randrange:    {before:10.3f} us/(trace id + span id)")
+    print(f"RandomIdGenerator:         {after:10.3f} us/(trace id + span id)")
+    print(f"speedup:                   {before / after:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Micro-benchmark of JSONFormatter throughput for a typical request log record, comparing the compiled message template
+fast path against the general-purpose str.format fallback.
+
+    python benchmarks/json_formatter.py
+"""
+import logging
+import timeit
+from unittest import mock
+
+from dmutils.logging import JSONFormatter, get_json_log_format
+
+
+def _make_record():
+    record = logging.LogRecord(
+        "flask.app", logging.INFO, __file__, 1, "{method} {url} {status} {missing_key}", (), None,
+    )
+    record.__dict__.update({
+        "method": "GET",
+        "url": "https://www.digitalmarketplace.service.gov.uk/g-cloud/search?q=email",
+        "status": 200,
+        "endpoint": "main.search_services",
+        "duration_real": 0.1234,
+        "duration_process": 0.0456,
+        "process_": 1234,
+        "thread_": "140230934234",
+        "app_name": "buyer-frontend",
+        "trace_id": "3c1f0d6e2c9a4b6f8a1b2c3d4e5f6a7b",
+        "span_id": "8a1b2c3d4e5f6a7b",
+        "parent_span_id": None,
+        "is_sampled": "0",
+        "debug_flag": "0",
+    })
+    return record
+
+
+def _records_per_second(formatter, number):
+    # each format call is given a fresh record as formatting mutates the record
+    records = [_make_record() for _ in range(number)]
+    records_iter = iter(records)
+    duration = timeit.timeit(lambda: formatter.format(next(records_iter)), number=number)
+    return number / duration
+
+
+def main(number=20000):
+    # silence the "missing keys" warnings the formatter emits
+    logging.getLogger("dmutils").setLevel(logging.CRITICAL)
+    formatter = JSONFormatter(get_json_log_format())
+
+    with mock.patch("dmutils.logging._compile_message_template", return_value=None):
+        before = _records_per_second(formatter, number)
+    after = _records_per_second(formatter, number)
+
+    print(f"str.format fallback:       {before:10.0f} records/s")
+    print(f"compiled template:         {after:10.0f} records/s")
+    print(f"speedup:                   {after / before:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
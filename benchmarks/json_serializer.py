@@ -0,0 +1,57 @@
+"""
+Benchmark of JSONFormatter serialization of a typical after_request record, comparing python-json-logger's default
+stdlib json serializer against fast_json_dumps (using whichever C-accelerated backend is installed).
+
+    python benchmarks/json_serializer.py
+"""
+import logging
+import timeit
+
+from dmutils.logging import FAST_JSON_BACKEND, JSONFormatter, fast_json_dumps, get_json_log_format
+
+
+def _make_log_record(formatter):
+    record = logging.LogRecord("flask.app", logging.INFO, __file__, 1, "{method} {url} {status}", (), None)
+    record.__dict__.update({
+        "method": "GET",
+        "url": "https://www.digitalmarketplace.service.gov.uk/g-cloud/search?q=email",
+        "status": 200,
+        "endpoint": "main.search_services",
+        "duration_real": 0.1234,
+        "duration_process": 0.0456,
+        "process_": 1234,
+        "thread_": "140230934234",
+        "app_name": "buyer-frontend",
+        "trace_id": "3c1f0d6e2c9a4b6f8a1b2c3d4e5f6a7b",
+        "span_id": "8a1b2c3d4e5f6a7b",
+        "parent_span_id": None,
+        "is_sampled": "0",
+        "debug_flag": "0",
+    })
+    record.message = record.getMessage()
+    record.asctime = formatter.formatTime(record)
+    # the dict as it would be passed to the serializer
+    log_record = {}
+    formatter.add_fields(log_record, record, {})
+    return formatter.process_log_record(log_record)
+
+
+def _records_per_second(formatter, log_record, number):
+    return number / timeit.timeit(lambda: formatter.jsonify_log_record(log_record), number=number)
+
+
+def main(number=100000):
+    standard = JSONFormatter(get_json_log_format())
+    fast = JSONFormatter(get_json_log_format(), json_serializer=fast_json_dumps)
+    log_record = _make_log_record(standard)
+
+    before = _records_per_second(standard, log_record, number)
+    after = _records_per_second(fast, log_record, number)
+
+    print(f"stdlib json:               {before:10.0f} records/s")
+    print(f"{FAST_JSON_BACKEND + ':':<27}{after:10.0f} records/s")
+    print(f"speedup:                   {after / before:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Benchmark of the per-record cost of attaching request trace context to log records in a log-heavy request, comparing
+the per-request snapshot against rebuilding the context for every record.
+
+    python benchmarks/request_log_context.py
+"""
+import logging
+import timeit
+
+from flask import Flask, request
+
+from dmutils import request_id
+from dmutils.logging import RequestExtraContextFilter
+
+
+def _records_per_second(app, rebuild_every_record, records_per_request=20, number=2000):
+    filter_ = RequestExtraContextFilter()
+    record = logging.LogRecord("flask.app", logging.INFO, __file__, 1, "hello", (), None)
+    headers = (("X-B3-TraceId", "3c1f0d6e2c9a4b6f8a1b2c3d4e5f6a7b"), ("X-B3-SpanId", "8a1b2c3d4e5f6a7b"),)
+
+    def _log_heavy_request():
+        with app.test_request_context(headers=headers):
+            for _ in range(records_per_request):
+                if rebuild_every_record:
+                    request.__dict__.pop("_extra_log_context", None)
+                filter_.filter(record)
+
+    duration = timeit.timeit(_log_heavy_request, number=number)
+    return (number * records_per_request) / duration
+
+
+def main():
+    app = Flask(__name__)
+    request_id.init_app(app)
+
+    before = _records_per_second(app, rebuild_every_record=True)
+    after = _records_per_second(app, rebuild_every_record=False)
+
+    print(f"rebuilt per record:        {before:10.0f} records/s")
+    print(f"snapshot per request:      {after:10.0f} records/s")
+    print(f"speedup:                   {after / before:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+from collections import deque
+import logging
+from threading import Lock
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised in place of making a call to an external service while the service's circuit breaker is open"""
+    def __init__(self, service, retry_after):
+        super().__init__(f"Circuit breaker for {service} is open, not retrying for {retry_after:.1f}s")
+        self.service = service
+        self.retry_after = retry_after
+
+
+def _get_status_code(exception):
+    # notifications_python_client's errors
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None:
+        response = getattr(exception, "response", None)
+        if isinstance(response, dict):
+            # botocore's ClientError
+            status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        else:
+            # requests' HTTPError
+            status_code = getattr(response, "status_code", None)
+    if status_code is None and exception.args and isinstance(exception.args[0], dict):
+        # mailchimp3's MailChimpError
+        status_code = exception.args[0].get("status")
+    return status_code
+
+
+def is_not_client_error(exception):
+    """
+    The default ``is_failure`` of a CircuitBreaker: any exception counts as a failure apart from those representing 4xx
+    responses (other than 408 Request Timeout and 429 Too Many Requests), which say something about the request that
+    was made (e.g. Mailchimp's "Member Exists") rather than about the health of the service
+    """
+    status_code = _get_status_code(exception)
+    return not (isinstance(status_code, int) and 400 <= status_code < 500 and status_code not in (408, 429))
+
+
+class CircuitBreaker:
+    """
+        Tracks the outcomes of the most recent calls to an external service, "opening" (i.e. failing calls fast with a
+        CircuitOpenError rather than making them) once the proportion of them which either failed or were slow crosses a
+        threshold. After ``open_duration`` seconds the breaker becomes "half-open", letting through up to
+        ``half_open_max_calls`` probe calls - if all of these succeed (without being slow) the breaker closes again,
+        otherwise it re-opens. Whether an exception raised by a call counts as a failure is decided by ``is_failure``,
+        and a call counts as slow if it took at least ``slow_call_duration`` seconds - this should be set to comfortably
+        above how long calls to the service take when it's healthy.
+    """
+    STATE_CLOSED = "closed"
+    STATE_OPEN = "open"
+    STATE_HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        service,
+        window_size=20,
+        minimum_calls=10,
+        failure_rate_threshold=0.5,
+        slow_call_rate_threshold=0.8,
+        slow_call_duration=10,
+        open_duration=30,
+        half_open_max_calls=1,
+        is_failure=is_not_client_error,
+    ):
+        self.service = service
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+        self.is_failure = is_failure
+
+        self._lock = Lock()
+        self._state = self.STATE_CLOSED
+        # (failed, slow) for each of the most recent calls made while closed
+        self._outcomes = deque(maxlen=window_size)
+        self._failure_count = 0
+        self._slow_count = 0
+        self._opened_at = None
+        self._half_open_calls = 0
+        self._half_open_successes = 0
+
+    def _set_state(self, state, now):
+        if state == self._state:
+            return
+        logger.warning(
+            "Circuit breaker for {service} changed state from {previous_state} to {state}",
+            extra={"service": self.service, "previous_state": self._state, "state": state},
+        )
+        self._state = state
+        self._opened_at = now if state == self.STATE_OPEN else None
+        self._half_open_calls = self._half_open_successes = 0
+        if state == self.STATE_CLOSED:
+            self._outcomes.clear()
+            self._failure_count = self._slow_count = 0
+
+    def before_call(self):
+        """Raises a CircuitOpenError if a call shouldn't be made right now"""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.STATE_OPEN:
+                retry_after = self._opened_at + self.open_duration - now
+                if retry_after > 0:
+                    raise CircuitOpenError(self.service, retry_after)
+                self._set_state(self.STATE_HALF_OPEN, now)
+
+            if self._state == self.STATE_HALF_OPEN:
+                if self._half_open_calls >= self.half_open_max_calls:
+                    # probe(s) still in flight
+                    raise CircuitOpenError(self.service, 0)
+                self._half_open_calls += 1
+
+    def is_slow(self, duration):
+        return duration >= self.slow_call_duration
+
+    def record_call(self, failed, slow):
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.STATE_HALF_OPEN:
+                if failed or slow:
+                    self._set_state(self.STATE_OPEN, now)
+                else:
+                    self._half_open_successes += 1
+                    if self._half_open_successes >= self.half_open_max_calls:
+                        self._set_state(self.STATE_CLOSED, now)
+                return
+
+            if self._state == self.STATE_OPEN:
+                # a call which was already in flight when we opened
+                return
+
+            if len(self._outcomes) == self._outcomes.maxlen:
+                oldest_failed, oldest_slow = self._outcomes[0]
+                self._failure_count -= oldest_failed
+                self._slow_count -= oldest_slow
+            self._outcomes.append((failed, slow))
+            self._failure_count += failed
+            self._slow_count += slow
+
+            if len(self._outcomes) >= self.minimum_calls and (
+                self._failure_count / len(self._outcomes) >= self.failure_rate_threshold
+                or self._slow_count / len(self._outcomes) >= self.slow_call_rate_threshold
+            ):
+                self._set_state(self.STATE_OPEN, now)
+
+    def get_status(self):
+        with self._lock:
+            call_count = len(self._outcomes)
+            return {
+                "state": self._state,
+                "calls": call_count,
+                "failure_rate": self._failure_count / call_count if call_count else 0.,
+                "slow_call_rate": self._slow_count / call_count if call_count else 0.,
+            }
+
+
+_circuit_breakers = {}
+
+
+def configure_circuit_breaker(service, **kwargs):
+    """
+    Enables a circuit breaker for calls to ``service`` made through ``logged_duration_for_external_request`` (or its
+    async equivalent), replacing any existing one. ``kwargs`` are passed on to CircuitBreaker.
+    """
+    _circuit_breakers[service] = CircuitBreaker(service, **kwargs)
+    return _circuit_breakers[service]
+
+
+def get_circuit_breaker(service):
+    """Returns the CircuitBreaker for ``service``, or None if one hasn't been configured"""
+    return _circuit_breakers.get(service)
+
+
+def get_circuit_breaker_statuses():
+    return {service: circuit_breaker.get_status() for service, circuit_breaker in _circuit_breakers.items()}
+
+
+def init_app(app):
+    """
+    Configures a circuit breaker for each service named in DM_CIRCUIT_BREAKERS, a mapping of service names (as passed to
+    ``logged_duration_for_external_request``) to dicts of CircuitBreaker arguments, e.g.::
+
+        DM_CIRCUIT_BREAKERS = {"Mailchimp": {"failure_rate_threshold": 0.3, "slow_call_duration": 15}}
+
+    The clients in ``dmutils.email`` handle a CircuitOpenError as they would the service failing a call, but callers of
+    other services will have to be ready for one to be raised.
+    """
+    for service, kwargs in (app.config.get("DM_CIRCUIT_BREAKERS") or {}).items():
+        configure_circuit_breaker(service, **kwargs)
@@ -11,6 +11,7 @@ from requests.exceptions import RequestException, HTTPError
 from mailchimp3 import MailChimp
 from mailchimp3.mailchimpclient import MailChimpError
 
+from dmutils.circuit_breaker import CircuitOpenError
 from dmutils.timing import logged_duration_for_external_request as log_external_request
 
 PAGINATION_SIZE = 1000
@@ -66,7 +67,7 @@ class DMMailChimpClient(object):
             with log_external_request(service='Mailchimp'):
                 campaign = self._client.campaigns.create(campaign_data)
             return campaign['id']
-        except (RequestException, MailChimpError) as e:
+        except (RequestException, MailChimpError, CircuitOpenError) as e:
             self.logger.error(
                 "Mailchimp failed to create campaign for '{campaign_title}'".format(
                     campaign_title=campaign_data.get("settings", {}).get("title")
@@ -82,7 +83,7 @@ class DMMailChimpClient(object):
         try:
             with log_external_request(service='Mailchimp'):
                 return self._client.campaigns.content.update(campaign_id, content_data)
-        except (RequestException, MailChimpError) as e:
+        except (RequestException, MailChimpError, CircuitOpenError) as e:
             self.logger.error(
                 "Mailchimp failed to set content for campaign id '{0}'".format(campaign_id),
                 extra={
@@ -97,7 +98,7 @@ class DMMailChimpClient(object):
             with log_external_request(service='Mailchimp'):
                 self._client.campaigns.actions.send(campaign_id)
             return True
-        except (RequestException, MailChimpError) as e:
+        except (RequestException, MailChimpError, CircuitOpenError) as e:
             self.logger.error(
                 "Mailchimp failed to send campaign id '{0}'".format(campaign_id),
                 extra={
@@ -129,7 +130,7 @@ class DMMailChimpClient(object):
                 )
                 resp.update({"status": "success", "error_type": None, "status_code": 200})
                 return resp
-        except (RequestException, MailChimpError) as e:
+        except (RequestException, MailChimpError, CircuitOpenError) as e:
             # Some errors we don't care about but do want to log. Find and log them here.
             response = get_response_from_exception(e)
             if "looks fake or invalid, please enter a real email address." in response.get("detail", ""):
@@ -178,7 +179,8 @@ class DMMailChimpClient(object):
     def subscribe_new_emails_to_list(self, list_id: str, email_addresses: str) -> bool:
         success = True
         for email_address in email_addresses:
-            with log_external_request(service='Mailchimp'):
+            # subscribe_new_email_to_list makes (and circuit breaks) the actual call
+            with log_external_request(service='Mailchimp', use_circuit_breaker=False):
                 if not self.subscribe_new_email_to_list(list_id, email_address):
                     success = False
         return success
@@ -220,7 +222,7 @@ class DMMailChimpClient(object):
                     subscriber_hash=hashed_email,
                 )
             return True
-        except (RequestException, MailChimpError) as e:
+        except (RequestException, MailChimpError, CircuitOpenError) as e:
             self.logger.error(
                 f"Mailchimp failed to permanently remove user ({hashed_email}) from list ({list_id})",
                 extra={"error": str(e), "mailchimp_response": get_response_from_exception(e)},
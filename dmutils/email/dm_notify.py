@@ -4,6 +4,7 @@ from flask import current_app
 from notifications_python_client import NotificationsAPIClient
 from notifications_python_client.errors import HTTPError
 
+from dmutils.circuit_breaker import CircuitOpenError
 from dmutils.email.exceptions import EmailError
 from dmutils.email.helpers import hash_string
 from dmutils.timing import logged_duration_for_external_request as log_external_request
@@ -178,6 +179,19 @@ class DMNotifyClient:
         except HTTPError as e:
             self._log_email_error_message(to_email_address, template_name_or_id, reference, e)
             raise EmailError(str(e))
+        except CircuitOpenError as e:
+            # Notify has been failing recently, so we didn't try it
+            self.logger.error(
+                "Error sending email: {error}",
+                extra={
+                    "client": self.__class__,
+                    "reference": reference,
+                    "template_name_or_id": template_name_or_id,
+                    "to_email_address": hash_string(to_email_address),
+                    "error": str(e),
+                },
+            )
+            raise EmailError(str(e))
 
         self._update_cache(reference)
 
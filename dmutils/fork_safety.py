@@ -0,0 +1,68 @@
+"""
+Helpers for objects holding per-process state (locks, buffers, background threads, connections...) which a forked
+child process mustn't share with, or inherit half-finished from, its parent.
+"""
+import os
+from threading import Thread
+import weakref
+
+
+# without register_at_fork (python < 3.7) we have to check for having been forked ourselves
+_check_pid_for_fork = not hasattr(os, "register_at_fork")
+
+
+_pid = os.getpid()
+
+
+def _refresh_pid():
+    global _pid
+    _pid = os.getpid()
+
+
+if not _check_pid_for_fork:
+    os.register_at_fork(after_in_child=_refresh_pid)
+
+    def get_pid():
+        """Returns the current process's pid, cached so as not to need a syscall every time"""
+        return _pid
+else:
+    # we have no way of knowing when we need to refresh a cached pid
+    get_pid = os.getpid
+
+
+class ResetOnFork(object):
+    """
+        Calls `reset` (a bound method) in forked child processes, so its object can replace any state the child
+        shouldn't share with its parent - including locks, which the parent may have been holding when it forked. On
+        python 3.7+ this happens immediately after the fork, so `reset` shouldn't do anything but replace state (e.g.
+        starting threads or logging from it isn't safe). Before python 3.7 it happens the next time `check` is called,
+        which should be done before each use of the state. Only a weak reference to `reset`'s object is held.
+    """
+    def __init__(self, reset):
+        self._reset = weakref.WeakMethod(reset)
+        self._pid = os.getpid()
+        if not _check_pid_for_fork:
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._pid = os.getpid()
+        reset = self._reset()
+        if reset is not None:
+            reset()
+
+    def check(self):
+        if _check_pid_for_fork and self._pid != os.getpid():
+            self._after_fork()
+
+
+def ensure_thread(thread, target, name):
+    """
+    Returns `thread` if it is alive, otherwise starts and returns a new daemon thread running `target`. A forked child
+    inherits its parent's Thread objects but not the threads themselves, so checking is_alive() rather than simply for
+    a thread's existence means a new one will be started in the child.
+    """
+    if thread is not None and thread.is_alive():
+        return thread
+    thread = Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
@@ -1,17 +1,45 @@
 from __future__ import absolute_import
+import atexit
+from collections import Counter
+from datetime import date, datetime, time as datetime_time
+from functools import lru_cache
+import json
 import logging
+import logging.handlers
+import queue
+import random
 import sys
 import re
-from os import getpid
 import os.path
-from threading import get_ident as get_thread_ident
+import string
+from threading import get_ident as get_thread_ident, Event, Lock
 import time
+import traceback
+from types import TracebackType
 
 from flask import request, current_app
 from flask.ctx import has_request_context
 
 from pythonjsonlogger.jsonlogger import JsonFormatter as BaseJSONFormatter
 
+from dmutils.fork_safety import ResetOnFork, ensure_thread, get_pid
+from dmutils.timing import (
+    capture_request_context,
+    clear_captured_request_context,
+    pop_span_tree,
+    start_span_tree,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 LOG_FORMAT = '%(asctime)s %(app_name)s %(name)s %(levelname)s ' \
              '%(trace_id)s "%(message)s" [in %(pathname)s:%(lineno)d]'
 
@@ -26,6 +54,11 @@ LOG_FORMAT_EXTRA_JSON_KEYS = (
 )
 
 
+# the default for DM_LOG_SPAN_TREE_MAX_SPANS, the most spans a request's span tree record will include - any further
+# spans are only counted, as "spans_dropped"
+DEFAULT_SPAN_TREE_MAX_SPANS = 100
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -39,24 +72,84 @@ def _common_request_extra_log_context():
         # log messages - they are designed to be included when the formatter is being configured. This is why
         # I'm manually grabbing them and putting them in as `extra` here, avoiding the existing parameter names
         # to prevent LogRecord from complaining
-        "process_": getpid(),
+        "process_": get_pid(),
         # stringifying this as it could potentially be a long that json is unable to represent accurately
         "thread_": str(get_thread_ident()),
     }
 
 
+def _create_access_log_aggregator(app):
+    access_log_aggregator = AccessLogAggregator(
+        app.logger,
+        endpoints=app.config.get('DM_LOG_AGGREGATE_ENDPOINTS') or (),
+        url_prefixes=app.config.get('DM_LOG_AGGREGATE_URL_PREFIXES') or (),
+        interval=app.config.get('DM_LOG_AGGREGATE_INTERVAL', AccessLogAggregator.DEFAULT_INTERVAL),
+    )
+    if app.config.get('DM_LOG_AGGREGATE_ENDPOINTS') or app.config.get('DM_LOG_AGGREGATE_URL_PREFIXES'):
+        # so the final interval's summary isn't lost. registered after logging's own atexit handler, so will be run
+        # before it
+        atexit.register(access_log_aggregator.close)
+    return access_log_aggregator
+
+
+def _reset_span_tree(max_spans):
+    # a fresh (or no) span tree for every request so nothing leaks between requests served by the same thread
+    if getattr(request, "is_sampled", False) or getattr(request, "tail_sampling_enabled", False):
+        start_span_tree(max_spans)
+    else:
+        pop_span_tree()
+
+
+def _get_request_duration_real_and_apply_tail_sampling():
+    if not hasattr(request, "before_request_real_time"):
+        return None
+
+    duration_real = time.perf_counter() - request.before_request_real_time
+    if hasattr(request, "apply_tail_sampling"):
+        # slow requests may become sampled now, which everything following should take into account
+        request.apply_tail_sampling(duration_real)
+    return duration_real
+
+
+def _teardown_request(exception):
+    clear_captured_request_context()
+
+
+def _log_span_tree():
+    spans, spans_dropped = pop_span_tree(with_dropped_count=True)
+    # a tree may have been collected for a request which didn't end up being sampled
+    if spans and getattr(request, "is_sampled", False) and current_app.logger.isEnabledFor(logging.INFO):
+        current_app.logger.info(
+            "Span tree for {method} {url}: {span_count} spans",
+            extra={
+                "span_count": len(spans),
+                "spans": spans,
+                "spans_dropped": spans_dropped,
+                **_common_request_extra_log_context(),
+            },
+        )
+
+
 def init_app(app):
     app.config.setdefault('DM_LOG_LEVEL', 'INFO')
     app.config.setdefault('DM_APP_NAME', 'none')
 
+    collect_span_trees = app.config.get('DM_LOG_SPAN_TREES', False)
+    span_tree_max_spans = app.config.get('DM_LOG_SPAN_TREE_MAX_SPANS', DEFAULT_SPAN_TREE_MAX_SPANS)
+
     @app.before_request
     def before_request():
         # annotating these onto request instead of flask.g as they probably shouldn't be inheritable from a request-less
         # application context
         request.before_request_real_time = time.perf_counter()
         request.before_request_process_time = time.process_time()
+        # making the request's sampling state available to logged_duration conditions evaluated in asyncio tasks
+        capture_request_context()
+
+        if collect_span_trees:
+            _reset_span_tree(span_tree_max_spans)
 
-        if getattr(request, "is_sampled", False):
+        if getattr(request, "is_sampled", False) and current_app.logger.isEnabledFor(logging.DEBUG):
             # emit an early log message to record that the request was received by the app
             current_app.logger.log(
                 logging.DEBUG,
@@ -64,17 +157,35 @@ def init_app(app):
                 extra=_common_request_extra_log_context(),
             )
 
+    access_log_aggregator = _create_access_log_aggregator(app)
+
     @app.after_request
     def after_request(response):
+        duration_real = _get_request_duration_real_and_apply_tail_sampling()
+
+        if collect_span_trees:
+            _log_span_tree()
+
+        log_level = logging.ERROR if response.status_code // 100 == 5 else logging.INFO
+        # building the log context (particularly request.url) isn't free, so don't bother if the record is only going
+        # to be thrown away
+        if not current_app.logger.isEnabledFor(log_level):
+            return response
+
+        aggregate_key = (
+            access_log_aggregator.get_aggregate_key(request.endpoint, request.path)
+            if log_level < logging.ERROR and not getattr(request, "is_sampled", False) else None
+        )
+        if aggregate_key is not None:
+            access_log_aggregator.add(aggregate_key, response.status_code, duration_real)
+            return response
+
         current_app.logger.log(
-            logging.ERROR if response.status_code // 100 == 5 else logging.INFO,
+            log_level,
             '{method} {url} {status}',
             extra={
                 "status": response.status_code,
-                "duration_real": (
-                    (time.perf_counter() - request.before_request_real_time)
-                    if hasattr(request, "before_request_real_time") else None
-                ),
+                "duration_real": duration_real,
                 "duration_process": (
                     (time.process_time() - request.before_request_process_time)
                     if hasattr(request, "before_request_process_time") else None
@@ -84,12 +195,15 @@ def init_app(app):
         )
         return response
 
+    app.teardown_request(_teardown_request)
+
     logging.getLogger().addHandler(logging.NullHandler())
 
     del app.logger.handlers[:]
 
     handler = get_handler(app)
     loglevel = logging.getLevelName(app.config['DM_LOG_LEVEL'])
+    logger_levels = _get_logger_levels(app)
     loggers = [
         app.logger,
         logging.getLogger('dmutils'),
@@ -103,13 +217,42 @@ def init_app(app):
 
     for logger_ in loggers:
         logger_.addHandler(handler)
-        logger_.setLevel(loglevel)
+        logger_.setLevel(logger_levels.get(logger_.name, loglevel))
+
+    # other loggers named in DM_LOG_LEVELS (e.g. children of the above) only get their level set. records they let
+    # through will propagate to the handler of their configured ancestor.
+    for logger_name, logger_level in logger_levels.items():
+        if logger_name not in (logger_.name for logger_ in loggers):
+            logging.getLogger(logger_name).setLevel(logger_level)
+
     app.logger.info('Logging configured')
 
 
+def _get_logger_levels(app):
+    """
+    Returns DM_LOG_LEVELS, a mapping of logger names to levels (either names or numbers), with all levels converted to
+    numbers
+    """
+    return {
+        logger_name: logging.getLevelName(level) if isinstance(level, str) else level
+        for logger_name, level in (app.config.get('DM_LOG_LEVELS') or {}).items()
+    }
+
+
 def configure_handler(handler, app, formatter):
-    handler.setLevel(logging.getLevelName(app.config['DM_LOG_LEVEL']))
+    # the handler has to accept the most verbose level any logger is configured for - the loggers' own levels will
+    # have already discarded (before any filter is run) records they aren't interested in
+    handler.setLevel(min((
+        logging.getLevelName(app.config['DM_LOG_LEVEL']),
+        *_get_logger_levels(app).values(),
+    )))
     handler.setFormatter(formatter)
+    # these go first so that discarded records don't have to pass through the more expensive filters
+    for filter_ in get_rate_limiting_filters(app.config.get('DM_LOG_RATE_LIMITS')):
+        handler.addFilter(filter_)
+        if isinstance(filter_, RateLimitingFilter):
+            # as for AccessLogAggregator, so the final summaries aren't lost
+            atexit.register(filter_.close)
     handler.addFilter(AppNameFilter(app.config['DM_APP_NAME']))
     handler.addFilter(RequestExtraContextFilter())
     handler.addFilter(AppStackLocationFilter("app_", app.root_path))
@@ -124,17 +267,572 @@ def get_json_log_format():
 def get_handler(app):
     if app.config.get('DM_PLAIN_TEXT_LOGS'):
         formatter = CustomLogFormatter(LOG_FORMAT)
+    elif app.config.get('DM_LOG_FAST_JSON'):
+        formatter = JSONFormatter(get_json_log_format(), json_serializer=fast_json_dumps)
     else:
         formatter = JSONFormatter(get_json_log_format())
 
-    if app.config.get('DM_LOG_PATH'):
+    if app.config.get('DM_LOG_PATH') and app.config.get('DM_LOG_BUFFERED'):
+        handler = BufferedJSONFileHandler(
+            app.config['DM_LOG_PATH'],
+            buffer_size=app.config.get('DM_LOG_BUFFER_SIZE', BufferedJSONFileHandler.DEFAULT_BUFFER_SIZE),
+            flush_interval=app.config.get(
+                'DM_LOG_BUFFER_FLUSH_INTERVAL',
+                BufferedJSONFileHandler.DEFAULT_FLUSH_INTERVAL,
+            ),
+            fsync_policy=app.config.get('DM_LOG_BUFFER_FSYNC_POLICY', BufferedJSONFileHandler.FSYNC_NEVER),
+        )
+    elif app.config.get('DM_LOG_PATH'):
         handler = logging.FileHandler(app.config['DM_LOG_PATH'])
     else:
         handler = logging.StreamHandler(sys.stdout)
 
+    if app.config.get('DM_LOG_ASYNC'):
+        # the "real" handler only has to format & write records on the listener thread - filtering still has to happen
+        # on the logging thread as our filters depend on request context & stack inspection
+        handler.setFormatter(formatter)
+        handler = AsyncQueueHandler(
+            handler,
+            maxsize=app.config.get('DM_LOG_ASYNC_QUEUE_SIZE', AsyncQueueHandler.DEFAULT_MAXSIZE),
+            overflow_policy=app.config.get('DM_LOG_ASYNC_OVERFLOW_POLICY', AsyncQueueHandler.OVERFLOW_BLOCK),
+        )
+
     return configure_handler(handler, app, formatter)
 
 
+class _LogRecordQueue(queue.Queue):
+    def evict(self, predicate=None):
+        """
+        Remove and return the oldest queued item for which `predicate` returns True (or simply the oldest item if
+        `predicate` is None), returning None if no such item was found. Does not block. Will never evict a queue
+        listener's (None) sentinel.
+        """
+        with self.mutex:
+            for item in self.queue:
+                if item is not None and (predicate is None or predicate(item)):
+                    self.queue.remove(item)
+                    self.unfinished_tasks -= 1
+                    self.not_full.notify()
+                    return item
+        return None
+
+
+class _LogRecordQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # QueueListener's default uses put_nowait, which would fail if our bounded queue happened to be full
+        self.queue.put(self._sentinel)
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+        Handler which passes records through a bounded in-memory queue to be formatted and written by `target_handler`
+        in a background thread, so the logging thread never has to wait on log I/O. What happens when the queue is
+        full is determined by `overflow_policy`:
+
+        - ``"block"``: wait for space in the queue (no records are lost)
+        - ``"drop-oldest"``: discard the oldest queued record to make room
+        - ``"drop-debug"``: discard the oldest queued DEBUG-or-lower record, failing that the incoming record if it is
+          DEBUG-or-lower, failing that the oldest queued record
+
+        Discarded records are counted by level name in `dropped_records`. Remaining queued records are written out
+        when the handler is closed, which `logging.shutdown` does on interpreter exit. A forked child process gets its
+        own queue and background thread the first time it handles a record, records queued before the fork being left
+        for the parent to write.
+    """
+    OVERFLOW_BLOCK = "block"
+    OVERFLOW_DROP_OLDEST = "drop-oldest"
+    OVERFLOW_DROP_DEBUG = "drop-debug"
+
+    DEFAULT_MAXSIZE = 10000
+
+    def __init__(self, target_handler, maxsize=DEFAULT_MAXSIZE, overflow_policy=OVERFLOW_BLOCK):
+        if overflow_policy not in (self.OVERFLOW_BLOCK, self.OVERFLOW_DROP_OLDEST, self.OVERFLOW_DROP_DEBUG):
+            raise ValueError(f"Unknown overflow_policy {overflow_policy!r}")
+
+        super().__init__(_LogRecordQueue(maxsize))
+        self.target_handler = target_handler
+        self.overflow_policy = overflow_policy
+        self.dropped_records = Counter()
+        self._dropped_records_lock = Lock()
+
+        self._listener = _LogRecordQueueListener(self.queue, self.target_handler)
+        self._listener.start()
+        self._restart_listener = False
+        self._reset_on_fork = ResetOnFork(self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # a forked child inherits our listener but not its thread. it needs a new queue as well, because the parent's
+        # listener may have been holding the queue's mutex at the time of the fork
+        if self._listener is not None:
+            self.queue = _LogRecordQueue(self.queue.maxsize)
+            self._dropped_records_lock = Lock()
+            self._listener = _LogRecordQueueListener(self.queue, self.target_handler)
+            self._restart_listener = True
+
+    def _ensure_listener(self):
+        self._reset_on_fork.check()
+        if self._restart_listener:
+            self._restart_listener = False
+            self._listener.start()
+
+    @property
+    def dropped_count(self):
+        return sum(self.dropped_records.values())
+
+    def _record_dropped(self, record):
+        with self._dropped_records_lock:
+            self.dropped_records[record.levelname] += 1
+
+    def prepare(self, record):
+        # resolve any %-style args now while they are guaranteed to still hold the values the caller intended. all
+        # other (more expensive) formatting is deferred to the listener thread.
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        # (called with the handler lock held, so only one thread can be restarting the listener)
+        self._ensure_listener()
+        if self.overflow_policy == self.OVERFLOW_BLOCK:
+            self.queue.put(record)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                evicted = None
+                if self.overflow_policy == self.OVERFLOW_DROP_DEBUG:
+                    evicted = self.queue.evict(lambda r: r.levelno <= logging.DEBUG)
+                    if evicted is None and record.levelno <= logging.DEBUG:
+                        self._record_dropped(record)
+                        return
+
+                evicted = evicted or self.queue.evict()
+                if evicted is not None:
+                    self._record_dropped(evicted)
+
+    def stop(self):
+        """
+        Write out all remaining queued records and stop the background thread. Records handled after this point will
+        be queued but never written.
+        """
+        self._ensure_listener()
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            self.target_handler.flush()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+class BufferedJSONFileHandler(logging.FileHandler):
+    """
+        File handler which collects formatted records in an in-memory buffer, writing them to the file in a single
+        write when the buffer reaches `buffer_size` characters, every `flush_interval` milliseconds (from a background
+        thread) or immediately when a record at `flush_level` or above is handled. Whether the file is also fsync-ed
+        after writing is determined by `fsync_policy`:
+
+        - ``"never"``: leave it to the OS
+        - ``"error"``: only when writing because of a record at `flush_level` or above
+        - ``"always"``: after every write
+
+        A forked child process starts with an empty buffer, records buffered before the fork being left for the parent
+        to write.
+    """
+    FSYNC_NEVER = "never"
+    FSYNC_ERROR = "error"
+    FSYNC_ALWAYS = "always"
+
+    DEFAULT_BUFFER_SIZE = 64 * 1024
+    DEFAULT_FLUSH_INTERVAL = 1000
+
+    def __init__(
+        self,
+        filename,
+        mode='a',
+        encoding=None,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        fsync_policy=FSYNC_NEVER,
+        flush_level=logging.ERROR,
+    ):
+        if fsync_policy not in (self.FSYNC_NEVER, self.FSYNC_ERROR, self.FSYNC_ALWAYS):
+            raise ValueError(f"Unknown fsync_policy {fsync_policy!r}")
+
+        super().__init__(filename, mode=mode, encoding=encoding)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.flush_level = flush_level
+
+        self._buffer = []
+        self._buffer_len = 0
+        self._stop_event = Event()
+        self._flusher = None
+        self._reset_on_fork = ResetOnFork(self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # otherwise the parent's buffered records would be written by both processes. the child needs its own flusher
+        # too, with its own stop event as the parent's flusher may have been waiting on the inherited one's lock
+        self._buffer = []
+        self._buffer_len = 0
+        stopped = self._stop_event.is_set()
+        self._stop_event = Event()
+        if stopped:
+            self._stop_event.set()
+        self._flusher = None
+
+    def _ensure_flusher(self):
+        if not self._stop_event.is_set():
+            self._flusher = ensure_thread(self._flusher, self._flush_periodically, "BufferedJSONFileHandler")
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self.flush_interval / 1000):
+            self.flush()
+
+    def _write_buffer(self, fsync):
+        # should be called with the handler lock held
+        if self._buffer:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write("".join(self._buffer))
+            self._buffer.clear()
+            self._buffer_len = 0
+
+        if self.stream is not None:
+            self.stream.flush()
+            if fsync:
+                os.fsync(self.stream.fileno())
+
+    def emit(self, record):
+        try:
+            self._reset_on_fork.check()
+            msg = self.format(record) + self.terminator
+            self._buffer.append(msg)
+            self._buffer_len += len(msg)
+
+            if record.levelno >= self.flush_level:
+                self._write_buffer(fsync=self.fsync_policy in (self.FSYNC_ERROR, self.FSYNC_ALWAYS))
+            elif self._buffer_len >= self.buffer_size:
+                self._write_buffer(fsync=self.fsync_policy == self.FSYNC_ALWAYS)
+            else:
+                self._ensure_flusher()
+        except Exception:  # noqa
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._reset_on_fork.check()
+            self._write_buffer(fsync=self.fsync_policy == self.FSYNC_ALWAYS)
+        finally:
+            self.release()
+
+    def close(self):
+        self._stop_event.set()
+        # FileHandler.close will flush() our buffer before closing the file
+        super().close()
+
+
+class AccessLogAggregator:
+    """
+        Collects statistics for requests to the given `endpoints` (by endpoint name) or URLs starting with one of the
+        given `url_prefixes`, so that instead of logging each such request individually, a summary record of the
+        request count, status codes and duration percentiles for each of them is logged every `interval` seconds
+        (from a background thread, so a summary is still logged if the requests stop coming). Any outstanding summary
+        is logged when the aggregator is closed. A forked child process starts a fresh interval, requests added before
+        the fork being left for the parent to summarize.
+    """
+    DEFAULT_INTERVAL = 60
+    # the maximum number of durations we keep per aggregate per interval to calculate percentiles from
+    MAX_DURATION_SAMPLES = 1000
+
+    def __init__(self, logger, endpoints=(), url_prefixes=(), interval=DEFAULT_INTERVAL):
+        self._logger = logger
+        self._endpoints = frozenset(endpoints)
+        self._url_prefixes = tuple(url_prefixes)
+        self._interval = interval
+
+        self._lock = Lock()
+        # aggregate key -> [request count, Counter of status codes, list of sampled durations]
+        self._aggregates = {}
+        self._interval_start = time.monotonic()
+        self._stop_event = Event()
+        self._flusher = None
+        self._reset_on_fork = ResetOnFork(self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = Lock()
+        self._aggregates = {}
+        self._interval_start = time.monotonic()
+        stopped = self._stop_event.is_set()
+        self._stop_event = Event()
+        if stopped:
+            self._stop_event.set()
+        self._flusher = None
+
+    def get_aggregate_key(self, endpoint, path):
+        """
+        Returns the endpoint name or url prefix requests to `endpoint` or `path` should be aggregated under, or None if
+        they shouldn't be
+        """
+        if endpoint in self._endpoints:
+            return endpoint
+        if self._url_prefixes and path.startswith(self._url_prefixes):
+            return next(prefix for prefix in self._url_prefixes if path.startswith(prefix))
+        return None
+
+    def add(self, aggregate_key, status, duration_real):
+        self._reset_on_fork.check()
+        now = time.monotonic()
+        with self._lock:
+            aggregate = self._aggregates.get(aggregate_key)
+            if aggregate is None:
+                aggregate = self._aggregates[aggregate_key] = [0, Counter(), []]
+
+            aggregate[0] += 1
+            aggregate[1][status] += 1
+            if duration_real is not None:
+                # reservoir sampling keeps our memory use bounded however many requests we get in an interval
+                if len(aggregate[2]) < self.MAX_DURATION_SAMPLES:
+                    aggregate[2].append(duration_real)
+                else:
+                    index = random.randrange(aggregate[0])
+                    if index < self.MAX_DURATION_SAMPLES:
+                        aggregate[2][index] = duration_real
+
+        self._ensure_flusher()
+        self.flush(now=now)
+
+    def _ensure_flusher(self):
+        if not self._stop_event.is_set():
+            self._flusher = ensure_thread(self._flusher, self._flush_periodically, "AccessLogAggregator")
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(max(0, self._interval_start + self._interval - time.monotonic())):
+            self.flush()
+
+    def flush(self, force=False, now=None):
+        """
+        Log summaries of the requests added in the current interval if it has ended (or regardless if `force`), and
+        start a new interval
+        """
+        self._reset_on_fork.check()
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not force and now - self._interval_start < self._interval:
+                return
+            aggregates, self._aggregates = self._aggregates, {}
+            interval_duration, self._interval_start = now - self._interval_start, now
+
+        for key, (count, status_counts, durations) in aggregates.items():
+            self._log_summary(key, count, status_counts, durations, interval_duration)
+
+    def close(self):
+        self._stop_event.set()
+        self.flush(force=True)
+
+    @staticmethod
+    def _percentile(sorted_values, percentile):
+        return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+    def _log_summary(self, aggregate_key, count, status_counts, durations, interval_duration):
+        durations.sort()
+        self._logger.info(
+            "{count} requests to {aggregate_key} in {interval}s",
+            extra={
+                "aggregate_key": aggregate_key,
+                "count": count,
+                "interval": interval_duration,
+                # json objects need string keys
+                "status_counts": {str(status): n for status, n in sorted(status_counts.items())},
+                **({
+                    "duration_real_p50": self._percentile(durations, 50),
+                    "duration_real_p90": self._percentile(durations, 90),
+                    "duration_real_p99": self._percentile(durations, 99),
+                    "duration_real_max": durations[-1],
+                } if durations else {}),
+            },
+        )
+
+
+def get_rate_limiting_filters(rate_limits):
+    """
+    Build the filters described by a ``DM_LOG_RATE_LIMITS``-style dict, which may contain the keys:
+
+    - ``rate``: sustained number of records per second to allow for each (logger, message template)
+    - ``burst``: number of records for each (logger, message template) allowed in a burst above ``rate``
+    - ``summary_interval``: minimum number of seconds between "suppressed records" summaries
+    - ``sample_rates``: mapping of level names to the fraction of records at that level to keep
+    """
+    filters = []
+    if not rate_limits:
+        return filters
+
+    if rate_limits.get("sample_rates"):
+        filters.append(SamplingFilter(rate_limits["sample_rates"]))
+    if rate_limits.get("rate"):
+        filters.append(RateLimitingFilter(
+            rate_limits["rate"],
+            burst=rate_limits.get("burst", RateLimitingFilter.DEFAULT_BURST),
+            summary_interval=rate_limits.get("summary_interval", RateLimitingFilter.DEFAULT_SUMMARY_INTERVAL),
+        ))
+
+    return filters
+
+
+class SamplingFilter(logging.Filter):
+    """
+        Filter which only lets through a random fraction of records at each level named in `sample_rates`. Records
+        at ERROR and above, and records emitted during sampled (i.e. traced) requests are always let through.
+    """
+    def __init__(self, sample_rates):
+        self._sample_rates = {
+            (level if isinstance(level, int) else logging.getLevelName(level)): sample_rate
+            for level, sample_rate in sample_rates.items()
+        }
+
+    def filter(self, record):
+        sample_rate = self._sample_rates.get(record.levelno)
+        if sample_rate is None or record.levelno >= logging.ERROR:
+            return True
+        if has_request_context() and getattr(request, "is_sampled", False):
+            return True
+
+        return random.random() < sample_rate
+
+
+class RateLimitingFilter(logging.Filter):
+    """
+        Filter which rate-limits records using a token bucket for each (logger, message template) pair, allowing a
+        sustained `rate` of records per second with bursts of up to `burst`. Records at ERROR and above are always let
+        through. A summary record noting how many records were suppressed is logged at most every `summary_interval`
+        seconds, either as the next record passes through the filter or from a background thread (so a summary is
+        still logged if the records stop coming). Any outstanding summary is logged when the filter is closed. A forked
+        child process starts with no suppressed records, those suppressed before the fork being left for the parent to
+        summarize.
+    """
+    DEFAULT_BURST = 10
+    DEFAULT_SUMMARY_INTERVAL = 60
+    # the number of distinct (logger, message template) buckets to track before we forget about them all and start
+    # again, in case of messages which aren't actually templates
+    MAX_BUCKETS = 10000
+
+    def __init__(self, rate, burst=DEFAULT_BURST, summary_interval=DEFAULT_SUMMARY_INTERVAL):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._summary_interval = summary_interval
+
+        self._lock = Lock()
+        # (logger name, message template) -> [tokens remaining, time of last update]
+        self._buckets = {}
+        # (logger name, message template) -> number of records suppressed since last summary
+        self._suppressed = Counter()
+        self._last_summary_time = time.monotonic()
+        self._stop_event = Event()
+        self._flusher = None
+        self._reset_on_fork = ResetOnFork(self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = Lock()
+        self._suppressed = Counter()
+        self._last_summary_time = time.monotonic()
+        stopped = self._stop_event.is_set()
+        self._stop_event = Event()
+        if stopped:
+            self._stop_event.set()
+        self._flusher = None
+
+    def _take_token(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                self._buckets.clear()
+            bucket = self._buckets[key] = [self._burst, now]
+
+        bucket[0] = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+    def _pop_due_summaries(self, now, force=False):
+        if not self._suppressed or (not force and now - self._last_summary_time < self._summary_interval):
+            return ()
+
+        summaries = tuple(self._suppressed.items())
+        self._suppressed.clear()
+        self._last_summary_time = now
+        return summaries
+
+    def _log_summaries(self, summaries):
+        # these must be logged outside of our lock as they will themselves pass through this filter
+        for (logger_name, message), suppressed_count in summaries:
+            logger.warning(
+                "Suppressed {suppressed_count} similar records from {suppressed_logger}: {suppressed_message}",
+                extra={
+                    "suppressed_count": suppressed_count,
+                    "suppressed_logger": logger_name,
+                    "suppressed_message": message,
+                    "rate_limit_summary": True,
+                },
+            )
+
+    def _ensure_flusher(self):
+        # (with no summary_interval every summary is logged straight away, so there's nothing for a flusher to do)
+        if self._summary_interval > 0 and not self._stop_event.is_set():
+            self._flusher = ensure_thread(self._flusher, self._flush_periodically, "RateLimitingFilter")
+
+    def _flush_periodically(self):
+        while not self._stop_event.wait(self._get_flush_delay()):
+            self.flush()
+
+    def _get_flush_delay(self):
+        # the time until a summary could next be due. if that's already passed, nothing can have been suppressed since
+        # (the filter call suppressing it would have logged a summary straight away), so we can wait a whole interval
+        delay = self._last_summary_time + self._summary_interval - time.monotonic()
+        return delay if delay > 0 else self._summary_interval
+
+    def flush(self, force=False):
+        """
+        Log summaries of the records suppressed since the last summary if `summary_interval` has passed since it (or
+        regardless if `force`)
+        """
+        self._reset_on_fork.check()
+        with self._lock:
+            summaries = self._pop_due_summaries(time.monotonic(), force=force)
+        self._log_summaries(summaries)
+
+    def close(self):
+        self._stop_event.set()
+        self.flush(force=True)
+
+    def filter(self, record):
+        if getattr(record, "rate_limit_summary", False):
+            return True
+
+        self._reset_on_fork.check()
+        now = time.monotonic()
+        key = (record.name, record.msg if isinstance(record.msg, str) else None)
+        with self._lock:
+            allowed = record.levelno >= logging.ERROR or self._take_token(key, now)
+            if not allowed:
+                self._suppressed[key] += 1
+            summaries = self._pop_due_summaries(now)
+
+        if not allowed:
+            self._ensure_flusher()
+        self._log_summaries(summaries)
+
+        return allowed
+
+
 class AppNameFilter(logging.Filter):
     def __init__(self, app_name):
         self.app_name = app_name
@@ -196,19 +894,25 @@ class AppStackLocationFilter(BaseExtraStackLocationFilter):
         that is from a module *within* the "app", based on the code location's
         filename and a provided base file_path_prefix for the "app"
     """
-    def __init__(self, param_prefix, file_path_prefix):
+    def __init__(self, param_prefix, file_path_prefix, filename_cache_size=4096):
         self._file_path_prefix = os.path.normcase(file_path_prefix)
+        # regarding abspath here: there is a possibility due to https://bugs.python.org/issue20443 that absolutizing
+        # these file paths won't work correctly if our python process has done a chdir. I don't think we generally
+        # do that but a better solution might be to outlaw relative imports.
+        self._abs_file_path_prefix = os.path.abspath(self._file_path_prefix)
+        # the answer for any given code filename isn't going to change, so there's no need to repeat the (relatively
+        # expensive) path manipulation every time we walk over a frame from it
+        self._is_app_filename = lru_cache(maxsize=filename_cache_size)(self._is_app_filename_uncached)
         super().__init__(param_prefix)
 
-    def is_interesting_frame(self, frame):
-        filename = os.path.normcase(frame.f_code.co_filename)
+    def _is_app_filename_uncached(self, filename):
         return os.path.commonpath(
-            # regarding abspath here: there is a possibility due to https://bugs.python.org/issue20443 that absolutizing
-            # these file paths won't work correctly if our python process has done a chdir. I don't think we generally
-            # do that but a better solution might be to outlaw relative imports.
-            (os.path.abspath(self._file_path_prefix), os.path.abspath(filename))
+            (self._abs_file_path_prefix, os.path.abspath(os.path.normcase(filename)))
         ) == self._file_path_prefix
 
+    def is_interesting_frame(self, frame):
+        return self._is_app_filename(frame.f_code.co_filename)
+
     def enabled_for_record(self, record):
         return record.levelno >= logging.WARNING or (has_request_context() and getattr(request, "is_sampled", False))
 
@@ -219,9 +923,10 @@ class RequestExtraContextFilter(logging.Filter):
         and make this available on log records
     """
     def filter(self, record):
-        if has_request_context() and callable(getattr(request, "get_extra_log_context", None)):
-            for key, value in request.get_extra_log_context().items():
-                setattr(record, key, value)
+        if has_request_context():
+            get_extra_log_context = getattr(request, "get_extra_log_context", None)
+            if callable(get_extra_log_context):
+                record.__dict__.update(get_extra_log_context())
 
         return record
 
@@ -261,28 +966,174 @@ class CustomLogFormatter(logging.Formatter):
         return msg
 
 
+def _json_default(obj):
+    """
+    Conversions for objects json can't natively represent, matching those of python-json-logger's JsonEncoder
+    """
+    if isinstance(obj, (date, datetime, datetime_time)):
+        return obj.isoformat()
+    if isinstance(obj, TracebackType):
+        return "".join(traceback.format_tb(obj)).strip()
+    # anything else (including exceptions and classes) gets stringified
+    try:
+        return str(obj)
+    except Exception:  # noqa
+        return None
+
+
+if orjson is not None:
+    FAST_JSON_BACKEND = "orjson"
+
+    def _fast_json_dumps(obj, ensure_ascii):
+        # orjson always outputs utf-8 rather than \u-escaping non-ascii characters, but either is equally valid json
+        return orjson.dumps(
+            obj,
+            default=_json_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        ).decode("utf-8")
+elif ujson is not None:
+    FAST_JSON_BACKEND = "ujson"
+
+    def _fast_json_dumps(obj, ensure_ascii):
+        return ujson.dumps(obj, default=_json_default, ensure_ascii=ensure_ascii)
+else:
+    FAST_JSON_BACKEND = "json"
+
+    def _fast_json_dumps(obj, ensure_ascii):
+        return json.dumps(obj, default=_json_default, ensure_ascii=ensure_ascii)
+
+
+def fast_json_dumps(obj, default=None, cls=None, indent=None, ensure_ascii=True, **kwargs):
+    """
+    A json.dumps-compatible serializer for use as a JSONFormatter's `json_serializer`, using the C-accelerated
+    library named by FAST_JSON_BACKEND if one is installed. Objects json can't natively represent are converted
+    as python-json-logger's JsonEncoder would - any `default` or `cls` passed are ignored in favour of this.
+    """
+    if indent is None and not kwargs:
+        try:
+            return _fast_json_dumps(obj, ensure_ascii)
+        except (TypeError, ValueError, OverflowError):
+            # e.g. integers too large for the backend to represent - let stdlib json have a go
+            pass
+
+    return json.dumps(obj, default=_json_default, indent=indent, ensure_ascii=ensure_ascii, **kwargs)
+
+
+# (conversion character -> function) as applied by str.format's "!" syntax
+_FORMAT_CONVERSIONS = {
+    "r": repr,
+    "s": str,
+    "a": ascii,
+}
+
+
+_formatter = string.Formatter()
+
+# a single attribute (".name") or index ("[key]") access in a str.format field name
+_FIELD_NAME_LOOKUP_PATTERN = re.compile(r"\.([^.[]+)|\[([^\]]+)\]")
+
+
+def _split_field_name(field_name):
+    """
+    Split a str.format field name into the name of the argument it refers to and a tuple of the ``(is_attribute,
+    name_or_index)`` accesses to perform on it, as str.format would. Returns None for field names which don't refer to
+    a keyword argument or can't be parsed.
+    """
+    match = re.match(r"[^.[]*", field_name)
+    key, position = match.group(), match.end()
+    if not key or key.isdecimal():
+        return None
+
+    lookups = []
+    while position < len(field_name):
+        match = _FIELD_NAME_LOOKUP_PATTERN.match(field_name, position)
+        if match is None:
+            return None
+        attribute, index = match.groups()
+        if attribute is not None:
+            lookups.append((True, attribute))
+        else:
+            lookups.append((False, int(index) if index.isdecimal() else index))
+        position = match.end()
+
+    return key, tuple(lookups)
+
+
+@lru_cache(maxsize=1024)
+def _compile_message_template(template):
+    """
+    Parse a str.format-style message template into a tuple of ``(literal_text, key, lookups, conversion,
+    format_spec)`` tuples, ``key`` being the name of the log record item the field refers to (or None for a trailing
+    piece of literal text) and ``lookups`` being the sequence of ``(is_attribute, name_or_index)`` accesses to perform
+    on that item.
+
+    Returns None for templates our fast path doesn't support (positional or nested fields) or which can't be parsed.
+    """
+    compiled = []
+    try:
+        for literal_text, field_name, format_spec, conversion in _formatter.parse(template):
+            if field_name is None:
+                compiled.append((literal_text, None, (), None, None,))
+                continue
+
+            split_field_name = _split_field_name(field_name)
+            if split_field_name is None or "{" in format_spec:
+                return None
+
+            key, lookups = split_field_name
+            compiled.append((literal_text, key, lookups, conversion, format_spec,))
+    except ValueError:
+        return None
+
+    return tuple(compiled)
+
+
 class JSONFormatter(BaseJSONFormatter):
+    RENAMED_KEYS = (
+        ("asctime", "time",),
+        ("trace_id", "requestId",),
+        ("span_id", "spanId",),
+        ("parent_span_id", "parentSpanId",),
+        ("app_name", "application",),
+        ("is_sampled", "isSampled",),
+        ("debug_flag", "debugFlag",),
+    )
+
     def __init__(self, *args, max_missing_key_attempts=5, **kwargs):
         super().__init__(*args, **kwargs)
         self._max_missing_key_attempts = max_missing_key_attempts
 
-    def process_log_record(self, log_record):
-        for key, newkey in (
-            ("asctime", "time",),
-            ("trace_id", "requestId",),
-            ("span_id", "spanId",),
-            ("parent_span_id", "parentSpanId",),
-            ("app_name", "application",),
-            ("is_sampled", "isSampled",),
-            ("debug_flag", "debugFlag",),
-        ):
-            try:
-                log_record[newkey] = log_record.pop(key)
-            except KeyError:
-                pass
+    @staticmethod
+    def _format_compiled_message(compiled_template, log_record):
+        """
+        Returns a tuple of the formatted message and an (ordered) dict of any missing keys mapped to the placeholder
+        value substituted for them.
+        """
+        parts = []
+        missing_keys = {}
+        for literal_text, key, lookups, conversion, format_spec in compiled_template:
+            parts.append(literal_text)
+            if key is None:
+                continue
 
-        log_record['logType'] = "application"
+            if key in log_record:
+                value = log_record[key]
+            else:
+                value = missing_keys.setdefault(key, f"{{{key}: missing key}}")
+
+            for is_attribute, name_or_index in lookups:
+                value = getattr(value, name_or_index) if is_attribute else value[name_or_index]
+            if conversion:
+                value = _FORMAT_CONVERSIONS[conversion](value)
+
+            parts.append(format(value, format_spec))
+
+        return "".join(parts), missing_keys
 
+    def _format_message(self, log_record):
+        """
+        Slower, general-purpose fallback for formatting the message, handling templates our compiled fast path can't
+        """
         missing_keys = {}
         for attempt in range(self._max_missing_key_attempts):
             try:
@@ -299,4 +1150,32 @@ class JSONFormatter(BaseJSONFormatter):
         else:
             logger.exception("Too many missing keys when attempting to format log message: gave up")
 
+    def process_log_record(self, log_record):
+        for key, newkey in self.RENAMED_KEYS:
+            if key in log_record:
+                log_record[newkey] = log_record.pop(key)
+
+        log_record['logType'] = "application"
+
+        message = log_record['message']
+        compiled_template = _compile_message_template(message) if isinstance(message, str) else None
+        if compiled_template is None:
+            self._format_message(log_record)
+            return log_record
+
+        try:
+            formatted_message, missing_keys = self._format_compiled_message(compiled_template, log_record)
+        except Exception:  # noqa
+            # leave any tricky cases (e.g. failing lookups inside a field) to be handled (or not) exactly as
+            # they always have been
+            self._format_message(log_record)
+            return log_record
+
+        if len(missing_keys) >= self._max_missing_key_attempts:
+            logger.exception("Too many missing keys when attempting to format log message: gave up")
+        else:
+            log_record['message'] = formatted_message
+            if missing_keys:
+                logger.warning("Missing keys when formatting log message: {}".format(tuple(missing_keys.keys())))
+
         return log_record
@@ -1,6 +1,21 @@
+import glob
+import json
+import os
+from threading import Lock
+import time
+
 from flask.signals import got_request_exception, request_finished
 
 from gds_metrics import GDSMetrics
+from prometheus_client.core import HistogramMetricFamily
+
+from dmutils.fork_safety import ResetOnFork, ensure_thread, get_pid
+from dmutils.timing import enable_duration_histograms
+
+
+def _get_multiprocess_dir():
+    # gds_metrics always sets up prometheus_client's multiprocess mode, defaulting the directory to /tmp
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
 
 
 class DMGDSMetrics(GDSMetrics):
@@ -15,8 +30,135 @@ class DMGDSMetrics(GDSMetrics):
     We should then call `add_url_rule` on our metrics blueprint instead (see github.com/alphagov/digitalmarketplace-brief-responses-frontend/blob/a0e89b3c84d6c49393b2264e6b4ca6508e7286d9/app/metrics/__init__.py#L31). # NOQA
     This binds our initialised metrics object's endpoint to the blueprint rather than the base application object.
     """
+    duration_histogram_exporter = None
 
     def init_app(self, app):
         app.before_request(self.before_request)
         request_finished.connect(self.teardown_request, sender=app)
         got_request_exception.connect(self.handle_exception, sender=app)
+
+        if app.config.get("DM_DURATION_HISTOGRAMS"):
+            self.duration_histogram_exporter = DurationHistogramExporter(
+                enable_duration_histograms(),
+                registry=self.registry,
+                multiprocess_dir=_get_multiprocess_dir(),
+                flush_interval=app.config.get(
+                    "DM_DURATION_HISTOGRAMS_FLUSH_INTERVAL",
+                    DurationHistogramExporter.DEFAULT_FLUSH_INTERVAL,
+                ),
+            )
+
+    def teardown_request(self, sender, response, *args, **kwargs):
+        if self.duration_histogram_exporter is not None:
+            # (re)starting the flusher here means it gets started in each worker process
+            self.duration_histogram_exporter.ensure_flusher()
+        return super().teardown_request(sender, response, *args, **kwargs)
+
+
+class DurationHistogramExporter:
+    """Exports the durations recorded by `logged_duration` in a DurationHistogramRegistry as the prometheus histogram
+    ``dm_logged_duration_seconds``, through a custom collector registered with `registry`.
+
+    GDSMetrics serves the metrics of all of an app's worker processes from whichever of them is scraped. So given a
+    `multiprocess_dir` (DMGDSMetrics uses prometheus_client's multiprocess directory), each worker writes a snapshot of
+    its counts to a file of its own there every `flush_interval` seconds (from a background thread, started after the
+    worker's first request) and whenever it's scraped, and the histogram exported is the sum of every worker's snapshot.
+    As with prometheus_client's own files, the directory should be emptied when the app is (re)started. Without a
+    `multiprocess_dir`, only the current process's counts are exported.
+    """
+    name = "dm_logged_duration_seconds"
+    documentation = "Durations of blocks timed by logged_duration"
+
+    DEFAULT_FLUSH_INTERVAL = 10
+
+    def __init__(
+        self,
+        duration_histogram_registry,
+        registry=None,
+        multiprocess_dir=None,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.duration_histogram_registry = duration_histogram_registry
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        # the upper bounds of the buckets as prometheus labels them
+        self._bucket_names = tuple(repr(float(bound)) for bound in duration_histogram_registry.buckets) + ("+Inf",)
+
+        self._flusher = None
+        self._reset_after_fork()
+        self._reset_on_fork = ResetOnFork(self._reset_after_fork)
+        if registry is not None:
+            registry.register(self)
+
+    def _reset_after_fork(self):
+        # the parent's flusher may have been holding the lock when it forked
+        self._lock = Lock()
+        self._flushed_snapshot = None
+
+    def _get_snapshot_path(self, pid):
+        return os.path.join(self.multiprocess_dir, f"{self.name}_{pid}.json")
+
+    def ensure_flusher(self):
+        if self.multiprocess_dir is not None:
+            self._flusher = ensure_thread(self._flusher, self._flush_periodically, "DurationHistogramExporter")
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write a snapshot of the current process's counts to its file in `multiprocess_dir`"""
+        if self.multiprocess_dir is None:
+            return
+
+        self._reset_on_fork.check()
+        snapshot = sorted(
+            [logger_name, label, cumulative_counts, sum_value]
+            for (logger_name, label), (cumulative_counts, sum_value)
+            in self.duration_histogram_registry.collect().items()
+        )
+        with self._lock:
+            if snapshot == self._flushed_snapshot:
+                return
+
+            path = self._get_snapshot_path(get_pid())
+            # written to a temporary file first so that a process reading the snapshot never sees half of it
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(f"{path}.tmp", path)
+            self._flushed_snapshot = snapshot
+
+    def _collect_snapshots(self):
+        merged = {}
+        for path in glob.glob(self._get_snapshot_path("*")):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for logger_name, label, cumulative_counts, sum_value in snapshot:
+                merged_counts, merged_sum = merged.get((logger_name, label), ([0] * len(cumulative_counts), 0.))
+                merged[logger_name, label] = (
+                    [a + b for a, b in zip(merged_counts, cumulative_counts)],
+                    merged_sum + sum_value,
+                )
+        return merged
+
+    def collect(self):
+        if self.multiprocess_dir is None:
+            histograms = self.duration_histogram_registry.collect()
+        else:
+            # this process's counts at least can be right up to date
+            self.flush()
+            histograms = self._collect_snapshots()
+
+        family = HistogramMetricFamily(self.name, self.documentation, labels=("logger", "label"))
+        for (logger_name, label), (cumulative_counts, sum_value) in sorted(histograms.items()):
+            family.add_metric(
+                (logger_name, label),
+                buckets=tuple(zip(self._bucket_names, cumulative_counts)),
+                sum_value=sum_value,
+            )
+        yield family
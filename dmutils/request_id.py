@@ -1,16 +1,155 @@
+from collections import namedtuple
 from itertools import chain
-from random import SystemRandom
+import os
+from random import random
+import re
+from threading import Lock
 
 from flask import request, current_app
 
+from dmutils.fork_safety import ResetOnFork
+
+
+class RandomIdGenerator(object):
+    """
+        Generates random hex ids by slicing up a buffer of ``os.urandom`` bytes, refilled ``buffer_size`` bytes at a
+        time, rather than making a syscall for every id. The buffer is discarded in forked child processes so a child
+        can never hand out the same ids as its parent (or its siblings).
+    """
+    DEFAULT_BUFFER_SIZE = 4096
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self._reset()
+        self._reset_on_fork = ResetOnFork(self._reset)
+
+    def _reset(self):
+        self._lock = Lock()
+        self._buffer = b""
+        self._offset = 0
+
+    def get_hex_id(self, bitlen):
+        """
+            Returns a random id of ``bitlen`` bits (a multiple of 8) as a zero-padded, lower-case hex string
+        """
+        nbytes = bitlen >> 3
+        self._reset_on_fork.check()
+        with self._lock:
+            offset = self._offset
+            end = offset + nbytes
+            if end > len(self._buffer):
+                self._buffer = os.urandom(max(self.buffer_size, nbytes))
+                offset, end = 0, nbytes
+            self._offset = end
+            buffer = self._buffer
+        return buffer[offset:end].hex()
+
+
+class RequestSampler(object):
+    """
+        Makes sampling decisions for requests which arrive without one in their headers (i.e. when there's no
+        zipkin-aware router in front of us making them). Requests are sampled with probability ``rate``, or the rate
+        given for their endpoint in ``endpoint_rates``. With a ``slow_threshold`` (in seconds), requests which weren't
+        sampled up-front but turn out to take longer than this are also considered sampled from the point they finish.
+    """
+    def __init__(self, rate=0., endpoint_rates=None, slow_threshold=None):
+        self.rate = rate
+        self.endpoint_rates = endpoint_rates or {}
+        self.slow_threshold = slow_threshold
+
+    def should_sample(self, endpoint):
+        rate = self.endpoint_rates.get(endpoint, self.rate)
+        # avoiding a random() call for the common cases
+        return rate >= 1 or (rate > 0 and random() < rate)
+
+    def should_tail_sample(self, duration_real):
+        return self.slow_threshold is not None and duration_real > self.slow_threshold
+
+
+# https://www.w3.org/TR/trace-context/#traceparent-header - versions after 00 may append further fields
+_traceparent_re = re.compile(r"([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?")
+_trace_id_re = re.compile(r"[0-9a-f]{16}|[0-9a-f]{32}")
+_span_id_re = re.compile(r"[0-9a-f]{16}")
+_TRACEPARENT_ENVIRON_KEY = "HTTP_TRACEPARENT"
+_TRACESTATE_ENVIRON_KEY = "HTTP_TRACESTATE"
+_INVALID_TRACE_ID = "0" * 32
+_INVALID_SPAN_ID = "0" * 16
+
+
+def _parse_traceparent(traceparent):
+    """
+    Returns a tuple of (trace id, span id, is sampled header value) from a W3C traceparent header value, or None if it
+    isn't valid
+    """
+    match = _traceparent_re.fullmatch(traceparent.strip())
+    if match is None:
+        return None
+    version, trace_id, span_id, flags, extra = match.groups()
+    if version == "ff" or (version == "00" and extra) or trace_id == _INVALID_TRACE_ID or span_id == _INVALID_SPAN_ID:
+        return None
+    return trace_id, span_id, "1" if int(flags, 16) & 1 else "0"
+
+
+def _format_traceparent(trace_id, span_id, is_sampled):
+    """
+    Returns a W3C traceparent header value, or None if ``trace_id`` or ``span_id`` aren't representable in one
+    """
+    if not trace_id or not span_id or not _trace_id_re.fullmatch(trace_id) or not _span_id_re.fullmatch(span_id):
+        return None
+    # 64-bit b3 trace ids are left-padded https://www.w3.org/TR/trace-context/#interoperating-with-existing-systems
+    return f"00-{trace_id.rjust(32, '0')}-{span_id}-{'01' if is_sampled else '00'}"
+
+
+def _get_environ_key(header_name):
+    # the key werkzeug would look a header up under in a wsgi environ
+    key = header_name.upper().replace("-", "_")
+    return key if key in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + key
+
+
+class RequestIdHeaderPlan(namedtuple("RequestIdHeaderPlan", (
+    "trace_id_headers",
+    "span_id_headers",
+    "parent_span_id_headers",
+    "is_sampled_headers",
+    "debug_flag_headers",
+    # for each of the above, the wsgi environ keys of its headers
+    "environ_keys",
+    # whether to also understand & propagate W3C trace context (traceparent/tracestate) headers
+    "w3c_trace_context",
+))):
+    """
+        The header names used for each of the trace values, compiled from an app's config once by init_app so that
+        requests don't have to consult the config and do case-insensitive header lookups for each value
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config):
+        header_names = tuple(tuple(config[key]) for key in (
+            "DM_TRACE_ID_HEADERS",
+            "DM_SPAN_ID_HEADERS",
+            "DM_PARENT_SPAN_ID_HEADERS",
+            "DM_IS_SAMPLED_HEADERS",
+            "DM_DEBUG_FLAG_HEADERS",
+        ))
+        return cls(
+            *header_names,
+            environ_keys=tuple(tuple(map(_get_environ_key, names)) for names in header_names),
+            w3c_trace_context=bool(config.get("DM_W3C_TRACE_CONTEXT")),
+        )
+
 
 class RequestIdRequestMixin(object):
     """
         A mixin intended for use against a flask Request class, implementing extraction (and partly generation) of
         headers approximately according to the "zipkin" scheme https://github.com/openzipkin/b3-propagation
     """
-    # a single class-wide random instance should be good enough for now
-    _spanid_random = _traceid_random = SystemRandom()
+    # a single class-wide id generator should be good enough for now
+    _span_id_generator = _trace_id_generator = RandomIdGenerator()
+    # RequestSampler to use for requests without a sampling decision in their headers, set by init_app
+    _request_sampler = None
+    # RequestIdHeaderPlan, set by init_app
+    _header_plan = None
 
     @property
     def request_id(self):
@@ -23,9 +162,7 @@ class RequestIdRequestMixin(object):
             be used. Failing that, this will be an id we've generated and assigned ourselves.
         """
         if not hasattr(self, "_trace_id"):
-            self._trace_id = self._get_first_header(
-                current_app.config['DM_TRACE_ID_HEADERS']
-            ) or self._get_new_trace_id()
+            self._trace_id = self._get_header_values()[0] or self._get_new_trace_id()
         return self._trace_id
 
     @property
@@ -38,7 +175,7 @@ class RequestIdRequestMixin(object):
             # an environment with no span-id-aware request router, and thus would have no intermediary to prevent the
             # propagation of our span id all the way through all our onwards requests much like trace id. and the point
             # of span id is to assign identifiers to each individual request.
-            self._span_id = self._get_first_header(current_app.config['DM_SPAN_ID_HEADERS'])
+            self._span_id = self._get_header_values()[1]
         return self._span_id
 
     @property
@@ -47,23 +184,94 @@ class RequestIdRequestMixin(object):
             The "parent span id" (in zipkin terms) set in this request's header, if present (None otherwise)
         """
         if not hasattr(self, "_parent_span_id"):
-            self._parent_span_id = self._get_first_header(current_app.config['DM_PARENT_SPAN_ID_HEADERS'])
+            self._parent_span_id = self._get_header_values()[2]
         return self._parent_span_id
 
     @property
     def is_sampled(self):
         if not hasattr(self, "_is_sampled"):
-            header_value = self._get_first_header(current_app.config['DM_IS_SAMPLED_HEADERS'])
+            header_value = self._get_header_values()[3]
             self._is_sampled = self.debug_flag or (None if header_value is None else header_value == "1")
+            if self._is_sampled is None and self._request_sampler is not None:
+                # nobody upstream has made a decision, so it's up to us
+                self._is_sampled = self._request_sampler.should_sample(self.endpoint)
         return self._is_sampled
 
+    @property
+    def tail_sampling_enabled(self):
+        """
+            Whether this request could still become sampled on completion through ``apply_tail_sampling``
+        """
+        return (
+            self._request_sampler is not None
+            and self._request_sampler.slow_threshold is not None
+            and not self.is_sampled
+        )
+
+    def apply_tail_sampling(self, duration_real):
+        """
+            To be called once the request has been handled, marking the request as sampled if it was slow enough
+            according to the app's RequestSampler. Returns the final value of ``is_sampled``.
+        """
+        if self.tail_sampling_enabled and self._request_sampler.should_tail_sample(duration_real):
+            self._is_sampled = True
+        return self.is_sampled
+
+    @property
+    def tracestate(self):
+        """
+            The W3C "tracestate" header value received alongside a valid "traceparent", if W3C trace context is enabled
+        """
+        return self._get_header_values()[5]
+
     @property
     def debug_flag(self):
         if not hasattr(self, "_debug_flag"):
-            header_value = self._get_first_header(current_app.config['DM_DEBUG_FLAG_HEADERS'])
+            header_value = self._get_header_values()[4]
             self._debug_flag = None if header_value is None else header_value == "1"
         return self._debug_flag
 
+    def _get_header_plan(self):
+        # falling back to compiling a plan from the config for classes not set up by init_app
+        return self._header_plan or RequestIdHeaderPlan.from_config(current_app.config)
+
+    def _read_header_values(self):
+        """
+        Returns a tuple of the first present (and Truthy) header value (or None) for each of the trace values in the
+        order they appear in RequestIdHeaderPlan, read directly from the wsgi environ, followed by the tracestate
+        header's value
+        """
+        environ = self.environ
+        header_plan = self._get_header_plan()
+        header_values = tuple(
+            next((environ[key] for key in keys if environ.get(key)), None)
+            for keys in header_plan.environ_keys
+        )
+        if not header_plan.w3c_trace_context:
+            return header_values + (None,)
+
+        traceparent_values = _parse_traceparent(environ.get(_TRACEPARENT_ENVIRON_KEY) or "")
+        if traceparent_values is None:
+            # tracestate is meaningless without a valid traceparent
+            return header_values + (None,)
+
+        trace_id, span_id, parent_span_id, is_sampled, debug_flag = header_values
+        # values from b3-style headers take precedence
+        return (
+            trace_id or traceparent_values[0],
+            span_id or traceparent_values[1],
+            parent_span_id,
+            is_sampled or traceparent_values[2],
+            debug_flag,
+            environ.get(_TRACESTATE_ENVIRON_KEY) or None,
+        )
+
+    def _get_header_values(self):
+        header_values = self.__dict__.get("_header_values")
+        if header_values is None:
+            header_values = self._header_values = self._read_header_values()
+        return header_values
+
     def _get_first_header(self, header_names):
         """
         Returns value of request's first present (and Truthy) header from header_names
@@ -75,48 +283,59 @@ class RequestIdRequestMixin(object):
             return None
 
     def _get_new_trace_id(self):
-        bitlen = 128
-        return hex(self._traceid_random.randrange(1 << bitlen))[2:].rjust(bitlen // 4, "0")
+        return self._trace_id_generator.get_hex_id(128)
 
     def _get_new_span_id(self):
-        bitlen = 64
-        return hex(self._spanid_random.randrange(1 << bitlen))[2:].rjust(bitlen // 4, "0")
+        return self._span_id_generator.get_hex_id(64)
 
     def get_onwards_request_headers(self):
         """
             Headers to add to any further (internal) http api requests we perform if we want that request to be
             considered part of this "trace id"
         """
+        header_plan = self._get_header_plan()
         new_span_id = self._get_new_span_id()
-        return dict(chain(
-            (
-                (header_name, self.trace_id)
-                for header_name in current_app.config['DM_TRACE_ID_HEADERS']
-            ) if self.trace_id else (),
-            (
-                (header_name, new_span_id)
-                for header_name in current_app.config['DM_SPAN_ID_HEADERS']
-            ) if self.trace_id else (),
-            (
-                (header_name, self.span_id)
-                for header_name in current_app.config['DM_PARENT_SPAN_ID_HEADERS']
-            ) if self.span_id else (),
-            (
-                (header_name, "1" if self.is_sampled else "0")
-                for header_name in current_app.config['DM_IS_SAMPLED_HEADERS']
-                # according to zipkin spec we shouldn't propagate the sampling decision if debug_flag is set
-            ) if self.is_sampled is not None and not self.debug_flag else (),
-            (
-                (header_name, "1" if self.debug_flag else "0")
-                for header_name in current_app.config['DM_DEBUG_FLAG_HEADERS']
-            ) if self.debug_flag is not None else (),
-        ))
+
+        onwards_request_headers = {}
+        if self.trace_id:
+            onwards_request_headers.update(dict.fromkeys(header_plan.trace_id_headers, self.trace_id))
+            onwards_request_headers.update(dict.fromkeys(header_plan.span_id_headers, new_span_id))
+        if self.span_id:
+            onwards_request_headers.update(dict.fromkeys(header_plan.parent_span_id_headers, self.span_id))
+        # according to zipkin spec we shouldn't propagate the sampling decision if debug_flag is set
+        if self.is_sampled is not None and not self.debug_flag:
+            onwards_request_headers.update(
+                dict.fromkeys(header_plan.is_sampled_headers, "1" if self.is_sampled else "0")
+            )
+        if self.debug_flag is not None:
+            onwards_request_headers.update(
+                dict.fromkeys(header_plan.debug_flag_headers, "1" if self.debug_flag else "0")
+            )
+        if header_plan.w3c_trace_context:
+            traceparent = _format_traceparent(self.trace_id, new_span_id, self.is_sampled)
+            if traceparent is not None:
+                onwards_request_headers["traceparent"] = traceparent
+                if self.tracestate:
+                    onwards_request_headers["tracestate"] = self.tracestate
+        return onwards_request_headers
+
+    # the (lazily populated) attributes the values in get_extra_log_context are derived from
+    _extra_log_context_source_attrs = ("_trace_id", "_span_id", "_parent_span_id", "_is_sampled", "_debug_flag",)
+
+    def _get_extra_log_context_key(self):
+        return tuple(map(self.__dict__.get, self._extra_log_context_source_attrs))
 
     def get_extra_log_context(self):
         """
-            extra attributes to be made available on a log record based on this request
+            extra attributes to be made available on a log record based on this request. this is computed once and
+            stored on the request, only being rebuilt if any of the trace values it was built from change, so
+            callers should treat the returned dict as read-only.
         """
-        return {
+        snapshot = self.__dict__.get("_extra_log_context")
+        if snapshot is not None and snapshot[0] == self._get_extra_log_context_key():
+            return snapshot[1]
+
+        extra_log_context = {
             "trace_id": self.trace_id,
             "span_id": self.span_id,
             "parent_span_id": self.parent_span_id,
@@ -124,13 +343,21 @@ class RequestIdRequestMixin(object):
             "is_sampled": "1" if self.is_sampled else "0",
             "debug_flag": "1" if self.debug_flag else "0",
         }
+        self._extra_log_context = (self._get_extra_log_context_key(), extra_log_context,)
+        return extra_log_context
 
 
 class ResponseHeaderMiddleware(object):
-    def __init__(self, app, trace_id_headers, span_id_headers):
+    def __init__(self, app, trace_id_headers, span_id_headers, w3c_trace_context=False):
         self.app = app
         self.trace_id_headers = trace_id_headers
         self.span_id_headers = span_id_headers
+        self.w3c_trace_context = w3c_trace_context
+
+    def _get_w3c_response_headers(self):
+        # https://w3c.github.io/trace-context/#traceresponse-header
+        traceresponse = _format_traceparent(request.trace_id, request.span_id, request.is_sampled)
+        return (("traceresponse", traceresponse,),) if traceresponse is not None else ()
 
     def __call__(self, environ, start_response):
         def rewrite_response_headers(status, headers, exc_info=None):
@@ -146,6 +373,8 @@ class ResponseHeaderMiddleware(object):
                     for header_name in self.span_id_headers
                     if header_name.lower() not in lower_existing_header_names
                 ),
+                self._get_w3c_response_headers()
+                if self.w3c_trace_context and "traceresponse" not in lower_existing_header_names else (),
             ))
 
             return start_response(status, headers, exc_info)
@@ -162,6 +391,8 @@ def init_app(app):
     app.config.setdefault("DM_PARENT_SPAN_ID_HEADERS", ("X-B3-ParentSpanId",))
     app.config.setdefault("DM_IS_SAMPLED_HEADERS", ("X-B3-Sampled",))
     app.config.setdefault("DM_DEBUG_FLAG_HEADERS", ("X-B3-Flags",))
+    # also understand & propagate W3C trace context headers (traceparent, tracestate)
+    app.config.setdefault("DM_W3C_TRACE_CONTEXT", False)
 
     # we do something a little odd here now - back-populate the first value of DM_TRACE_ID_HEADERS back to the
     # DM_REQUEST_ID_HEADER setting, because it turns out that some components (notably the apiclient) depend on that
@@ -169,13 +400,29 @@ def init_app(app):
     if app.config.get("DM_TRACE_ID_HEADERS"):
         app.config["DM_REQUEST_ID_HEADER"] = app.config["DM_TRACE_ID_HEADERS"][0]
 
+    request_sampler = (
+        RequestSampler(
+            rate=app.config.get("DM_SAMPLING_RATE") or 0.,
+            endpoint_rates=app.config.get("DM_SAMPLING_ENDPOINT_RATES"),
+            slow_threshold=app.config.get("DM_SAMPLING_SLOW_THRESHOLD"),
+        ) if any(app.config.get(key) is not None for key in (
+            "DM_SAMPLING_RATE",
+            "DM_SAMPLING_ENDPOINT_RATES",
+            "DM_SAMPLING_SLOW_THRESHOLD",
+        )) else None
+    )
+
+    header_plan = RequestIdHeaderPlan.from_config(app.config)
+
     # dynamically define this class as we don't necessarily know how request_class may have already been modified by
     # another init_app
     class _RequestIdRequest(RequestIdRequestMixin, app.request_class):
-        pass
+        _request_sampler = request_sampler
+        _header_plan = header_plan
     app.request_class = _RequestIdRequest
     app.wsgi_app = ResponseHeaderMiddleware(
         app.wsgi_app,
         app.config['DM_TRACE_ID_HEADERS'],
         app.config['DM_SPAN_ID_HEADERS'],
+        w3c_trace_context=header_plan.w3c_trace_context,
     )
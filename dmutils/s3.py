@@ -1,16 +1,23 @@
 from __future__ import absolute_import
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from dateutil.parser import parse as parse_time
 import logging
 import mimetypes
 import os
+from threading import Lock
+import time
 
 # a bit of a lie here - retains compatibility with consumers that were importing boto2's S3ResponseError from here. this
 # is the exception boto3 raises in (mostly) the same situations.
 from botocore.exceptions import ClientError as S3ResponseError
 
+from .fork_safety import ResetOnFork
 from .formats import DATETIME_FORMAT
 from .timing import logged_duration_for_external_request as log_external_request
 
@@ -21,10 +28,180 @@ FILE_SIZE_LIMIT = 5400000  # approximately 5Mb
 default_region = "eu-west-1"
 
 
+class S3ClientCache(object):
+    """
+        A thread-safe, per-process cache of boto3 S3 clients, keyed by region, credentials and max_pool_connections, so
+        that S3 instances constructed per request or per bucket can share a client - and with it the client's loaded
+        service model and pool of keep-alive connections - rather than each building their own. boto3 clients are
+        thread-safe, and each resource handed out is a new (cheap) one wrapping a shared client. Clients are created
+        from boto3's default session if there is one (e.g. set up with ``boto3.setup_default_session``), otherwise from
+        a new session of their own. The cache is emptied in forked child processes so a child never shares its parent's
+        connections.
+    """
+    # the environment variables boto3 takes default credentials from - including these in cache keys means a change of
+    # credentials gets a new client (unless there's a default session, which will have resolved its credentials already)
+    CREDENTIALS_ENVIRONMENT_VARIABLES = (
+        "AWS_ACCESS_KEY_ID",
+        "AWS_SECRET_ACCESS_KEY",
+        "AWS_SESSION_TOKEN",
+        "AWS_PROFILE",
+    )
+
+    def __init__(self):
+        self._reset()
+        self._reset_on_fork = ResetOnFork(self._reset)
+
+    def _reset(self):
+        self._lock = Lock()
+        # (resource class, Bucket class, client) tuples - boto3 generates resource classes on the fly, rather
+        # expensively, so we reuse those too
+        self._entries = {}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_entry(self, region_name, max_pool_connections):
+        self._reset_on_fork.check()
+
+        # anything configured with boto3.setup_default_session should apply as it would to boto3.resource(...), so a
+        # default session is used in place of a new one - and is part of the key, so setting up another gets new
+        # clients. (as with boto3.resource(...), a default session's credentials don't then change with the environment)
+        default_session = boto3.DEFAULT_SESSION
+        cache_key = (region_name, max_pool_connections, default_session) + tuple(
+            os.environ.get(name) for name in self.CREDENTIALS_ENVIRONMENT_VARIABLES
+        )
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                # boto3 sessions aren't thread-safe, so without a default session each client gets its own (which we
+                # hold the lock while using)
+                session = default_session or boto3.session.Session()
+                resource = session.resource(
+                    "s3",
+                    region_name=region_name,
+                    config=Config(max_pool_connections=max_pool_connections),
+                )
+                entry = self._entries[cache_key] = (
+                    type(resource),
+                    type(resource.Bucket("")),
+                    resource.meta.client,
+                )
+            return entry
+
+    def get_client(self, region_name, max_pool_connections):
+        return self._get_entry(region_name, max_pool_connections)[2]
+
+    def get_resource(self, region_name, max_pool_connections):
+        resource_class, _, client = self._get_entry(region_name, max_pool_connections)
+        return resource_class(client=client)
+
+    def get_bucket(self, bucket_name, region_name, max_pool_connections):
+        _, bucket_class, client = self._get_entry(region_name, max_pool_connections)
+        return bucket_class(bucket_name, client=client)
+
+
+_s3_client_cache = S3ClientCache()
+
+
+def get_s3_client_cache():
+    """Returns the process's shared S3ClientCache"""
+    return _s3_client_cache
+
+
+class S3MetadataCache(object):
+    """
+        A thread-safe LRU cache of the custom timestamps of S3 objects, keyed by (bucket name, key, ETag) so that an
+        object which has changed since it was cached will always be a miss. Can be shared between S3 instances.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, cache_key):
+        with self._lock:
+            value = self._entries.get(cache_key)
+            if value is not None:
+                self._entries.move_to_end(cache_key)
+            return value
+
+    def set(self, cache_key, value):
+        with self._lock:
+            self._entries[cache_key] = value
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class S3ExistenceCache(S3MetadataCache):
+    """
+        A thread-safe LRU cache of which S3 objects were recently found to exist, keyed by (bucket name, key), with
+        entries expiring after ``ttl`` seconds. Only objects which exist are cached, so a newly-created object is never
+        hidden by a stale miss - at worst a URL for a recently-deleted object may be signed. Can be shared between S3
+        instances.
+    """
+    def __init__(self, ttl=10, maxsize=10000):
+        super().__init__(maxsize=maxsize)
+        self.ttl = ttl
+
+    def get(self, cache_key):
+        entry = super().get(cache_key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, cache_key, value):
+        super().set(cache_key, (value, time.monotonic() + self.ttl))
+
+    def discard(self, cache_key):
+        with self._lock:
+            self._entries.pop(cache_key, None)
+
+
 class S3(object):
-    def __init__(self, bucket_name, region_name=default_region):
-        self._resource = boto3.resource("s3", region_name=region_name)
-        self._bucket = self._resource.Bucket(bucket_name)
+    # maximum number of concurrent HEAD requests made by list(load_timestamps=True)
+    LIST_TIMESTAMPS_MAX_WORKERS = 16
+    # maximum number of concurrent HEAD requests made by get_signed_urls
+    SIGNED_URLS_MAX_WORKERS = 16
+    # files of at least this size are uploaded by save() in parts rather than with a single PUT
+    MULTIPART_THRESHOLD = 64 * 1024 * 1024
+    MULTIPART_PART_SIZE = 16 * 1024 * 1024
+    MULTIPART_MAX_CONCURRENCY = 8
+    # enough connections for all of our concurrent HEAD requests to keep theirs alive
+    MAX_POOL_CONNECTIONS = 16
+
+    def __init__(
+        self,
+        bucket_name,
+        region_name=default_region,
+        metadata_cache=None,
+        existence_cache=None,
+        multipart_threshold=None,
+        multipart_part_size=None,
+        multipart_max_concurrency=None,
+        max_pool_connections=None,
+    ):
+        """
+        :param bucket_name:               name of the bucket to operate on
+        :param region_name:               AWS region of the bucket
+        :param metadata_cache:            optional S3MetadataCache for list(load_timestamps=True) to use to avoid
+                                          re-fetching the timestamps of unchanged objects
+        :param existence_cache:           optional S3ExistenceCache for get_signed_url(s) to use to avoid re-checking
+                                          that recently-seen objects exist
+        :param multipart_threshold:       size in bytes from which save() switches to a multipart upload
+        :param multipart_part_size:       size in bytes of each part of a multipart upload (S3 requires at least 5MiB)
+        :param multipart_max_concurrency: maximum number of parts of a multipart upload to upload at once
+        :param max_pool_connections:      maximum number of connections to keep in the (shared) client's pool
+        """
+        max_pool_connections = max_pool_connections or self.MAX_POOL_CONNECTIONS
+        self._resource = _s3_client_cache.get_resource(region_name, max_pool_connections)
+        self._bucket = _s3_client_cache.get_bucket(bucket_name, region_name, max_pool_connections)
+        self._metadata_cache = metadata_cache
+        self._existence_cache = existence_cache
+        self.multipart_threshold = multipart_threshold or self.MULTIPART_THRESHOLD
+        self.multipart_part_size = multipart_part_size or self.MULTIPART_PART_SIZE
+        self.multipart_max_concurrency = multipart_max_concurrency or self.MULTIPART_MAX_CONCURRENCY
 
     @property
     def bucket_name(self):
@@ -32,7 +209,7 @@ class S3(object):
 
     def save(self, path, file_, acl='public-read', timestamp=None, download_filename=None,
              disposition_type='attachment'):
-        """Save a file in an S3 bucket
+        """Save a file in an S3 bucket, using a (parallel) multipart upload if it's at least multipart_threshold bytes
 
         canned ACL list: https://docs.aws.amazon.com/AmazonS3/latest/dev/acl-overview.html#canned-acl
 
@@ -50,7 +227,12 @@ class S3(object):
         filesize = get_file_size(file_)
 
         obj = self._bucket.Object(path)
-        extra_kwargs = {}
+        extra_kwargs = {
+            "ACL": acl,
+            "ContentType": self._get_mimetype(path),
+            # using a custom "timestamp" field allows us to manually override it if necessary
+            "Metadata": {"timestamp": timestamp.strftime(DATETIME_FORMAT)},
+        }
         if download_filename:
             extra_kwargs["ContentDisposition"] = u'{}; filename="{}"'.format(
                 disposition_type,
@@ -59,22 +241,32 @@ class S3(object):
                 str(download_filename).encode("ascii", errors="ignore").decode(),
             )
 
+        multipart = filesize >= self.multipart_threshold
+
         log_description = 'file upload [{filepath} of size {filesize} and acl {fileacl}]'
         with log_external_request('S3', log_description) as log_context:
             log_context.update({
                 "filepath": path,
                 "filesize": filesize,
                 "fileacl": acl,
+                "multipart": multipart,
             })
 
-            obj.put(
-                ACL=acl,
-                Body=file_,
-                ContentType=self._get_mimetype(path),
-                # using a custom "timestamp" field allows us to manually override it if necessary
-                Metadata={"timestamp": timestamp.strftime(DATETIME_FORMAT)},
-                **extra_kwargs
-            )
+            if multipart:
+                # boto's managed transfer uploads the parts in parallel and aborts the multipart upload if any of them
+                # fail, so we don't leave orphaned parts lying around (and being charged for) in the bucket
+                obj.upload_fileobj(
+                    # like get_file_size, we want to deal with TextIO objects on a byte-level
+                    getattr(file_, "buffer", file_),
+                    ExtraArgs=extra_kwargs,
+                    Config=TransferConfig(
+                        multipart_threshold=self.multipart_threshold,
+                        multipart_chunksize=self.multipart_part_size,
+                        max_concurrency=self.multipart_max_concurrency,
+                    ),
+                )
+            else:
+                obj.put(Body=file_, **extra_kwargs)
 
         return self._format_key(obj)
 
@@ -127,16 +319,71 @@ class S3(object):
         :return: signed URL or ``None`` if object was not found
 
         """
-        path = self._normalize_path(path)
-        if self.path_exists(path):
-            return self._resource.meta.client.generate_presigned_url(
+        return self.get_signed_urls((path,), expires_in=expires_in)[path]
+
+    def get_signed_urls(self, paths, expires_in=30, check_exists=True):
+        """Create signed S3 document URLs for many paths at once, checking they exist concurrently
+
+        :param paths: S3 object paths within the bucket
+        :param expires_in: how long the generated URLs are valid
+                           for, in seconds
+        :param check_exists: set this to False to skip checking the objects exist, e.g. for paths just returned by
+                             list(), so no requests need to be made at all
+
+        :return: dict mapping each of ``paths`` to its signed URL, or ``None`` if its object was not found
+
+        """
+        normalized_paths = {path: self._normalize_path(path) for path in paths}
+        if check_exists:
+            existing_keys = self._keys_exist(set(normalized_paths.values()))
+        else:
+            existing_keys = set(normalized_paths.values())
+
+        # presigning happens locally so is cheap enough to do serially
+        client = self._resource.meta.client
+        return {
+            path: client.generate_presigned_url(
                 "get_object",
                 Params={
                     "Bucket": self._bucket.name,
-                    "Key": path,
+                    "Key": key,
                 },
                 ExpiresIn=expires_in,
-            )
+            ) if key in existing_keys else None
+            for path, key in normalized_paths.items()
+        }
+
+    def _keys_exist(self, keys):
+        """Returns the subset of ``keys`` which exist, consulting and updating any existence cache"""
+        existing_keys = set()
+        unknown_keys = []
+        for key in keys:
+            if self._existence_cache is not None and self._existence_cache.get((self.bucket_name, key)):
+                existing_keys.add(key)
+            else:
+                unknown_keys.append(key)
+
+        if len(unknown_keys) > 1:
+            max_workers = min(len(unknown_keys), self.SIGNED_URLS_MAX_WORKERS)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                key_exists = list(executor.map(self._head_exists, unknown_keys))
+        else:
+            key_exists = [self._head_exists(key) for key in unknown_keys]
+
+        for key, exists in zip(unknown_keys, key_exists):
+            if exists:
+                existing_keys.add(key)
+                if self._existence_cache is not None:
+                    self._existence_cache.set((self.bucket_name, key), True)
+        return existing_keys
+
+    def _head_exists(self, key):
+        # as in _format_object_summaries, HEADs go through the (thread-safe) client rather than the resource
+        try:
+            self._resource.meta.client.head_object(Bucket=self.bucket_name, Key=key)
+        except S3ResponseError:
+            return False
+        return True
 
     def _get_key(self, path):
         path = self._normalize_path(path)
@@ -155,6 +402,8 @@ class S3(object):
     def delete_key(self, path):
         path = self._normalize_path(path)
         self._bucket.Object(path).delete()
+        if self._existence_cache is not None:
+            self._existence_cache.discard((self.bucket_name, path))
 
     def list(self, prefix='', delimiter='', load_timestamps=False):
         """
@@ -167,19 +416,101 @@ class S3(object):
                                 if you need to show the timestamp set this to True.
         :return: list
         """
-        prefix = self._normalize_path(prefix)
+        return sorted(
+            self.iter_list(prefix=prefix, delimiter=delimiter, load_timestamps=load_timestamps),
+            key=lambda obj_s: (obj_s.get("last_modified") or "", obj_s["path"]),
+        )
 
-        filtered_objects = self._bucket.objects.filter(Prefix=prefix, Delimiter=delimiter)
+    def iter_list(self, prefix='', delimiter='', load_timestamps=False, limit=None, start_after=None):
+        """
+        generate file keys from an s3 bucket in key order, a page at a time as they are fetched, rather than loading the
+        whole listing into memory
 
-        with log_external_request('S3', f'list objects [prefix={prefix}, delimiter={delimiter}]'):
-            # Consume the `filtered_objects` generator to memory and prepare for sorting
-            objects_for_sorting = [
-                self._format_key(obj_s, with_timestamp=load_timestamps)
-                for obj_s in filtered_objects
-                if not (obj_s.size == 0 and obj_s.key[-1] == '/')
-            ]
+        :param prefix:          filter by files whose names begin with the prefix
+        :param delimiter:       filter out files whose names contain the delimiter
+        :param load_timestamps: by default custom timestamps are not loaded as they require an extra API call.
+                                if you need to show the timestamp set this to True.
+        :param limit:           maximum number of keys to generate
+        :param start_after:     only generate keys which come after this one, e.g. the last key of a previous call
+        :return: generator of dicts
+        """
+        prefix = self._normalize_path(prefix)
 
-        return sorted(objects_for_sorting, key=lambda obj_s: (obj_s.get("last_modified") or "", obj_s["path"]))
+        filter_kwargs = {"Prefix": prefix, "Delimiter": delimiter}
+        if start_after:
+            # v1 ListObjects' Marker has the same meaning as v2's StartAfter
+            filter_kwargs["Marker"] = self._normalize_path(start_after)
+        filtered_objects = self._bucket.objects.filter(**filter_kwargs)
+        if limit is not None:
+            # no point fetching more than a page's worth more than we need
+            filtered_objects = filtered_objects.page_size(min(limit, 1000))
+        pages = filtered_objects.pages()
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            # the timed block covers any HEAD requests made for the page's timestamps, but (being a generator) not the
+            # time the caller spends between pages
+            with log_external_request('S3', f'list objects page [prefix={prefix}, delimiter={delimiter}]'):
+                page = next(pages, None)
+                if page is None:
+                    return
+
+                object_summaries = [obj_s for obj_s in page if not (obj_s.size == 0 and obj_s.key[-1] == '/')]
+                if remaining is not None:
+                    object_summaries = object_summaries[:remaining]
+                    remaining -= len(object_summaries)
+
+                keydicts = self._format_object_summaries(object_summaries, load_timestamps=load_timestamps)
+
+            yield from keydicts
+
+    def _format_object_summaries(self, object_summaries, load_timestamps):
+        """
+        Format a sequence of ObjectSummary objects with `_format_key`, preserving order. Custom timestamps, if wanted,
+        are fetched with concurrent HEAD requests (skipping any objects found in the metadata cache).
+        """
+        keydicts = [self._format_key(obj_s, with_timestamp=False) for obj_s in object_summaries]
+        if not load_timestamps:
+            return keydicts
+
+        cache_keys = [(self.bucket_name, obj_s.key, obj_s.e_tag) for obj_s in object_summaries]
+        timestamps = [
+            self._metadata_cache.get(cache_key) if self._metadata_cache is not None else None
+            for cache_key in cache_keys
+        ]
+        missing_indexes = [i for i, timestamp in enumerate(timestamps) if timestamp is None]
+
+        if len(missing_indexes) > 1:
+            # boto3 resources aren't thread-safe but clients are, so the HEADs are made through the client
+            max_workers = min(len(missing_indexes), self.LIST_TIMESTAMPS_MAX_WORKERS)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                fetched_timestamps = list(executor.map(
+                    self._head_timestamp,
+                    (object_summaries[i].key for i in missing_indexes),
+                ))
+        else:
+            fetched_timestamps = [self._head_timestamp(object_summaries[i].key) for i in missing_indexes]
+
+        for i, timestamp in zip(missing_indexes, fetched_timestamps):
+            timestamps[i] = timestamp
+            if self._metadata_cache is not None:
+                self._metadata_cache.set(cache_keys[i], timestamp)
+
+        for keydict, timestamp in zip(keydicts, timestamps):
+            keydict["last_modified"] = timestamp
+        return keydicts
+
+    def _head_timestamp(self, key):
+        response = self._resource.meta.client.head_object(Bucket=self.bucket_name, Key=key)
+        return self._format_timestamp(response.get("Metadata") or {}, response["LastModified"])
+
+    @staticmethod
+    def _format_timestamp(metadata, last_modified):
+        # First look for custom "timestamp" metadata field that is explicitly set by our S3 uploader
+        # fall back to AWS's "last_modified" if this doesn't exist
+        return (
+            (metadata.get("timestamp") and parse_time(metadata["timestamp"])) or last_modified
+        ).strftime(DATETIME_FORMAT)
 
     def _format_key(self, obj, with_timestamp=True):
         """
@@ -205,11 +536,7 @@ class S3(object):
             'size': obj.size if hasattr(obj, "size") else obj.content_length,
         }
         if with_timestamp:
-            # First look for custom "timestamp" metadata field that is explicitly set by our S3 uploader
-            # fall back to AWS's "last_modified" if this doesn't exist
-            keydict["last_modified"] = (
-                (obj.metadata.get("timestamp") and parse_time(obj.metadata["timestamp"])) or obj.last_modified
-            ).strftime(DATETIME_FORMAT)
+            keydict["last_modified"] = self._format_timestamp(obj.metadata, obj.last_modified)
 
         return keydict
 
@@ -4,6 +4,7 @@ import sys
 from flask import jsonify, current_app
 
 
+from dmutils.circuit_breaker import get_circuit_breaker_statuses
 from dmutils.timing import logged_duration
 
 
@@ -99,6 +100,12 @@ def get_app_status(
     if additional_checks:
         _perform_additional_checks(additional_checks, response_data, error_messages)
 
+    circuit_breaker_statuses = get_circuit_breaker_statuses()
+    if circuit_breaker_statuses:
+        # an open circuit breaker is the app protecting itself from a degraded dependency, so it isn't considered an
+        # error here
+        response_data['circuit_breakers'] = circuit_breaker_statuses
+
     if not ignore_dependencies:
         response_data['version'] = current_app.config['VERSION']
 
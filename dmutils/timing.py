@@ -1,16 +1,76 @@
+from bisect import bisect_left
 from contextlib import contextmanager
-import inspect
+from contextvars import ContextVar
+from functools import lru_cache, wraps
 import logging
 import sys
+from threading import current_thread, local, Lock
 import time
+import weakref
 
 from flask import request
 from flask.ctx import has_request_context
 
+from dmutils.circuit_breaker import get_circuit_breaker
+from dmutils.fork_safety import ResetOnFork
+
 
 SLOW_EXTERNAL_CALL_THRESHOLD = 0.25
 SLOW_DEFAULT_CALL_THRESHOLD = 0.5
 
+# the clocks logged_duration is able to measure `duration_process` with. "process" is the cpu time of the whole
+# process, *including other threads*, "thread" is the cpu time of the current thread only but isn't available on all
+# platforms (or before python 3.7).
+CLOCK_PROCESS = "process"
+CLOCK_THREAD = "thread"
+_clock_functions = {
+    CLOCK_PROCESS: time.process_time,
+}
+if hasattr(time, "thread_time"):
+    _clock_functions[CLOCK_THREAD] = time.thread_time
+
+# the clock logged_duration uses when none is specified
+DEFAULT_CLOCK = CLOCK_PROCESS
+
+
+class _RequestContextSnapshot:
+    __slots__ = ("is_sampled",)
+
+    def __init__(self, is_sampled):
+        self.is_sampled = is_sampled
+
+
+# the parts of the flask request logged_duration's conditions depend on, captured by `capture_request_context` so they
+# remain available to e.g. asyncio tasks which can't reach the (thread-local) flask request
+_request_context_snapshot = ContextVar("dmutils_request_context_snapshot", default=None)
+
+
+def capture_request_context():
+    """
+    Captures the parts of the current flask request which the conditions of ``logged_duration`` and
+    ``async_logged_duration`` depend on into the current context, from where it will be inherited by any asyncio tasks
+    created (on python 3.7+) or ``contextvars.copy_context()`` calls made from it. ``logging.init_app`` arranges for
+    this to be called at the start of each request and ``clear_captured_request_context`` at the end.
+    """
+    _request_context_snapshot.set(
+        _RequestContextSnapshot(bool(getattr(request, "is_sampled", False))) if has_request_context() else None
+    )
+
+
+def clear_captured_request_context():
+    _request_context_snapshot.set(None)
+
+
+def _in_request_context():
+    return has_request_context() or _request_context_snapshot.get() is not None
+
+
+def _current_request_is_sampled():
+    if has_request_context():
+        return getattr(request, "is_sampled", False)
+    snapshot = _request_context_snapshot.get()
+    return snapshot is not None and snapshot.is_sampled
+
 
 def _logged_duration_default_message(log_context):
     return "Block {} in {{duration_real}}s of real-time".format(
@@ -19,8 +79,8 @@ def _logged_duration_default_message(log_context):
 
 
 def _logged_duration_default_condition(log_context):
-    return has_request_context() and (
-        getattr(request, "is_sampled", False) or log_context.get("duration_real", 0) > SLOW_DEFAULT_CALL_THRESHOLD
+    return _in_request_context() and (
+        _current_request_is_sampled() or log_context.get("duration_real", 0) > SLOW_DEFAULT_CALL_THRESHOLD
     )
 
 
@@ -32,6 +92,268 @@ def _logged_duration_default_log_func(logger, message, log_level, log_context):
 _logged_duration_default_logger = logging.getLogger(__name__)
 
 
+DEFAULT_DURATION_HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0)
+
+
+class DurationHistogramRegistry:
+    """
+        A registry of fixed-bucket histograms of durations, keyed by ``(logger name, label)``. Each thread records
+        observations into its own shard of counts so no locking is needed when observing - only (briefly) the first
+        time a thread observes anything. The shards of threads which have finished are merged together when collecting,
+        so they don't accumulate (e.g. under a thread-per-request server). A forked child process starts with no
+        observations.
+    """
+    def __init__(self, buckets=DEFAULT_DURATION_HISTOGRAM_BUCKETS):
+        # upper bounds of the buckets, the final bucket catching everything larger than the largest of these
+        self.buckets = tuple(sorted(buckets))
+        self._reset()
+        self._reset_on_fork = ResetOnFork(self._reset)
+
+    def _reset(self):
+        self._local = local()
+        # (weak reference to the owning thread, shard) for each live thread which has observed anything
+        self._shards = []
+        # the merged counts of the shards of threads which have finished
+        self._finished_counts = {}
+        self._shards_lock = Lock()
+
+    def _get_shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            self._reset_on_fork.check()
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append((weakref.ref(current_thread()), shard))
+        return shard
+
+    @staticmethod
+    def _merge(merged, shard):
+        # taking a copy of items() first as the owning thread may be adding to the shard
+        for key, counts in tuple(shard.items()):
+            merged_counts = merged.setdefault(key, [0] * len(counts))
+            for i, value in enumerate(counts):
+                merged_counts[i] += value
+
+    def observe(self, key, duration):
+        shard = self._get_shard()
+        counts = shard.get(key)
+        if counts is None:
+            # a count for each bucket (including the final "+Inf" bucket) followed by the sum of all observations
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect_left(self.buckets, duration)] += 1
+        counts[-1] += duration
+
+    def collect(self):
+        """
+        Returns a dict of ``(logger name, label)`` keys mapped to a tuple of a list of *cumulative* bucket counts (the
+        final one being the total count) and the sum of all observations, merged across all threads.
+        """
+        self._reset_on_fork.check()
+        with self._shards_lock:
+            live_shards = []
+            for thread_ref, shard in self._shards:
+                thread = thread_ref()
+                if thread is None or not thread.is_alive():
+                    # nothing will be adding to this shard any more
+                    self._merge(self._finished_counts, shard)
+                else:
+                    live_shards.append((thread_ref, shard))
+            self._shards = live_shards
+            merged = {key: list(counts) for key, counts in self._finished_counts.items()}
+
+        for _, shard in live_shards:
+            self._merge(merged, shard)
+
+        result = {}
+        for key, counts in merged.items():
+            cumulative_counts = []
+            running_total = 0
+            for count in counts[:-1]:
+                running_total += count
+                cumulative_counts.append(running_total)
+            result[key] = (cumulative_counts, counts[-1])
+        return result
+
+
+_duration_histogram_registry = None
+
+
+# the _SpanTree being collected for the current request (see `start_span_tree`), None when not collecting spans
+_span_tree = ContextVar("dmutils_span_tree", default=None)
+# the span of the innermost logged_duration block currently executing, which any block started inside it is a child of
+_current_span = ContextVar("dmutils_current_span", default=None)
+# asyncio only gives each task its own copy of the current context from python 3.7. before that, with the contextvars
+# backport, concurrent tasks share a single context, so they would see each other's current spans. we don't collect
+# spans for async_logged_duration blocks there at all rather than build a tree of them with the wrong shape
+_async_spans_supported = sys.version_info >= (3, 7)
+
+
+class _SpanTree:
+    __slots__ = ("spans", "max_spans", "dropped_count",)
+
+    def __init__(self, max_spans):
+        self.spans = []
+        self.max_spans = max_spans
+        self.dropped_count = 0
+
+
+class _Span:
+    __slots__ = ("span_id", "parent", "name", "duration_real", "duration_children",)
+
+    def __init__(self, span_id, parent, name):
+        self.span_id = span_id
+        self.parent = parent
+        self.name = name
+        self.duration_real = None
+        self.duration_children = 0.
+
+    def as_dict(self):
+        return {
+            "id": self.span_id,
+            "parent_id": self.parent and self.parent.span_id,
+            "name": self.name,
+            "duration_real": self.duration_real,
+            # time spent in this block which wasn't spent in any of its children
+            "duration_self": None if self.duration_real is None else self.duration_real - self.duration_children,
+        }
+
+
+def start_span_tree(max_spans=None):
+    """
+    Start collecting the spans of all `logged_duration` blocks executed from now on in the current context (i.e. the
+    current request) into a tree, to be retrieved with `pop_span_tree`. Any previously collected spans are discarded.
+    Once `max_spans` spans have been collected, the spans of any further blocks are dropped (only counted).
+    """
+    _span_tree.set(_SpanTree(max_spans))
+    _current_span.set(None)
+
+
+def pop_span_tree(with_dropped_count=False):
+    """
+    Returns the spans of the `logged_duration` blocks collected since `start_span_tree` was called, in the order they
+    were started, as a list of dicts with the keys ``id``, ``parent_id``, ``name``, ``duration_real`` and
+    ``duration_self``. Returns None if spans weren't being collected. Stops further collection.
+
+    With `with_dropped_count`, returns a tuple of the spans and the number of spans dropped for exceeding
+    `max_spans` (None and 0 if spans weren't being collected).
+    """
+    span_tree = _span_tree.get()
+    _span_tree.set(None)
+    _current_span.set(None)
+    spans = None if span_tree is None else [span.as_dict() for span in span_tree.spans]
+    if with_dropped_count:
+        return spans, 0 if span_tree is None else span_tree.dropped_count
+    return spans
+
+
+def _start_span(logger, label):
+    span_tree = _span_tree.get()
+    if span_tree is None:
+        return None, None
+
+    spans = span_tree.spans
+    if span_tree.max_spans is not None and len(spans) >= span_tree.max_spans:
+        # blocks inside this one will be dropped too, so will never be parented to a span which doesn't exist
+        span_tree.dropped_count += 1
+        return None, None
+
+    span = _Span(len(spans) + 1, _current_span.get(), f"{logger.name}:{label}" if label else logger.name)
+    spans.append(span)
+    return span, _current_span.set(span)
+
+
+def _end_span(span, token, duration_real):
+    span.duration_real = duration_real
+    if span.parent is not None:
+        span.parent.duration_children += duration_real
+    _current_span.reset(token)
+
+
+def enable_duration_histograms(buckets=DEFAULT_DURATION_HISTOGRAM_BUCKETS):
+    """
+    Start recording the durations of all `logged_duration` blocks (whether they log or not) in a process-wide
+    DurationHistogramRegistry, which is returned. Has no effect if histograms are already enabled, returning the
+    existing registry.
+    """
+    global _duration_histogram_registry
+    if _duration_histogram_registry is None:
+        _duration_histogram_registry = DurationHistogramRegistry(buckets)
+    return _duration_histogram_registry
+
+
+def get_duration_histogram_registry():
+    """Returns the process-wide DurationHistogramRegistry, or None if duration histograms haven't been enabled"""
+    return _duration_histogram_registry
+
+
+class _LoggedDurationTimer:
+    """
+        The implementation of a single ``logged_duration`` or ``async_logged_duration`` block, ``finish`` being called
+        on exiting the block (while any exception raised from it is still being handled).
+    """
+    __slots__ = (
+        "logger",
+        "message",
+        "log_level",
+        "condition",
+        "log_func",
+        "histogram_label",
+        "clock",
+        "clock_function_name",
+        "span",
+        "span_token",
+        "original_real_time",
+        "original_process_time",
+        "log_context",
+    )
+
+    def __init__(self, logger, message, log_level, condition, log_func, histogram_label, clock):
+        self.logger = logger
+        self.message = message
+        self.log_level = log_level
+        self.condition = condition
+        self.log_func = log_func
+        self.histogram_label = histogram_label
+
+        self.clock = clock or DEFAULT_CLOCK
+        if self.clock not in _clock_functions:
+            if self.clock not in (CLOCK_PROCESS, CLOCK_THREAD):
+                raise ValueError(f"Unknown clock {self.clock!r}")
+            # a clock this platform doesn't support
+            self.clock = CLOCK_PROCESS
+        # looked up through the time module on each call so it remains mockable
+        self.clock_function_name = _clock_functions[self.clock].__name__
+
+    def start(self, collect_span=True):
+        self.span, self.span_token = _start_span(self.logger, self.histogram_label) if collect_span else (None, None)
+
+        self.original_real_time = time.perf_counter()
+        # NOTE with CLOCK_PROCESS if multiple threads are running in this process this will include their cpu time too
+        self.original_process_time = getattr(time, self.clock_function_name)()
+
+        self.log_context = {}
+        return self.log_context
+
+    def finish(self):
+        duration_real = time.perf_counter() - self.original_real_time
+        duration_process = getattr(time, self.clock_function_name)() - self.original_process_time
+
+        log_context = self.log_context
+        log_context["duration_real"] = duration_real
+        log_context["duration_process"] = duration_process
+        log_context["duration_process_clock"] = self.clock
+
+        if self.span is not None:
+            _end_span(self.span, self.span_token, duration_real)
+
+        if _duration_histogram_registry is not None:
+            _duration_histogram_registry.observe((self.logger.name, self.histogram_label or ""), duration_real)
+
+        if self.condition in (True, None,) or self.condition(log_context):
+            self.log_func(self.logger, self.message, self.log_level, log_context)
+
+
 @contextmanager
 def logged_duration(
     logger=_logged_duration_default_logger,
@@ -39,6 +361,8 @@ def logged_duration(
     log_level=logging.DEBUG,
     condition=_logged_duration_default_condition,
     log_func=_logged_duration_default_log_func,
+    histogram_label=None,
+    clock=None,
 ):
     """
         returns a context manager which will monitor the amount of time spent "inside" its code block and emit a log
@@ -69,26 +393,20 @@ def logged_duration(
         :param log_func:  The actual logging function which will be called if `condition` passes. Arguments passed are:
                           ``logger``, ``message``, ``log_level`` (all verbatim as passed to ``logged_duration``) and
                           ``log_context``.
+        :param histogram_label: Label under which (along with the logger's name) to record this block's duration if
+                          duration histograms have been enabled using ``enable_duration_histograms``. Also used
+                          to name this block's span if a span tree is being collected (see ``start_span_tree``).
+        :param clock:     The clock to measure ``duration_process`` with, either ``CLOCK_PROCESS`` or ``CLOCK_THREAD``.
+                          Defaults to ``DEFAULT_CLOCK``. Where ``CLOCK_THREAD`` isn't supported we fall back to
+                          ``CLOCK_PROCESS``, but any other value raises a ``ValueError``. The clock actually used is
+                          included in ``log_context`` as ``duration_process_clock``.
     """
-    original_real_time = time.perf_counter()
-    # NOTE this is *process* time, not *thread* time. if multiple threads are running in this process it will include
-    # their cpu time too. getting *thread* time will be possible in python 3.7+ (but even then it doesn't work on older
-    # macos)
-    original_process_time = time.process_time()
-
-    log_context = {}
-
+    timer = _LoggedDurationTimer(logger, message, log_level, condition, log_func, histogram_label, clock)
+    log_context = timer.start()
     try:
         yield log_context
     finally:
-        duration_real = time.perf_counter() - original_real_time
-        duration_process = time.process_time() - original_process_time
-
-        log_context["duration_real"] = duration_real
-        log_context["duration_process"] = duration_process
-
-        if condition in (True, None,) or condition(log_context):
-            log_func(logger, message, log_level, log_context)
+        timer.finish()
 
 
 #
@@ -103,6 +421,71 @@ logged_duration.default_condition = _logged_duration_default_condition
 logged_duration.default_logger = _logged_duration_default_logger
 
 
+class _AsyncLoggedDuration:
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._timer = None
+
+    async def __aenter__(self):
+        if self._timer is not None:
+            raise RuntimeError("async_logged_duration blocks can't be re-entered - create a new one for each block")
+        self._timer = _LoggedDurationTimer(**self._kwargs)
+        return self._timer.start(collect_span=_async_spans_supported)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        timer, self._timer = self._timer, None
+        timer.finish()
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with _AsyncLoggedDuration(**self._kwargs):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+
+def async_logged_duration(
+    logger=_logged_duration_default_logger,
+    message=_logged_duration_default_message,
+    log_level=logging.DEBUG,
+    condition=_logged_duration_default_condition,
+    log_func=_logged_duration_default_log_func,
+    histogram_label=None,
+    clock=None,
+):
+    """
+        An equivalent of ``logged_duration`` for use as an ``async with`` block or as a decorator of a coroutine
+        function, accepting the same arguments. e.g.::
+
+            async with async_logged_duration(message="Fetched {key} in {duration_real}s") as log_context:
+                log_context["key"] = key
+                await fetch(key)
+
+        The default conditions (``request_is_sampled`` etc.) work on asyncio tasks as long as they were created in a
+        context which captured the current request (see ``capture_request_context``), even once the flask request
+        itself is no longer reachable, e.g. from a task running on an event loop in another thread.
+
+        On python 3.6 asyncio tasks don't get their own contexts - all of the tasks run by an event loop share the
+        context of the thread running it (so for the above, that thread has to be run in a copy of the capturing
+        context, e.g. using ``contextvars.copy_context().run``). Because of this, these blocks aren't included in span
+        trees (see ``start_span_tree``) on python 3.6.
+
+        Note ``duration_process`` will include cpu time spent by any other tasks run by the event loop while the block
+        was suspended.
+    """
+    return _AsyncLoggedDuration(
+        logger=logger,
+        message=message,
+        log_level=log_level,
+        condition=condition,
+        log_func=log_func,
+        histogram_label=histogram_label,
+        clock=clock,
+    )
+
+
 def exceeds_slow_external_call_threshold(log_context):
     """A public condition that will return True if the duration is above the threshold we have defined as acceptable for
     calls to external services (e.g. Notify, Mailchimp, S3, etc)."""
@@ -113,7 +496,7 @@ def request_is_sampled(log_context):
     """A public condition that returns True if the request has the X-B3-Sampled flag set in its headers. While this is
     the default condition for logged_duration, exposing it publically allows it to be easily combined with other
     conditions."""
-    return has_request_context() and getattr(request, "is_sampled", False)
+    return _in_request_context() and _current_request_is_sampled()
 
 
 def exception_in_stack():
@@ -131,39 +514,138 @@ def different_message_for_success_or_error(success_message, error_message):
 
 
 def request_context_and_any_of_slow_call_or_sampled_request_or_exception_in_stack(log_context):
-    return has_request_context() and (
+    return _in_request_context() and (
         exceeds_slow_external_call_threshold(log_context) or request_is_sampled(log_context) or exception_in_stack()
     )
 
 
+@lru_cache(maxsize=1024)
+def _external_request_message(service, description, success_message, error_message):
+    """
+    The `message` for a logged_duration_for_external_request block, cached as in practice there will be a small,
+    fixed number of combinations of arguments, one for each call site.
+    """
+    success_message = (
+        success_message
+        if success_message else
+        f'Call to {service} ({description}) executed in {{duration_real}}s'
+    )
+    error_message = (
+        error_message
+        if error_message else
+        f'Exception from call to {service} ({description}) after {{duration_real}}s'
+    )
+
+    return different_message_for_success_or_error(success_message=success_message, error_message=error_message)
+
+
+class _CircuitBrokenBlock:
+    """
+        Wraps a ``logged_duration`` or ``async_logged_duration`` block (as created by ``block_factory``), failing fast
+        if ``circuit_breaker`` is open and recording the block's outcome with it otherwise. Like the blocks it wraps,
+        can also be used as a (sync or async, respectively) function decorator.
+    """
+    def __init__(self, circuit_breaker, block_factory):
+        self.circuit_breaker = circuit_breaker
+        self.block_factory = block_factory
+        self.block = block_factory()
+        self.log_context = None
+
+    def _record_call(self, exc_value):
+        self.circuit_breaker.record_call(
+            failed=exc_value is not None and self.circuit_breaker.is_failure(exc_value),
+            slow=self.circuit_breaker.is_slow(self.log_context["duration_real"]),
+        )
+
+    def __enter__(self):
+        self.circuit_breaker.before_call()
+        self.log_context = self.block.__enter__()
+        return self.log_context
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.block.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._record_call(exc_value)
+
+    async def __aenter__(self):
+        self.circuit_breaker.before_call()
+        self.log_context = await self.block.__aenter__()
+        return self.log_context
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            return await self.block.__aexit__(exc_type, exc_value, traceback)
+        finally:
+            self._record_call(exc_value)
+
+    def __call__(self, func):
+        # each call of the decorated function needs a block of its own
+        if isinstance(self.block, _AsyncLoggedDuration):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with _CircuitBrokenBlock(self.circuit_breaker, self.block_factory):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with _CircuitBrokenBlock(self.circuit_breaker, self.block_factory):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+
+def _with_circuit_breaker(service, block_factory):
+    circuit_breaker = get_circuit_breaker(service)
+    return block_factory() if circuit_breaker is None else _CircuitBrokenBlock(circuit_breaker, block_factory)
+
+
+def _external_request_kwargs(service, description, success_message, error_message, logger):
+    return {
+        "message": _external_request_message(service, description, success_message, error_message),
+        "condition": request_context_and_any_of_slow_call_or_sampled_request_or_exception_in_stack,
+        # description could include variable details - the service is a safe, low-cardinality label
+        "histogram_label": service,
+        **({'logger': logger} if logger else {}),
+    }
+
+
 def logged_duration_for_external_request(service, description=None, success_message=None, error_message=None,
-                                         logger=None):
+                                         logger=None, use_circuit_breaker=True):
     """A default implementation of `logged_duration` to wrap around calls to external services (such as Notify,
     Mailchimp, S3, ...) to generate log messages on these events in a standardised manner.
 
     This implementation will not log durations outside of a Flask request context (e.g. when running scripts).
 
+    If a circuit breaker has been configured for ``service`` (see ``dmutils.circuit_breaker``), each call's outcome will
+    be recorded with it and a ``CircuitOpenError`` raised on entering the block while the breaker is open. Pass
+    ``use_circuit_breaker=False`` for blocks which only wrap other such blocks rather than making calls themselves.
+
     Use to wrap a call to a third-party service like so [note the final () call which accepts additional args]:
     >>> with logged_duration_for_external_request('Notify'):
     >>>     notify_client.send_email('user@email.com')
     """
     if not description:
-        # Returns the name of the calling function
-        description = inspect.stack()[1].function
+        # Returns the name of the calling function. Note inspect.stack() would do the same but is *very* expensive,
+        # building FrameInfo objects for the whole stack and reading source lines from disk.
+        description = sys._getframe(1).f_code.co_name
 
-    success_message = (
-        success_message
-        if success_message else
-        f'Call to {service} ({description}) executed in {{duration_real}}s'
-    )
-    error_message = (
-        error_message
-        if error_message else
-        f'Exception from call to {service} ({description}) after {{duration_real}}s'
-    )
+    kwargs = _external_request_kwargs(service, description, success_message, error_message, logger)
+    if not use_circuit_breaker:
+        return logged_duration(**kwargs)
+    return _with_circuit_breaker(service, lambda: logged_duration(**kwargs))
 
-    return logged_duration(
-        message=different_message_for_success_or_error(success_message=success_message, error_message=error_message),
-        condition=request_context_and_any_of_slow_call_or_sampled_request_or_exception_in_stack,
-        **{'logger': logger} if logger else {}
-    )
+
+def async_logged_duration_for_external_request(service, description=None, success_message=None, error_message=None,
+                                               logger=None, use_circuit_breaker=True):
+    """The `async_logged_duration` equivalent of `logged_duration_for_external_request`, e.g.
+    >>> async with async_logged_duration_for_external_request('S3'):
+    >>>     await fetch_from_s3(key)
+    """
+    if not description:
+        description = sys._getframe(1).f_code.co_name
+
+    kwargs = _external_request_kwargs(service, description, success_message, error_message, logger)
+    if not use_circuit_breaker:
+        return async_logged_duration(**kwargs)
+    return _with_circuit_breaker(service, lambda: async_logged_duration(**kwargs))
@@ -9,6 +9,7 @@ from json.decoder import JSONDecodeError
 from requests import RequestException
 from requests.exceptions import HTTPError, ConnectTimeout
 
+from dmutils.circuit_breaker import configure_circuit_breaker
 from dmutils.email.dm_mailchimp import DMMailChimpClient, get_response_from_exception
 from mailchimp3.mailchimpclient import MailChimpError
 
@@ -51,6 +52,15 @@ class TestGetResponseFromException:
         assert get_response_from_exception(exception) == {}
 
 
+@pytest.fixture
+def open_circuit_breaker():
+    with mock.patch.dict("dmutils.circuit_breaker._circuit_breakers", clear=True):
+        circuit_breaker = configure_circuit_breaker("Mailchimp", minimum_calls=1)
+        circuit_breaker.before_call()
+        circuit_breaker.record_call(failed=True, slow=False)
+        yield circuit_breaker
+
+
 class TestMailchimp(PatchExternalServiceLogConditionMixin):
     def test_create_campaign(self):
         dm_mailchimp_client = DMMailChimpClient('username', DUMMY_MAILCHIMP_API_KEY, 'logger')
@@ -351,6 +361,41 @@ class TestMailchimp(PatchExternalServiceLogConditionMixin):
             assert log_catcher.records[1].error == "error sending"
             assert log_catcher.records[1].levelname == 'ERROR'
 
+    def test_open_circuit_breaker_handled_like_failed_call(self, open_circuit_breaker):
+        dm_mailchimp_client = DMMailChimpClient('username', DUMMY_MAILCHIMP_API_KEY, mock.MagicMock())
+        with mock.patch.object(dm_mailchimp_client._client.campaigns, 'create', autospec=True) as create:
+            with mock.patch.object(
+                dm_mailchimp_client._client.lists.members, 'create_or_update', autospec=True,
+            ) as create_or_update:
+                assert dm_mailchimp_client.create_campaign({"example": "data"}) is False
+                assert dm_mailchimp_client.subscribe_new_email_to_list('list_id', 'example@example.com') == {
+                    "status": "error",
+                    "error_type": "unexpected_error",
+                    "status_code": 500,
+                }
+                assert dm_mailchimp_client.subscribe_new_emails_to_list('list_id', ['example@example.com']) is True
+
+        assert create.called is False
+        assert create_or_update.called is False
+        assert dm_mailchimp_client.logger.error.call_count == 3
+
+    def test_subscribe_new_emails_to_list_circuit_breaker_counts_each_call(self):
+        dm_mailchimp_client = DMMailChimpClient('username', DUMMY_MAILCHIMP_API_KEY, mock.MagicMock())
+        with mock.patch.dict("dmutils.circuit_breaker._circuit_breakers", clear=True):
+            circuit_breaker = configure_circuit_breaker("Mailchimp")
+            with mock.patch.object(
+                dm_mailchimp_client._client.lists.members, 'create_or_update', autospec=True,
+            ) as create_or_update:
+                create_or_update.side_effect = MailChimpError({"title": "Member Exists", "status": 400})
+                dm_mailchimp_client.subscribe_new_emails_to_list('list_id', ['a@example.com', 'b@example.com'])
+
+            assert circuit_breaker.get_status() == {
+                "state": "closed",
+                "calls": 2,
+                "failure_rate": 0.,
+                "slow_call_rate": 0.,
+            }
+
     def test_subscribe_new_emails_to_list(self):
         dm_mailchimp_client = DMMailChimpClient('username', DUMMY_MAILCHIMP_API_KEY, mock.MagicMock())
         with mock.patch.object(dm_mailchimp_client, 'subscribe_new_email_to_list', autospec=True, return_value=True):
@@ -9,7 +9,9 @@ from itertools import product
 
 import pytest
 
+from dmutils.circuit_breaker import configure_circuit_breaker
 from dmutils.email.dm_notify import DMNotifyClient
+from dmutils.email.exceptions import EmailError
 from helpers import PatchExternalServiceLogConditionMixin, assert_external_service_log_entry
 
 
@@ -420,6 +422,22 @@ class TestDMNotifyClient(PatchExternalServiceLogConditionMixin):
                     dm_notify_client.send_email(self.email_address + 'foo', self.template_id, allow_resend=False)
                     dm_notify_client.send_email(self.email_address + 'foo', self.template_id, allow_resend=False)
 
+    def test_send_email_open_circuit_breaker(self, dm_notify_client):
+        with mock.patch.dict("dmutils.circuit_breaker._circuit_breakers", clear=True):
+            circuit_breaker = configure_circuit_breaker("Notify", minimum_calls=1)
+            circuit_breaker.before_call()
+            circuit_breaker.record_call(failed=True, slow=False)
+
+            with mock.patch(self.client_class_str + '.' + 'send_email_notification') as send_email_notification_mock:
+                with mock.patch.object(dm_notify_client.logger, 'error') as error:
+                    with pytest.raises(EmailError):
+                        dm_notify_client.send_email(self.email_address, self.template_id)
+
+        assert send_email_notification_mock.called is False
+        assert error.call_args_list == [
+            mock.call("Error sending email: {error}", extra=mock.ANY),
+        ]
+
     def test_constructor_can_retrieve_api_key_from_app_config(self, app):
         api_key = "notify-api-key-" + _test_api_key
         app.config["DM_NOTIFY_API_KEY"] = api_key
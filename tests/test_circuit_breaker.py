@@ -0,0 +1,282 @@
+import asyncio
+
+from botocore.exceptions import ClientError
+import mock
+from mailchimp3.mailchimpclient import MailChimpError
+from notifications_python_client.errors import HTTPError as NotifyHTTPError
+import pytest
+from requests import Response
+from requests.exceptions import ConnectTimeout, HTTPError
+
+from dmtestutils.comparisons import AnySupersetOf
+
+from dmutils.circuit_breaker import (
+    CircuitBreaker,
+    CircuitOpenError,
+    configure_circuit_breaker,
+    get_circuit_breaker,
+    get_circuit_breaker_statuses,
+    init_app,
+    is_not_client_error,
+)
+from dmutils.timing import async_logged_duration_for_external_request, logged_duration_for_external_request
+
+
+@pytest.fixture(autouse=True)
+def circuit_breakers():
+    with mock.patch.dict("dmutils.circuit_breaker._circuit_breakers", clear=True) as circuit_breakers:
+        yield circuit_breakers
+
+
+@pytest.fixture
+def monotonic():
+    with mock.patch("dmutils.circuit_breaker.time.monotonic", return_value=1000.) as monotonic:
+        yield monotonic
+
+
+def _call(circuit_breaker, failed=False, slow=False):
+    circuit_breaker.before_call()
+    circuit_breaker.record_call(failed=failed, slow=slow)
+
+
+class TestCircuitBreaker:
+    def test_stays_closed_below_minimum_calls(self, monotonic):
+        circuit_breaker = CircuitBreaker("Foo", minimum_calls=5)
+        for _ in range(4):
+            _call(circuit_breaker, failed=True)
+
+        assert circuit_breaker.get_status() == {
+            "state": "closed",
+            "calls": 4,
+            "failure_rate": 1.,
+            "slow_call_rate": 0.,
+        }
+        circuit_breaker.before_call()
+
+    @pytest.mark.parametrize("failed,slow", ((True, False), (False, True)))
+    def test_opens_on_threshold_and_fails_fast(self, monotonic, failed, slow):
+        circuit_breaker = CircuitBreaker(
+            "Foo",
+            minimum_calls=4,
+            failure_rate_threshold=0.5,
+            slow_call_rate_threshold=0.5,
+            open_duration=30,
+        )
+        _call(circuit_breaker)
+        _call(circuit_breaker)
+        _call(circuit_breaker, failed=failed, slow=slow)
+        assert circuit_breaker.get_status()["state"] == "closed"
+        _call(circuit_breaker, failed=failed, slow=slow)
+        assert circuit_breaker.get_status()["state"] == "open"
+
+        monotonic.return_value = 1020.
+        with pytest.raises(CircuitOpenError) as exc_info:
+            circuit_breaker.before_call()
+        assert exc_info.value.service == "Foo"
+        assert exc_info.value.retry_after == 10.
+
+    def test_rolling_window(self, monotonic):
+        circuit_breaker = CircuitBreaker("Foo", window_size=4, minimum_calls=4, failure_rate_threshold=0.75)
+        for failed in (True, True, False, False, True, False, True):
+            _call(circuit_breaker, failed=failed)
+
+        # only the last 4 calls count
+        assert circuit_breaker.get_status() == {
+            "state": "closed",
+            "calls": 4,
+            "failure_rate": 0.5,
+            "slow_call_rate": 0.,
+        }
+
+    @pytest.mark.parametrize("probe_failed,probe_slow,expected_state", (
+        (False, False, "closed"),
+        (True, False, "open"),
+        (False, True, "open"),
+    ))
+    def test_half_open_probe(self, monotonic, probe_failed, probe_slow, expected_state):
+        circuit_breaker = CircuitBreaker("Foo", minimum_calls=1, open_duration=30, half_open_max_calls=1)
+        _call(circuit_breaker, failed=True)
+        assert circuit_breaker.get_status()["state"] == "open"
+
+        monotonic.return_value = 1031.
+        circuit_breaker.before_call()
+        assert circuit_breaker.get_status()["state"] == "half-open"
+        # only one probe allowed at once
+        with pytest.raises(CircuitOpenError):
+            circuit_breaker.before_call()
+
+        circuit_breaker.record_call(failed=probe_failed, slow=probe_slow)
+        assert circuit_breaker.get_status()["state"] == expected_state
+        if expected_state == "closed":
+            assert circuit_breaker.get_status()["calls"] == 0
+            circuit_breaker.before_call()
+        else:
+            with pytest.raises(CircuitOpenError):
+                circuit_breaker.before_call()
+
+
+def _http_error(status_code):
+    response = Response()
+    response.status_code = status_code
+    return HTTPError(response=response)
+
+
+@pytest.mark.parametrize("exception,expected_result", (
+    (ValueError("Boo"), True),
+    (ConnectTimeout(), True),
+    (_http_error(400), False),
+    (_http_error(404), False),
+    (_http_error(408), True),
+    (_http_error(429), True),
+    (_http_error(500), True),
+    (MailChimpError({"title": "Member Exists", "status": 400}), False),
+    (MailChimpError({"status": 503}), True),
+    (NotifyHTTPError(_http_error(400).response), False),
+    (NotifyHTTPError(_http_error(503).response), True),
+    (ClientError({"Error": {}, "ResponseMetadata": {"HTTPStatusCode": 403}}, "GetObject"), False),
+    (ClientError({"Error": {}, "ResponseMetadata": {"HTTPStatusCode": 500}}, "GetObject"), True),
+))
+def test_is_not_client_error(exception, expected_result):
+    assert is_not_client_error(exception) is expected_result
+
+
+def test_init_app(app):
+    app.config["DM_CIRCUIT_BREAKERS"] = {"Mailchimp": {"open_duration": 60, "slow_call_duration": 15}}
+    init_app(app)
+
+    assert get_circuit_breaker("Mailchimp").open_duration == 60
+    assert get_circuit_breaker("Mailchimp").slow_call_duration == 15
+    assert get_circuit_breaker("Notify") is None
+    assert get_circuit_breaker_statuses() == {
+        "Mailchimp": {"state": "closed", "calls": 0, "failure_rate": 0., "slow_call_rate": 0.},
+    }
+
+
+class TestLoggedDurationForExternalRequest:
+    def test_records_calls(self, monotonic):
+        circuit_breaker = configure_circuit_breaker("Foo", minimum_calls=2, failure_rate_threshold=0.6)
+
+        with logged_duration_for_external_request("Foo"):
+            pass
+        with pytest.raises(ValueError):
+            with logged_duration_for_external_request("Foo"):
+                raise ValueError
+        assert circuit_breaker.get_status() == AnySupersetOf({"calls": 2, "failure_rate": 0.5})
+
+        with pytest.raises(ValueError):
+            with logged_duration_for_external_request("Foo"):
+                raise ValueError
+        assert circuit_breaker.get_status()["state"] == "open"
+
+        block_entered = False
+        with pytest.raises(CircuitOpenError):
+            with logged_duration_for_external_request("Foo"):
+                block_entered = True
+        assert block_entered is False
+
+        # other services unaffected
+        with logged_duration_for_external_request("Bar"):
+            pass
+
+    def test_client_errors_not_failures(self, monotonic):
+        circuit_breaker = configure_circuit_breaker("Foo", minimum_calls=1)
+
+        with pytest.raises(HTTPError):
+            with logged_duration_for_external_request("Foo"):
+                raise _http_error(400)
+
+        assert circuit_breaker.get_status() == AnySupersetOf({"state": "closed", "calls": 1, "failure_rate": 0.})
+
+    def test_custom_is_failure(self, monotonic):
+        circuit_breaker = configure_circuit_breaker(
+            "Foo",
+            minimum_calls=1,
+            is_failure=lambda exception: not isinstance(exception, KeyError),
+        )
+
+        with pytest.raises(KeyError):
+            with logged_duration_for_external_request("Foo"):
+                raise KeyError
+        assert circuit_breaker.get_status()["state"] == "closed"
+
+        with pytest.raises(HTTPError):
+            with logged_duration_for_external_request("Foo"):
+                raise _http_error(400)
+        assert circuit_breaker.get_status()["state"] == "open"
+
+    def test_without_circuit_breaker(self, monotonic):
+        circuit_breaker = configure_circuit_breaker("Foo", minimum_calls=1)
+        _call(circuit_breaker, failed=True)
+
+        block_entered = False
+        with logged_duration_for_external_request("Foo", use_circuit_breaker=False):
+            block_entered = True
+
+        assert block_entered is True
+        assert circuit_breaker.get_status()["calls"] == 1
+
+    @pytest.mark.parametrize("duration_real,expected_state", (
+        (0.5, "closed"),
+        (2., "open"),
+    ))
+    def test_slow_calls(self, monotonic, duration_real, expected_state):
+        circuit_breaker = configure_circuit_breaker(
+            "Foo",
+            minimum_calls=1,
+            slow_call_rate_threshold=1.,
+            slow_call_duration=2.,
+        )
+
+        with mock.patch("dmutils.timing.time.perf_counter", side_effect=(100., 100. + duration_real)):
+            with logged_duration_for_external_request("Foo"):
+                pass
+
+        assert circuit_breaker.get_status()["state"] == expected_state
+
+    def test_decorator(self, monotonic):
+        circuit_breaker = configure_circuit_breaker("Foo", minimum_calls=2, failure_rate_threshold=0.6)
+
+        @logged_duration_for_external_request("Foo")
+        def call(fail):
+            if fail:
+                raise ValueError
+            return "Bar"
+
+        assert call(False) == "Bar"
+        with pytest.raises(ValueError):
+            call(True)
+        assert circuit_breaker.get_status() == AnySupersetOf({"calls": 2, "failure_rate": 0.5})
+
+        with pytest.raises(ValueError):
+            call(True)
+        assert circuit_breaker.get_status()["state"] == "open"
+        with pytest.raises(CircuitOpenError):
+            call(False)
+
+    def test_async_decorator(self, monotonic):
+        circuit_breaker = configure_circuit_breaker("Foo", minimum_calls=2, failure_rate_threshold=0.6)
+
+        @async_logged_duration_for_external_request("Foo")
+        async def call(fail):
+            if fail:
+                raise ValueError
+            return "Bar"
+
+        assert asyncio.new_event_loop().run_until_complete(call(False)) == "Bar"
+        with pytest.raises(ValueError):
+            asyncio.new_event_loop().run_until_complete(call(True))
+        assert circuit_breaker.get_status() == AnySupersetOf({"calls": 2, "failure_rate": 0.5})
+
+    def test_async(self, monotonic):
+        circuit_breaker = configure_circuit_breaker("Foo", minimum_calls=1)
+
+        async def fail():
+            async with async_logged_duration_for_external_request("Foo"):
+                raise ValueError
+
+        with pytest.raises(ValueError):
+            asyncio.new_event_loop().run_until_complete(fail())
+        assert circuit_breaker.get_status()["state"] == "open"
+
+        with pytest.raises(CircuitOpenError):
+            asyncio.new_event_loop().run_until_complete(fail())
@@ -0,0 +1,90 @@
+import gc
+import os
+from threading import Event
+
+import mock
+import pytest
+
+import dmutils.fork_safety
+from dmutils.fork_safety import ResetOnFork, ensure_thread, get_pid
+
+
+class _Resettable(object):
+    def __init__(self):
+        self.reset_count = 0
+        self.reset_on_fork = ResetOnFork(self.reset)
+
+    def reset(self):
+        self.reset_count += 1
+
+
+def test_refresh_pid():
+    with mock.patch("dmutils.fork_safety.os.getpid", return_value=31415):
+        dmutils.fork_safety._refresh_pid()
+        assert get_pid() == 31415
+
+    dmutils.fork_safety._refresh_pid()
+    assert get_pid() == os.getpid()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_reset_on_fork():
+    resettable = _Resettable()
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child
+        try:
+            resettable.reset_on_fork.check()
+            os.write(write_fd, str(resettable.reset_count).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as pipe:
+        assert pipe.read() == "1"
+
+    resettable.reset_on_fork.check()
+    assert resettable.reset_count == 0
+
+
+def test_reset_on_fork_checking_pid():
+    resettable = _Resettable()
+
+    with mock.patch("dmutils.fork_safety._check_pid_for_fork", True):
+        resettable.reset_on_fork.check()
+        assert resettable.reset_count == 0
+
+        with mock.patch("dmutils.fork_safety.os.getpid", return_value=31415):
+            resettable.reset_on_fork.check()
+            resettable.reset_on_fork.check()
+            assert resettable.reset_count == 1
+
+
+def test_reset_on_fork_doesnt_keep_object_alive():
+    resettable = _Resettable()
+    reset_on_fork = resettable.reset_on_fork
+    del resettable
+    gc.collect()
+
+    # nothing left to reset
+    reset_on_fork._after_fork()
+
+
+def test_ensure_thread():
+    stop_event = Event()
+    thread = ensure_thread(None, stop_event.wait, "Foo")
+    try:
+        assert thread.is_alive()
+        assert thread.daemon
+        assert thread.name == "Foo"
+        assert ensure_thread(thread, stop_event.wait, "Foo") is thread
+    finally:
+        stop_event.set()
+        thread.join()
+
+    other_thread = ensure_thread(thread, lambda: None, "Foo")
+    assert other_thread is not thread
+    other_thread.join()
@@ -1,19 +1,39 @@
 from io import StringIO
+import contextvars
+import datetime
 import json
+import sys
 import logging
+from logging import Logger
 import os.path
 import tempfile
 import time
 
 import mock
 
-from flask import request
+from flask import Flask, request
 import pytest
 
 from dmtestutils.comparisons import AnyStringMatching, AnySupersetOf, RestrictedAny
 
-from dmutils.logging import init_app, RequestExtraContextFilter, JSONFormatter, CustomLogFormatter
+import dmutils.logging
+from dmutils.logging import (
+    init_app,
+    AccessLogAggregator,
+    AppStackLocationFilter,
+    AsyncQueueHandler,
+    BufferedJSONFileHandler,
+    CustomLogFormatter,
+    fast_json_dumps,
+    JSONFormatter,
+    RateLimitingFilter,
+    RequestExtraContextFilter,
+    SamplingFilter,
+)
 from dmutils.logging import LOG_FORMAT, get_json_log_format
+from dmutils import timing
+from dmutils.request_id import init_app as request_id_init_app
+from dmutils.timing import logged_duration
 
 
 def test_request_extra_context_filter_not_in_app_context():
@@ -57,6 +77,33 @@ def test_request_extra_context_filter_no_method(app):
         assert result.called is False
 
 
+@pytest.mark.parametrize("co_filename,expected", (
+    ("/usr/src/app/app/main/views.py", True),
+    ("/usr/src/app/app/../app/main/views.py", True),
+    ("/usr/src/app/application.py", False),
+    ("/usr/src/app/app_other/views.py", False),
+    ("/usr/lib/python3/site-packages/flask/app.py", False),
+))
+def test_app_stack_location_filter_is_interesting_frame(co_filename, expected):
+    filter_ = AppStackLocationFilter("app_", "/usr/src/app/app")
+    frame = mock.Mock(f_code=mock.Mock(co_filename=co_filename))
+
+    assert filter_.is_interesting_frame(frame) is expected
+
+
+def test_app_stack_location_filter_caches_per_filename():
+    filter_ = AppStackLocationFilter("app_", "/usr/src/app/app")
+    app_frame = mock.Mock(f_code=mock.Mock(co_filename="/usr/src/app/app/main/views.py"))
+    lib_frame = mock.Mock(f_code=mock.Mock(co_filename="/usr/lib/python3/site-packages/flask/app.py"))
+
+    with mock.patch("dmutils.logging.os.path.commonpath", wraps=os.path.commonpath) as commonpath:
+        for _ in range(5):
+            assert filter_.is_interesting_frame(app_frame) is True
+            assert filter_.is_interesting_frame(lib_frame) is False
+
+    assert commonpath.call_count == 2
+
+
 def test_init_app_adds_stream_handler_without_log_path(app):
 
     assert len(app.logger.handlers) == 1
@@ -83,6 +130,78 @@ def test_init_app_adds_stream_handler_with_plain_text_format_when_config_env_set
     assert isinstance(app.logger.handlers[0].formatter, CustomLogFormatter)
 
 
+def test_init_app_adds_async_queue_handler_when_config_env_set(app):
+    app.config['DM_LOG_ASYNC'] = True
+    app.config['DM_LOG_ASYNC_QUEUE_SIZE'] = 123
+    app.config['DM_LOG_ASYNC_OVERFLOW_POLICY'] = "drop-debug"
+    init_app(app)
+
+    assert len(app.logger.handlers) == 1
+    handler = app.logger.handlers[0]
+    assert isinstance(handler, AsyncQueueHandler)
+    assert handler.queue.maxsize == 123
+    assert handler.overflow_policy == "drop-debug"
+    assert isinstance(handler.target_handler, logging.StreamHandler)
+    assert isinstance(handler.target_handler.formatter, JSONFormatter)
+
+    handler.close()
+
+
+def test_init_app_adds_buffered_file_handler_with_log_path_when_config_env_set(app):
+    with tempfile.NamedTemporaryFile() as f:
+        app.config['DM_LOG_PATH'] = f.name
+        app.config['DM_LOG_BUFFERED'] = True
+        app.config['DM_LOG_BUFFER_SIZE'] = 1024
+        app.config['DM_LOG_BUFFER_FLUSH_INTERVAL'] = 250
+        app.config['DM_LOG_BUFFER_FSYNC_POLICY'] = "error"
+        init_app(app)
+
+        assert len(app.logger.handlers) == 1
+        handler = app.logger.handlers[0]
+        assert isinstance(handler, BufferedJSONFileHandler)
+        assert isinstance(handler.formatter, JSONFormatter)
+        assert (handler.buffer_size, handler.flush_interval, handler.fsync_policy) == (1024, 250, "error")
+
+        handler.close()
+
+
+def test_init_app_sets_per_logger_levels_when_config_env_set(app):
+    app.config['DM_LOG_LEVEL'] = 'INFO'
+    app.config['DM_LOG_LEVELS'] = {
+        app.logger.name: 'DEBUG',
+        'dmapiclient': 'WARNING',
+        'dmutils.timing': logging.ERROR,
+    }
+    try:
+        init_app(app)
+
+        assert app.logger.level == logging.DEBUG
+        assert logging.getLogger('dmapiclient').level == logging.WARNING
+        assert logging.getLogger('dmutils').level == logging.INFO
+        assert logging.getLogger('dmutils.timing').level == logging.ERROR
+        # the child logger shouldn't have been given its own handler
+        assert logging.getLogger('dmutils.timing').handlers == []
+        # the handler must let through the most verbose of these
+        assert app.logger.handlers[0].level == logging.DEBUG
+    finally:
+        logging.getLogger('dmutils.timing').setLevel(logging.NOTSET)
+
+
+def test_disabled_logger_records_dont_reach_filters(app):
+    app.config['DM_LOG_LEVELS'] = {'dmapiclient': 'WARNING'}
+    init_app(app)
+    filter_ = mock.Mock(spec_set=("filter",), filter=mock.Mock(return_value=True))
+    app.logger.handlers[0].addFilter(filter_)
+
+    with app.test_request_context('/'):
+        logging.getLogger('dmapiclient').info("Quiet please")
+        logging.getLogger('dmapiclient.base').info("Quiet please")
+        assert filter_.filter.called is False
+
+        app.logger.info("Loud enough")
+        assert filter_.filter.call_count == 1
+
+
 def test_init_app_only_adds_handlers_to_defined_loggers(app):
     for logger in logging.Logger.manager.loggerDict.values():
         logger.handlers = []
@@ -144,6 +263,22 @@ def test_app_request_logs_responses_with_info_level_not_sampled(app_with_mocked_
     assert app_with_mocked_logger.logger.log.call_args_list == [expected_call]
 
 
+@pytest.mark.parametrize("is_sampled", (None, True))
+def test_app_request_doesnt_build_log_context_if_level_disabled(app_with_mocked_logger, is_sampled):
+    if is_sampled is not None:
+        _set_request_class_is_sampled(app_with_mocked_logger, is_sampled)
+    app_with_mocked_logger.logger.isEnabledFor.return_value = False
+
+    with mock.patch("dmutils.logging._common_request_extra_log_context") as common_context:
+        app_with_mocked_logger.test_client().get('/')
+
+    assert app_with_mocked_logger.logger.log.called is False
+    assert common_context.called is False
+    assert app_with_mocked_logger.logger.isEnabledFor.call_args_list == (
+        [mock.call(logging.DEBUG)] if is_sampled else []
+    ) + [mock.call(logging.INFO)]
+
+
 def test_app_request_logs_responses_with_info_level_sampled(app_with_mocked_logger):
     _set_request_class_is_sampled(app_with_mocked_logger, True)
 
@@ -220,6 +355,641 @@ def test_app_request_logs_5xx_responses_with_error_level_sampled(app_with_mocked
     assert expected_call in app_with_mocked_logger.logger.log.call_args_list
 
 
+def test_async_logging_writes_records_in_initialized_app(app_with_stream_logger):
+    app, stream = app_with_stream_logger
+    app.config['DM_LOG_ASYNC'] = True
+    init_app(app)
+
+    with app.test_request_context('/'):
+        app.logger.warning("Unapproachable {yew}", extra={"yew": "trees"})
+
+    # closing the handler should flush all queued records through to the stream
+    app.logger.handlers[0].close()
+
+    all_lines = tuple(json.loads(line) for line in stream.getvalue().splitlines())
+    assert all_lines[-1] == AnySupersetOf({
+        "message": "Unapproachable trees",
+        "levelname": "WARNING",
+        "application": "none",
+        # the stack inspection must have happened on the calling thread to have found this
+        "app_funcName": "test_async_logging_writes_records_in_initialized_app",
+    })
+
+
+class TestAsyncQueueHandler:
+    def setup(self):
+        self.buffer = StringIO()
+        self.target_handler = logging.StreamHandler(self.buffer)
+        self.target_handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.logger = logging.getLogger("logging-test.async")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+
+    def teardown(self):
+        del self.logger.handlers[:]
+
+    def _create_handler(self, **kwargs):
+        handler = AsyncQueueHandler(self.target_handler, **kwargs)
+        self.logger.addHandler(handler)
+        return handler
+
+    def test_unknown_overflow_policy(self):
+        with pytest.raises(ValueError):
+            AsyncQueueHandler(self.target_handler, overflow_policy="drop-everything")
+
+    def test_records_written_on_close(self):
+        handler = self._create_handler()
+        for i in range(50):
+            self.logger.info("Bloom %s", i)
+        handler.close()
+
+        assert self.buffer.getvalue().splitlines() == [f"INFO Bloom {i}" for i in range(50)]
+        assert handler.dropped_count == 0
+
+    def test_args_resolved_when_record_handled(self):
+        handler = self._create_handler()
+        handler.stop()
+
+        arg = ["Flora"]
+        self.logger.info("Hello %s", arg)
+        arg.append("Fauna")
+
+        assert handler.queue.get_nowait().msg == "Hello ['Flora']"
+
+    def test_drop_oldest(self):
+        handler = self._create_handler(maxsize=3, overflow_policy="drop-oldest")
+        # prevent the queue from being consumed
+        handler.stop()
+
+        self.logger.debug("one")
+        self.logger.warning("two")
+        self.logger.info("three")
+        self.logger.debug("four")
+        self.logger.error("five")
+
+        assert [r.msg for r in handler.queue.queue] == ["three", "four", "five"]
+        assert handler.dropped_records == {"DEBUG": 1, "WARNING": 1}
+        assert handler.dropped_count == 2
+
+    def test_drop_debug(self):
+        handler = self._create_handler(maxsize=3, overflow_policy="drop-debug")
+        handler.stop()
+
+        self.logger.warning("one")
+        self.logger.debug("two")
+        self.logger.info("three")
+        self.logger.error("four")
+        self.logger.debug("five")
+        self.logger.critical("six")
+
+        assert [r.msg for r in handler.queue.queue] == ["three", "four", "six"]
+        assert handler.dropped_records == {"DEBUG": 2, "WARNING": 1}
+
+    def test_block(self):
+        handler = self._create_handler(maxsize=2, overflow_policy="block")
+        for i in range(20):
+            self.logger.debug("Bloom %s", i)
+        handler.close()
+
+        assert len(self.buffer.getvalue().splitlines()) == 20
+        assert handler.dropped_count == 0
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+    def test_forked_child_gets_own_listener(self):
+        with tempfile.NamedTemporaryFile(mode="r") as log_file:
+            self.target_handler = logging.FileHandler(log_file.name)
+            self.target_handler.setFormatter(logging.Formatter("%(process)d %(message)s"))
+            handler = self._create_handler(maxsize=5, overflow_policy="block")
+            self.logger.info("Before fork")
+            # so the parent's record is written before the child's
+            handler.queue.join()
+
+            pid = os.fork()
+            if pid == 0:
+                # child
+                try:
+                    for i in range(10):
+                        self.logger.info("Child %s", i)
+                    handler.close()
+                finally:
+                    os._exit(0)
+
+            # a child without a listener would block forever on its full queue
+            deadline = time.monotonic() + 10
+            while os.waitpid(pid, os.WNOHANG) == (0, 0):
+                if time.monotonic() > deadline:
+                    os.kill(pid, 9)
+                    os.waitpid(pid, 0)
+                    pytest.fail("child process didn't finish logging")
+                time.sleep(0.01)
+
+            self.logger.info("After fork")
+            handler.close()
+
+            assert log_file.read().splitlines() == [
+                f"{os.getpid()} Before fork",
+            ] + [
+                f"{pid} Child {i}" for i in range(10)
+            ] + [
+                f"{os.getpid()} After fork",
+            ]
+
+
+def _make_record(level=logging.INFO, msg="Hello {name}", name="logging-test"):
+    return logging.LogRecord(name, level, __file__, 1, msg, (), None)
+
+
+def test_init_app_adds_rate_limiting_filters_when_config_env_set(app):
+    app.config['DM_LOG_RATE_LIMITS'] = {"rate": 2, "burst": 5, "sample_rates": {"DEBUG": 0.1}}
+    with mock.patch("dmutils.logging.atexit.register") as atexit_register:
+        init_app(app)
+
+    filters = app.logger.handlers[0].filters
+    assert isinstance(filters[0], SamplingFilter)
+    assert isinstance(filters[1], RateLimitingFilter)
+    assert mock.call(filters[1].close) in atexit_register.call_args_list
+
+
+def test_init_app_adds_no_rate_limiting_filters_by_default(app):
+    assert not any(
+        isinstance(filter_, (SamplingFilter, RateLimitingFilter)) for filter_ in app.logger.handlers[0].filters
+    )
+
+
+class TestSamplingFilter:
+    @pytest.mark.parametrize("level,random_value,expected", (
+        (logging.DEBUG, 0.09, True),
+        (logging.DEBUG, 0.11, False),
+        (logging.INFO, 0.49, True),
+        (logging.INFO, 0.51, False),
+        (logging.WARNING, 0.99, True),
+    ))
+    @mock.patch("dmutils.logging.random.random")
+    def test_sampling(self, random_mock, level, random_value, expected):
+        random_mock.return_value = random_value
+        filter_ = SamplingFilter({"DEBUG": 0.1, logging.INFO: 0.5})
+
+        assert filter_.filter(_make_record(level)) is expected
+
+    @mock.patch("dmutils.logging.random.random", return_value=0.5)
+    def test_errors_never_sampled_out(self, random_mock):
+        filter_ = SamplingFilter({"ERROR": 0, "CRITICAL": 0})
+
+        assert filter_.filter(_make_record(logging.ERROR)) is True
+        assert filter_.filter(_make_record(logging.CRITICAL)) is True
+
+    @mock.patch("dmutils.logging.random.random", return_value=0.5)
+    def test_sampled_request_bypasses_sampling(self, random_mock, app):
+        filter_ = SamplingFilter({"DEBUG": 0.1})
+
+        with app.test_request_context('/'):
+            assert filter_.filter(_make_record(logging.DEBUG)) is False
+            request.is_sampled = True
+            assert filter_.filter(_make_record(logging.DEBUG)) is True
+
+
+class TestRateLimitingFilter:
+    def test_rate_limits_per_logger_and_template(self):
+        with mock.patch("dmutils.logging.time.monotonic", return_value=1000.0) as monotonic:
+            filter_ = RateLimitingFilter(rate=1, burst=3, summary_interval=60)
+
+            assert [filter_.filter(_make_record()) for _ in range(5)] == [True, True, True, False, False]
+            # a different template or logger gets its own bucket
+            assert filter_.filter(_make_record(msg="Goodbye {name}")) is True
+            assert filter_.filter(_make_record(name="logging-test.other")) is True
+            # errors are never suppressed
+            assert filter_.filter(_make_record(logging.ERROR)) is True
+
+            # after a couple of seconds we should have regained two tokens
+            monotonic.return_value = 1002.0
+            assert [filter_.filter(_make_record()) for _ in range(3)] == [True, True, False]
+
+    def test_summary_logged_after_interval(self):
+        with mock.patch("dmutils.logging.time.monotonic", return_value=1000.0) as monotonic, \
+                mock.patch("dmutils.logging.logger") as logger_mock:
+            filter_ = RateLimitingFilter(rate=0.001, burst=1, summary_interval=60)
+
+            assert [filter_.filter(_make_record()) for _ in range(4)] == [True, False, False, False]
+            assert logger_mock.warning.called is False
+
+            monotonic.return_value = 1061.0
+            assert filter_.filter(_make_record(msg="Goodbye {name}")) is True
+
+            assert logger_mock.warning.call_args_list == [mock.call(
+                "Suppressed {suppressed_count} similar records from {suppressed_logger}: {suppressed_message}",
+                extra={
+                    "suppressed_count": 3,
+                    "suppressed_logger": "logging-test",
+                    "suppressed_message": "Hello {name}",
+                    "rate_limit_summary": True,
+                },
+            )]
+
+            # nothing further suppressed, so no further summary
+            monotonic.return_value = 1200.0
+            assert filter_.filter(_make_record(msg="Farewell {name}")) is True
+            assert logger_mock.warning.call_count == 1
+
+    def test_summary_logged_without_further_records(self):
+        with mock.patch("dmutils.logging.logger") as logger_mock:
+            filter_ = RateLimitingFilter(rate=0.001, burst=1, summary_interval=0.05)
+            try:
+                assert [filter_.filter(_make_record()) for _ in range(3)] == [True, False, False]
+
+                for _ in range(100):
+                    if logger_mock.warning.called:
+                        break
+                    time.sleep(0.01)
+            finally:
+                filter_.close()
+
+        assert logger_mock.warning.call_args_list == [
+            mock.call(mock.ANY, extra=AnySupersetOf({"suppressed_count": 2, "suppressed_message": "Hello {name}"})),
+        ]
+
+    def test_summary_logged_on_close(self):
+        with mock.patch("dmutils.logging.logger") as logger_mock:
+            filter_ = RateLimitingFilter(rate=0.001, burst=1, summary_interval=60)
+            assert [filter_.filter(_make_record()) for _ in range(3)] == [True, False, False]
+            assert logger_mock.warning.called is False
+
+            filter_.close()
+
+        assert logger_mock.warning.call_args_list == [
+            mock.call(mock.ANY, extra=AnySupersetOf({"suppressed_count": 2, "suppressed_message": "Hello {name}"})),
+        ]
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+    def test_forked_child_starts_without_suppressed_records(self):
+        with mock.patch("dmutils.logging.logger") as logger_mock:
+            filter_ = RateLimitingFilter(rate=0.001, burst=1, summary_interval=60)
+            assert [filter_.filter(_make_record()) for _ in range(3)] == [True, False, False]
+
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # child
+                try:
+                    filter_.filter(_make_record())
+                    filter_.close()
+                    os.write(write_fd, json.dumps([
+                        call[1]["extra"]["suppressed_count"] for call in logger_mock.warning.call_args_list
+                    ]).encode())
+                finally:
+                    os._exit(0)
+
+            os.close(write_fd)
+            os.waitpid(pid, 0)
+            with os.fdopen(read_fd) as pipe:
+                assert json.loads(pipe.read()) == [1]
+
+            filter_.close()
+
+        assert logger_mock.warning.call_args_list == [
+            mock.call(mock.ANY, extra=AnySupersetOf({"suppressed_count": 2})),
+        ]
+
+    def test_summary_record_passes_through_filter(self):
+        filter_ = RateLimitingFilter(rate=0.001, burst=1, summary_interval=0)
+        logger = logging.getLogger("logging-test.rate-limited")
+        buffer = StringIO()
+        handler = logging.StreamHandler(buffer)
+        handler.setFormatter(JSONFormatter(get_json_log_format()))
+        handler.addFilter(filter_)
+        dmlogger = logging.getLogger("dmutils")
+        dmlogger.setLevel(logging.DEBUG)
+        for logger_ in (logger, dmlogger):
+            logger_.addHandler(handler)
+        try:
+            for i in range(3):
+                logger.warning("Leaking {tap}", extra={"tap": i})
+        finally:
+            for logger_ in (logger, dmlogger):
+                logger_.removeHandler(handler)
+
+        assert [json.loads(line)["message"] for line in buffer.getvalue().splitlines()] == [
+            "Leaking 0",
+            "Suppressed 1 similar records from logging-test.rate-limited: Leaking {tap}",
+            "Suppressed 1 similar records from logging-test.rate-limited: Leaking {tap}",
+        ]
+
+
+class TestBufferedJSONFileHandler:
+    def setup(self):
+        self.tmpfile = tempfile.NamedTemporaryFile()
+        self.logger = logging.getLogger("logging-test.buffered")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+
+    def teardown(self):
+        for handler in self.logger.handlers:
+            handler.close()
+        del self.logger.handlers[:]
+        self.tmpfile.close()
+
+    def _create_handler(self, **kwargs):
+        handler = BufferedJSONFileHandler(self.tmpfile.name, **kwargs)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.logger.addHandler(handler)
+        return handler
+
+    def _written_lines(self):
+        with open(self.tmpfile.name) as f:
+            return f.read().splitlines()
+
+    def test_unknown_fsync_policy(self):
+        with pytest.raises(ValueError):
+            BufferedJSONFileHandler(self.tmpfile.name, fsync_policy="sometimes")
+
+    def test_flushes_when_buffer_full(self):
+        # "INFO Bloom n\n" is 13 characters
+        self._create_handler(buffer_size=30, flush_interval=60000)
+
+        self.logger.info("Bloom %s", 1)
+        self.logger.info("Bloom %s", 2)
+        assert self._written_lines() == []
+
+        self.logger.info("Bloom %s", 3)
+        assert self._written_lines() == ["INFO Bloom 1", "INFO Bloom 2", "INFO Bloom 3"]
+
+    def test_flushes_on_error(self):
+        self._create_handler(flush_interval=60000)
+
+        self.logger.warning("Bloom")
+        assert self._written_lines() == []
+
+        self.logger.error("Boylan")
+        assert self._written_lines() == ["WARNING Bloom", "ERROR Boylan"]
+
+    def test_flushes_after_interval(self):
+        self._create_handler(flush_interval=10)
+
+        self.logger.info("Bloom")
+        for _ in range(100):
+            if self._written_lines():
+                break
+            time.sleep(0.01)
+
+        assert self._written_lines() == ["INFO Bloom"]
+
+    def test_flushes_on_close(self):
+        handler = self._create_handler(flush_interval=60000)
+
+        self.logger.info("Bloom")
+        assert self._written_lines() == []
+
+        handler.close()
+        assert self._written_lines() == ["INFO Bloom"]
+
+    @pytest.mark.parametrize("fsync_policy,expected_fsyncs", (
+        ("never", (0, 0)),
+        ("error", (0, 1)),
+        ("always", (1, 2)),
+    ))
+    def test_fsync_policy(self, fsync_policy, expected_fsyncs):
+        self._create_handler(buffer_size=1, flush_interval=60000, fsync_policy=fsync_policy)
+
+        with mock.patch("dmutils.logging.os.fsync") as fsync:
+            self.logger.info("Bloom")
+            first_fsyncs = fsync.call_count
+            self.logger.error("Boylan")
+
+        assert (first_fsyncs, fsync.call_count) == expected_fsyncs
+        assert self._written_lines() == ["INFO Bloom", "ERROR Boylan"]
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+    def test_forked_child_discards_parents_buffer(self):
+        handler = self._create_handler(flush_interval=60000)
+        self.logger.info("Before fork")
+
+        pid = os.fork()
+        if pid == 0:
+            # child
+            try:
+                self.logger.info("Child")
+                handler.close()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.logger.info("After fork")
+        handler.close()
+
+        assert self._written_lines() == ["INFO Child", "INFO Before fork", "INFO After fork"]
+
+
+class TestAccessLogAggregation:
+    def _create_app(self, sampled=False, **config):
+        # the regular app fixtures will have already called init_app, so we need our own app
+        with mock.patch('flask.app.create_logger', return_value=mock.Mock(spec=Logger('flask.app'), handlers=[])):
+            app = Flask(__name__, static_folder=None)
+            # app.logger is created lazily
+            assert isinstance(app.logger, mock.Mock)
+        if sampled:
+            _set_request_class_is_sampled(app, True)
+        app.config.update(config)
+        init_app(app)
+
+        @app.route('/_status')
+        def status():
+            return 'ok'
+
+        @app.route('/static/<path:path>')
+        def static_file(path):
+            return 'file'
+
+        @app.route('/broken')
+        def broken():
+            return 'error', 500
+
+        @app.route('/other')
+        def other():
+            return 'other'
+
+        app.logger.reset_mock()
+        return app
+
+    def _summary_calls(self, app):
+        return [
+            call for call in app.logger.info.call_args_list
+            if call[0] == ("{count} requests to {aggregate_key} in {interval}s",)
+        ]
+
+    def test_aggregated_requests_not_logged_individually(self):
+        app = self._create_app(
+            DM_LOG_AGGREGATE_ENDPOINTS=("status",),
+            DM_LOG_AGGREGATE_URL_PREFIXES=("/static/",),
+        )
+        client = app.test_client()
+
+        client.get('/_status')
+        client.get('/static/main.css')
+        assert app.logger.log.called is False
+        assert self._summary_calls(app) == []
+
+        client.get('/other')
+        client.get('/broken')
+        assert [call[0][:2] for call in app.logger.log.call_args_list] == [
+            (logging.INFO, '{method} {url} {status}'),
+            (logging.ERROR, '{method} {url} {status}'),
+        ]
+
+    def test_error_responses_logged_individually(self):
+        app = self._create_app(DM_LOG_AGGREGATE_ENDPOINTS=("broken",))
+
+        app.test_client().get('/broken')
+
+        assert [call[0][:2] for call in app.logger.log.call_args_list] == [
+            (logging.ERROR, '{method} {url} {status}'),
+        ]
+
+    def test_sampled_requests_logged_individually(self):
+        app = self._create_app(sampled=True, DM_LOG_AGGREGATE_ENDPOINTS=("status",))
+
+        app.test_client().get('/_status')
+
+        assert (logging.INFO, '{method} {url} {status}') in [
+            call[0][:2] for call in app.logger.log.call_args_list
+        ]
+
+    def test_summary_logged_after_interval(self):
+        app = self._create_app(
+            DM_LOG_AGGREGATE_URL_PREFIXES=("/static/", "/_"),
+            DM_LOG_AGGREGATE_INTERVAL=60,
+        )
+        client = app.test_client()
+
+        now = time.monotonic()
+        with mock.patch("dmutils.logging.time.monotonic") as monotonic:
+            monotonic.return_value = now + 1
+            for _ in range(3):
+                client.get('/static/main.css')
+            client.get('/static/main.js', query_string={"v": "123"})
+            client.get('/_status')
+            assert self._summary_calls(app) == []
+
+            monotonic.return_value += 60
+            client.get('/_status')
+
+        assert self._summary_calls(app) == [
+            mock.call(
+                "{count} requests to {aggregate_key} in {interval}s",
+                extra={
+                    "aggregate_key": "/static/",
+                    "count": 4,
+                    "interval": RestrictedAny(lambda value: value >= 60),
+                    "status_counts": {"200": 4},
+                    "duration_real_p50": RestrictedAny(lambda value: isinstance(value, float)),
+                    "duration_real_p90": RestrictedAny(lambda value: isinstance(value, float)),
+                    "duration_real_p99": RestrictedAny(lambda value: isinstance(value, float)),
+                    "duration_real_max": RestrictedAny(lambda value: isinstance(value, float)),
+                },
+            ),
+            mock.call(
+                "{count} requests to {aggregate_key} in {interval}s",
+                extra=AnySupersetOf({"aggregate_key": "/_", "count": 2, "status_counts": {"200": 2}}),
+            ),
+        ]
+
+    def test_summary_logged_without_further_requests(self):
+        logger = mock.Mock()
+        aggregator = AccessLogAggregator(logger, endpoints=("status",), interval=0.05)
+        for _ in range(3):
+            aggregator.add("status", 200, 0.01)
+        assert logger.info.called is False
+
+        deadline = time.monotonic() + 5
+        while not logger.info.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        aggregator.close()
+
+        assert logger.info.call_args_list == [
+            mock.call(mock.ANY, extra=AnySupersetOf({"aggregate_key": "status", "count": 3})),
+        ]
+
+    def test_summary_logged_on_close(self):
+        logger = mock.Mock()
+        aggregator = AccessLogAggregator(logger, url_prefixes=("/static/",), interval=60)
+        aggregator.add("/static/", 200, 0.01)
+        aggregator.add("/static/", 404, 0.02)
+        assert logger.info.called is False
+
+        aggregator.close()
+
+        assert logger.info.call_args_list == [
+            mock.call(mock.ANY, extra=AnySupersetOf({
+                "aggregate_key": "/static/",
+                "count": 2,
+                "status_counts": {"200": 1, "404": 1},
+            })),
+        ]
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+    def test_forked_child_starts_new_interval(self):
+        logger = mock.Mock()
+        aggregator = AccessLogAggregator(logger, url_prefixes=("/static/",), interval=60)
+        aggregator.add("/static/", 200, 0.01)
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child
+            try:
+                aggregator.add("/static/", 404, 0.02)
+                aggregator.close()
+                os.write(write_fd, json.dumps([
+                    call[1]["extra"]["status_counts"] for call in logger.info.call_args_list
+                ]).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as pipe:
+            assert json.loads(pipe.read()) == [{"404": 1}]
+
+        aggregator.close()
+        assert logger.info.call_args_list == [
+            mock.call(mock.ANY, extra=AnySupersetOf({"count": 1, "status_counts": {"200": 1}})),
+        ]
+
+    @pytest.mark.parametrize("config,expect_registered", (
+        ({}, False),
+        ({"DM_LOG_AGGREGATE_ENDPOINTS": ("status",)}, True),
+        ({"DM_LOG_AGGREGATE_URL_PREFIXES": ("/static/",)}, True),
+    ))
+    def test_close_registered_atexit(self, config, expect_registered):
+        with mock.patch("dmutils.logging.atexit.register") as atexit_register:
+            self._create_app(**config)
+
+        assert atexit_register.call_args_list == ([
+            mock.call(RestrictedAny(lambda func: func.__self__.__class__ is AccessLogAggregator))
+        ] if expect_registered else [])
+
+    def test_percentiles(self):
+        logger = mock.Mock()
+        with mock.patch("dmutils.logging.time.monotonic", return_value=0):
+            aggregator = AccessLogAggregator(logger, endpoints=("status",), interval=1)
+            assert aggregator.get_aggregate_key("status", "/_status") == "status"
+            assert aggregator.get_aggregate_key("other", "/_status") is None
+            for i in range(100, 0, -1):
+                aggregator.add("status", 200 if i % 10 else 404, i / 100)
+
+        with mock.patch("dmutils.logging.time.monotonic", return_value=1):
+            aggregator.add("status", 200, None)
+
+        assert logger.info.call_args_list == [mock.call(mock.ANY, extra={
+            "aggregate_key": "status",
+            "count": 101,
+            "interval": 1,
+            "status_counts": {"200": 91, "404": 10},
+            "duration_real_p50": 0.51,
+            "duration_real_p90": 0.91,
+            "duration_real_p99": 1.0,
+            "duration_real_max": 1.0,
+        })]
+
+
 class TestJSONFormatter(object):
     def _create_logger(self, name, formatter):
         logger = logging.getLogger(name)
@@ -303,6 +1073,100 @@ class TestJSONFormatter(object):
 
         assert result['message'].startswith("Too many missing keys when attempting to format")
 
+    def test_four_missing_keys_still_formats(self):
+        self.logger.info("hello {one} {two} {three} {four} {foo}", extra={"foo": "bar"})
+        result = json.loads(self.buffer.getvalue())
+
+        assert result['message'] == (
+            "hello {one: missing key} {two: missing key} {three: missing key} {four: missing key} bar"
+        )
+
+    @pytest.mark.parametrize("message,extra,expected_message", (
+        ("{foo!r} and {{braces}}", {"foo": "bar"}, "'bar' and {braces}"),
+        ("{foo:>6}|{bar:.2f}", {"foo": "bar", "bar": 1.23456}, "   bar|1.23"),
+        ("{foo[1]} {foo[2][x]}", {"foo": ("a", "b", {"x": "c"})}, "b c"),
+        ("{foo.real} {missing!r}", {"foo": 3}, "3 '{missing: missing key}'"),
+        ("{levelname} {name}", {}, "INFO logging-test"),
+        ("{foo:{width}}", {"foo": "bar", "width": 5}, "bar  "),
+        ("{foo[y]} {bar}", {"foo": {"x": 1}, "bar": "baz"}, "{foo[y]} {bar}"),
+        ("{foo[0].real[x]}", {"foo": [mock.Mock(real={"x": "y"})]}, "y"),
+        ("{foo[ 0]}", {"foo": {" 0": "bar"}}, "bar"),
+    ))
+    def test_log_message_formatting_matches_str_format(self, message, extra, expected_message):
+        self.logger.info(message, extra=extra)
+        result = json.loads(self.buffer.getvalue())
+
+        assert result['message'] == expected_message
+
+    def test_log_message_template_is_compiled_once(self):
+        with mock.patch.object(
+            dmutils.logging._formatter, "parse", wraps=dmutils.logging._formatter.parse,
+        ) as parser:
+            for i in range(3):
+                self.logger.info("hello {foo} - only parse me once", extra={"foo": i})
+
+        assert parser.call_count == 1
+        assert [json.loads(line)['message'] for line in self.buffer.getvalue().splitlines()] == [
+            f"hello {i} - only parse me once" for i in range(3)
+        ]
+
+
+@pytest.mark.parametrize("field_name,expected_result", (
+    ("foo", ("foo", ())),
+    ("foo.bar[0][baz]", ("foo", ((True, "bar"), (False, 0), (False, "baz")))),
+    ("foo[1.5]", ("foo", ((False, "1.5"),))),
+    ("", None),
+    ("0", None),
+    ("[0]", None),
+    ("foo.", None),
+    ("foo[0", None),
+    ("foo[0]bar", None),
+))
+def test_split_field_name(field_name, expected_result):
+    assert dmutils.logging._split_field_name(field_name) == expected_result
+
+
+def test_init_app_uses_fast_json_serializer_when_config_env_set(app):
+    app.config['DM_LOG_FAST_JSON'] = True
+    init_app(app)
+
+    assert app.logger.handlers[0].formatter.json_serializer is fast_json_dumps
+
+
+class _Client:
+    pass
+
+
+class TestFastJSONDumps:
+    def _get_exc_info(self):
+        try:
+            raise ValueError("Eccles Street")
+        except ValueError:
+            return sys.exc_info()
+
+    @pytest.mark.parametrize("obj", (
+        {"message": "hello", "status": 200, "duration_real": 0.5, "is_sampled": None, "nested": [1, {"a": True}]},
+        {"time": datetime.datetime(2019, 6, 16, 8, 0, 0, 123)},
+        {"date": datetime.date(1904, 6, 16), "time_of_day": datetime.time(8, 0)},
+        {"client": _Client, "error": ValueError("Eccles Street")},
+        {"very_big": 1 << 70},
+        {"non_ascii": "Molly\u2019s"},
+    ))
+    def test_matches_standard_json_formatter_output(self, obj):
+        standard = JSONFormatter(get_json_log_format())
+        expected = json.loads(standard.jsonify_log_record(obj))
+
+        fast = JSONFormatter(get_json_log_format(), json_serializer=fast_json_dumps)
+        assert json.loads(fast.jsonify_log_record(obj)) == expected
+
+    def test_traceback(self):
+        exc_info = self._get_exc_info()
+
+        assert json.loads(fast_json_dumps({"tb": exc_info[2]})) == {"tb": AnyStringMatching(r".*_get_exc_info.*")}
+
+    def test_indent_falls_back_to_stdlib(self):
+        assert fast_json_dumps({"a": 1}, indent=2) == '{\n  "a": 1\n}'
+
 
 @pytest.mark.parametrize("is_sampled", (False, True,))
 def test_log_context_handling_in_initialized_app_high_level(app_with_stream_logger, is_sampled):
@@ -441,3 +1305,124 @@ class TestCustomLogFormatter(object):
 
         assert 'failed to format log message' in self.dmbuffer.getvalue()
         assert 'hello {' in self.buffer.getvalue()
+
+
+class TestSpanTreeLogging:
+    def _create_app(self, sampled, **config):
+        # the regular app fixtures will have already called init_app, so we need our own app
+        with mock.patch('flask.app.create_logger', return_value=mock.Mock(spec=Logger('flask.app'), handlers=[])):
+            app = Flask(__name__, static_folder=None)
+            assert isinstance(app.logger, mock.Mock)
+        app.logger.name = 'flask.app'
+        app.config.update(config)
+        if sampled is None:
+            # leave it up to request_id's sampler
+            request_id_init_app(app)
+        else:
+            _set_request_class_is_sampled(app, sampled)
+        init_app(app)
+
+        @app.route('/nested')
+        def nested():
+            with logged_duration(logger=app.logger, condition=lambda log_context: False, histogram_label="outer"):
+                with logged_duration(logger=app.logger, condition=lambda log_context: False, histogram_label="inner"):
+                    pass
+            return 'ok'
+
+        app.logger.reset_mock()
+        return app
+
+    def _span_tree_calls(self, app):
+        return [
+            call for call in app.logger.info.call_args_list
+            if call[0] == ("Span tree for {method} {url}: {span_count} spans",)
+        ]
+
+    def test_span_tree_logged_for_sampled_request(self):
+        app = self._create_app(True, DM_LOG_SPAN_TREES=True)
+        app.test_client().get('/nested')
+
+        assert self._span_tree_calls(app) == [mock.call(
+            "Span tree for {method} {url}: {span_count} spans",
+            extra=AnySupersetOf({
+                "url": "http://localhost/nested",
+                "span_count": 2,
+                "spans": [
+                    AnySupersetOf({"id": 1, "parent_id": None, "name": "flask.app:outer"}),
+                    AnySupersetOf({"id": 2, "parent_id": 1, "name": "flask.app:inner"}),
+                ],
+                "spans_dropped": 0,
+            }),
+        )]
+
+    def test_span_tree_max_spans(self):
+        app = self._create_app(True, DM_LOG_SPAN_TREES=True, DM_LOG_SPAN_TREE_MAX_SPANS=1)
+        app.test_client().get('/nested')
+
+        assert self._span_tree_calls(app) == [mock.call(
+            "Span tree for {method} {url}: {span_count} spans",
+            extra=AnySupersetOf({
+                "span_count": 1,
+                "spans": [AnySupersetOf({"id": 1, "parent_id": None, "name": "flask.app:outer"})],
+                "spans_dropped": 1,
+            }),
+        )]
+
+    def test_span_tree_max_spans_default(self):
+        app = self._create_app(True, DM_LOG_SPAN_TREES=True)
+
+        @app.route('/many')
+        def many():
+            for _ in range(150):
+                with logged_duration(logger=app.logger, condition=lambda log_context: False):
+                    pass
+            return 'ok'
+
+        app.test_client().get('/many')
+
+        assert self._span_tree_calls(app) == [mock.call(
+            mock.ANY,
+            extra=AnySupersetOf({"span_count": 100, "spans_dropped": 50}),
+        )]
+
+    @pytest.mark.parametrize("sampled,config", (
+        (False, {"DM_LOG_SPAN_TREES": True}),
+        (True, {}),
+    ))
+    def test_span_tree_not_logged(self, sampled, config):
+        app = self._create_app(sampled, **config)
+        app.test_client().get('/nested')
+
+        assert self._span_tree_calls(app) == []
+
+    @pytest.mark.parametrize("slow_threshold,expect_logged", ((0., True), (1000., False)))
+    def test_span_tree_logged_for_tail_sampled_request(self, slow_threshold, expect_logged):
+        app = self._create_app(None, DM_LOG_SPAN_TREES=True, DM_SAMPLING_SLOW_THRESHOLD=slow_threshold)
+        app.test_client().get('/nested')
+
+        assert len(self._span_tree_calls(app)) == (1 if expect_logged else 0)
+        assert app.logger.log.call_args_list == [mock.call(
+            logging.INFO,
+            '{method} {url} {status}',
+            extra=AnySupersetOf({"url": "http://localhost/nested"}),
+        )]
+        assert timing.pop_span_tree() is None
+
+
+@pytest.mark.parametrize("is_sampled", (False, True))
+def test_request_context_captured_for_duration_of_request(app, is_sampled):
+    _set_request_class_is_sampled(app, is_sampled)
+    captured = []
+
+    @app.route('/')
+    def index():
+        # as an asyncio task on another thread would see it
+        captured.append(contextvars.copy_context().run(lambda: (
+            timing._request_context_snapshot.get().is_sampled
+        )))
+        return 'ok'
+
+    app.test_client().get('/')
+
+    assert captured == [is_sampled]
+    assert timing._request_context_snapshot.get() is None
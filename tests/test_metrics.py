@@ -0,0 +1,147 @@
+import os
+
+import mock
+import pytest
+from prometheus_client import CollectorRegistry, generate_latest
+
+from dmutils import timing
+from dmutils.metrics import DMGDSMetrics, DurationHistogramExporter
+
+
+def _collect_samples(registry):
+    return {
+        (sample.name, sample.labels.get("le")): sample.value
+        for metric in registry.collect()
+        for sample in metric.samples
+        if sample.labels.get("logger") == "foo.bar"
+    }
+
+
+class TestDurationHistogramExporter:
+    def test_collect_without_multiprocess_dir(self):
+        registry = timing.DurationHistogramRegistry(buckets=(0.1, 1.0))
+        prometheus_registry = CollectorRegistry()
+        DurationHistogramExporter(registry, registry=prometheus_registry)
+        registry.observe(("foo.bar", "baz"), 0.05)
+        registry.observe(("foo.bar", "baz"), 0.5)
+
+        assert _collect_samples(prometheus_registry) == {
+            ("dm_logged_duration_seconds_bucket", "0.1"): 1,
+            ("dm_logged_duration_seconds_bucket", "1.0"): 2,
+            ("dm_logged_duration_seconds_bucket", "+Inf"): 2,
+            ("dm_logged_duration_seconds_count", None): 2,
+            ("dm_logged_duration_seconds_sum", None): 0.55,
+        }
+
+    def test_flush(self, tmpdir):
+        registry = timing.DurationHistogramRegistry(buckets=(0.1, 1.0))
+        exporter = DurationHistogramExporter(registry, multiprocess_dir=str(tmpdir))
+        registry.observe(("foo.bar", "baz"), 0.05)
+
+        assert tmpdir.listdir() == []
+
+        exporter.flush()
+        assert [path.basename for path in tmpdir.listdir()] == [f"dm_logged_duration_seconds_{os.getpid()}.json"]
+        assert exporter._collect_snapshots() == {("foo.bar", "baz"): ([1, 1, 1], 0.05)}
+
+        # unchanged counts aren't written again
+        with mock.patch("dmutils.metrics.os.replace") as replace:
+            exporter.flush()
+        assert replace.called is False
+
+        registry.observe(("foo.bar", "baz"), 5)
+        exporter.flush()
+        assert exporter._collect_snapshots() == {("foo.bar", "baz"): ([1, 1, 2], 5.05)}
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+    def test_aggregated_across_processes(self, tmpdir):
+        registry = timing.DurationHistogramRegistry(buckets=(0.1, 1.0))
+        prometheus_registry = CollectorRegistry()
+        DurationHistogramExporter(registry, registry=prometheus_registry, multiprocess_dir=str(tmpdir))
+        registry.observe(("foo.bar", "baz"), 0.05)
+
+        pid = os.fork()
+        if pid == 0:
+            # child
+            try:
+                registry.observe(("foo.bar", "baz"), 0.5)
+                generate_latest(prometheus_registry)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        # the parent's counts are flushed on collection
+        assert _collect_samples(prometheus_registry) == {
+            ("dm_logged_duration_seconds_bucket", "0.1"): 1,
+            ("dm_logged_duration_seconds_bucket", "1.0"): 2,
+            ("dm_logged_duration_seconds_bucket", "+Inf"): 2,
+            ("dm_logged_duration_seconds_count", None): 2,
+            ("dm_logged_duration_seconds_sum", None): 0.55,
+        }
+
+    def test_unreadable_snapshots_skipped(self, tmpdir):
+        registry = timing.DurationHistogramRegistry(buckets=(0.1, 1.0))
+        exporter = DurationHistogramExporter(registry, multiprocess_dir=str(tmpdir))
+        registry.observe(("foo.bar", "baz"), 0.05)
+        exporter.flush()
+        tmpdir.join("dm_logged_duration_seconds_31415.json").write("[[\"foo.bar\", ")
+
+        assert exporter._collect_snapshots() == {("foo.bar", "baz"): ([1, 1, 1], 0.05)}
+
+    def test_ensure_flusher(self, tmpdir):
+        registry = timing.DurationHistogramRegistry(buckets=(0.1, 1.0))
+        exporter = DurationHistogramExporter(registry, multiprocess_dir=str(tmpdir), flush_interval=0.01)
+        with mock.patch.object(exporter, "flush") as flush:
+            exporter.ensure_flusher()
+            flusher = exporter._flusher
+            exporter.ensure_flusher()
+            assert exporter._flusher is flusher
+
+            flusher.join(0.5)
+            assert flush.called
+
+    def test_no_flusher_without_multiprocess_dir(self):
+        exporter = DurationHistogramExporter(timing.DurationHistogramRegistry())
+        exporter.ensure_flusher()
+        assert exporter._flusher is None
+
+
+class TestDMGDSMetrics:
+    def setup(self):
+        self.registry_patch = mock.patch("dmutils.timing._duration_histogram_registry", None)
+        self.registry_patch.start()
+
+    def teardown(self):
+        self.registry_patch.stop()
+
+    def test_duration_histograms_not_enabled_by_default(self, app):
+        metrics = DMGDSMetrics()
+        metrics.init_app(app)
+
+        assert timing.get_duration_histogram_registry() is None
+        assert metrics.duration_histogram_exporter is None
+
+    def test_duration_histograms_exported(self, app, tmpdir):
+        app.config["DM_DURATION_HISTOGRAMS"] = True
+        app.config["DM_DURATION_HISTOGRAMS_FLUSH_INTERVAL"] = 60
+
+        @app.route("/")
+        def index():
+            with timing.logged_duration(logger=app.logger, condition=lambda log_context: False, histogram_label="baz"):
+                pass
+            return "ok"
+
+        with mock.patch.dict(os.environ, {"METRICS_BASIC_AUTH": "false", "PROMETHEUS_MULTIPROC_DIR": str(tmpdir)}):
+            metrics = DMGDSMetrics()
+            metrics.init_app(app)
+            app.add_url_rule(metrics.metrics_path, 'metrics', metrics.metrics_endpoint)
+
+            client = app.test_client()
+            client.get("/")
+
+            assert metrics.duration_histogram_exporter.multiprocess_dir == str(tmpdir)
+            assert metrics.duration_histogram_exporter.flush_interval == 60
+            assert metrics.duration_histogram_exporter._flusher.is_alive()
+            # flushed on being scraped
+            assert b'dm_logged_duration_seconds_count{label="baz",logger="' in client.get(metrics.metrics_path).data
+            assert tmpdir.join(f"dm_logged_duration_seconds_{os.getpid()}.json").check()
@@ -1,13 +1,18 @@
 from flask import request
 from itertools import chain, product
 import mock
+import os
+import re
 import pytest
 
 from dmtestutils.mocking import assert_args_and_return
-from dmtestutils.comparisons import AnySupersetOf
+from dmtestutils.comparisons import AnyStringMatching, AnySupersetOf
 
 from dmutils.request_id import (
     init_app as request_id_init_app,
+    RandomIdGenerator,
+    RequestIdHeaderPlan,
+    RequestSampler,
     RequestIdRequestMixin,
 )
 
@@ -502,11 +507,11 @@ _param_combinations = tuple(
     _param_combinations,
     ids=_abbreviate_id,
 )
-@mock.patch.object(RequestIdRequestMixin, "_traceid_random", autospec=True)
-@mock.patch.object(RequestIdRequestMixin, "_spanid_random", autospec=True)
+@mock.patch.object(RequestIdRequestMixin, "_trace_id_generator", autospec=True)
+@mock.patch.object(RequestIdRequestMixin, "_span_id_generator", autospec=True)
 def test_request_header(
-    spanid_random_mock,
-    traceid_random_mock,
+    span_id_generator_mock,
+    trace_id_generator_mock,
     app,
     extra_config,
     extra_req_headers,
@@ -525,8 +530,8 @@ def test_request_header(
 
     assert app.config.get("DM_REQUEST_ID_HEADER") == expected_dm_request_id_header_final_value
 
-    traceid_random_mock.randrange.side_effect = assert_args_and_return(_GENERATED_TRACE_VALUE, 1 << 128)
-    spanid_random_mock.randrange.side_effect = assert_args_and_return(_GENERATED_SPAN_VALUE, 1 << 64)
+    trace_id_generator_mock.get_hex_id.side_effect = assert_args_and_return(_GENERATED_TRACE_HEX, 128)
+    span_id_generator_mock.get_hex_id.side_effect = assert_args_and_return(_GENERATED_SPAN_HEX, 64)
 
     with app.test_request_context(headers=extra_req_headers):
         assert request.request_id == request.trace_id == expected_trace_id
@@ -544,38 +549,83 @@ def test_request_header(
             "debug_flag": "1" if expected_debug_flag else "0",
         }
 
-    assert traceid_random_mock.randrange.called is expect_trace_random_call
-    assert spanid_random_mock.randrange.called is True
+    assert trace_id_generator_mock.get_hex_id.called is expect_trace_random_call
+    assert span_id_generator_mock.get_hex_id.called is True
 
 
-@mock.patch.object(RequestIdRequestMixin, "_traceid_random", autospec=True)
-@mock.patch.object(RequestIdRequestMixin, "_spanid_random", autospec=True)
-def test_request_header_zero_padded(
-    spanid_random_mock,
-    traceid_random_mock,
-    app,
-):
+def test_request_header_zero_padded(app):
     request_id_init_app(app)
 
-    traceid_random_mock.randrange.side_effect = assert_args_and_return(0xbeef, 1 << 128)
-    spanid_random_mock.randrange.side_effect = assert_args_and_return(0xa, 1 << 64)
-
-    with app.test_request_context():
-        assert request.request_id == request.trace_id == "0000000000000000000000000000beef"
-        assert request.span_id is None
-        assert request.get_onwards_request_headers() == {
-            "DM-Request-ID": "0000000000000000000000000000beef",
-            "X-B3-TraceId": "0000000000000000000000000000beef",
-            "X-B3-SpanId": "000000000000000a",
-        }
-        assert request.get_extra_log_context() == AnySupersetOf({
-            'parent_span_id': None,
-            'span_id': None,
-            'trace_id': '0000000000000000000000000000beef',
-        })
-
-    assert traceid_random_mock.randrange.called is True
-    assert spanid_random_mock.randrange.called is True
+    with mock.patch.object(RequestIdRequestMixin, "_trace_id_generator", RandomIdGenerator(buffer_size=16)), \
+            mock.patch.object(RequestIdRequestMixin, "_span_id_generator", RandomIdGenerator(buffer_size=8)), \
+            mock.patch("dmutils.request_id.os.urandom", side_effect=(
+                b"\x00" * 14 + b"\xbe\xef",
+                b"\x00" * 7 + b"\x0a",
+            )) as urandom:
+        with app.test_request_context():
+            assert request.request_id == request.trace_id == "0000000000000000000000000000beef"
+            assert request.span_id is None
+            assert request.get_onwards_request_headers() == {
+                "DM-Request-ID": "0000000000000000000000000000beef",
+                "X-B3-TraceId": "0000000000000000000000000000beef",
+                "X-B3-SpanId": "000000000000000a",
+            }
+            assert request.get_extra_log_context() == AnySupersetOf({
+                'parent_span_id': None,
+                'span_id': None,
+                'trace_id': '0000000000000000000000000000beef',
+            })
+
+    assert urandom.call_args_list == [mock.call(16), mock.call(8)]
+
+
+class TestRandomIdGenerator:
+    def test_ids_sliced_from_buffer(self):
+        generator = RandomIdGenerator(buffer_size=32)
+        urandom_values = (bytes(range(32)), bytes(range(32, 64)))
+        with mock.patch("dmutils.request_id.os.urandom", side_effect=urandom_values) as urandom:
+            ids = [generator.get_hex_id(bitlen) for bitlen in (128, 64, 64, 64)]
+
+        assert ids == [
+            bytes(range(16)).hex(),
+            bytes(range(16, 24)).hex(),
+            bytes(range(24, 32)).hex(),
+            # this one didn't fit in the remainder of the first buffer
+            bytes(range(32, 40)).hex(),
+        ]
+        assert urandom.call_args_list == [mock.call(32), mock.call(32)]
+
+    def test_format(self):
+        generator = RandomIdGenerator()
+        trace_ids = {generator.get_hex_id(128) for _ in range(1000)}
+        span_ids = {generator.get_hex_id(64) for _ in range(1000)}
+
+        assert len(trace_ids) == len(span_ids) == 1000
+        assert all(re.fullmatch(r"[0-9a-f]{32}", trace_id) for trace_id in trace_ids)
+        assert all(re.fullmatch(r"[0-9a-f]{16}", span_id) for span_id in span_ids)
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+    def test_forked_child_does_not_reuse_buffer(self):
+        generator = RandomIdGenerator()
+        generator.get_hex_id(64)
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child
+            try:
+                os.write(write_fd, generator.get_hex_id(64).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as pipe:
+            child_id = pipe.read()
+
+        assert re.fullmatch(r"[0-9a-f]{16}", child_id)
+        # the parent's next id would have been the child's had the buffer been inherited
+        assert generator.get_hex_id(64) != child_id
 
 
 @pytest.mark.parametrize(
@@ -595,11 +645,11 @@ def test_request_header_zero_padded(
     _param_combinations,
     ids=_abbreviate_id,
 )
-@mock.patch.object(RequestIdRequestMixin, "_traceid_random", autospec=True)
-@mock.patch.object(RequestIdRequestMixin, "_spanid_random", autospec=True)
+@mock.patch.object(RequestIdRequestMixin, "_trace_id_generator", autospec=True)
+@mock.patch.object(RequestIdRequestMixin, "_span_id_generator", autospec=True)
 def test_response_headers_regular_response(
-    spanid_random_mock,
-    traceid_random_mock,
+    span_id_generator_mock,
+    trace_id_generator_mock,
     app,
     extra_config,
     extra_req_headers,
@@ -617,15 +667,15 @@ def test_response_headers_regular_response(
     request_id_init_app(app)
     client = app.test_client()
 
-    traceid_random_mock.randrange.side_effect = assert_args_and_return(_GENERATED_TRACE_VALUE, 1 << 128)
+    trace_id_generator_mock.get_hex_id.side_effect = assert_args_and_return(_GENERATED_TRACE_HEX, 128)
 
     with app.app_context():
         response = client.get('/', headers=extra_req_headers)
         # note using these mechanisms we're not able to test for the *absence* of a header
         assert dict(response.headers) == AnySupersetOf(expected_resp_headers)
 
-    assert traceid_random_mock.randrange.called is expect_trace_random_call
-    assert spanid_random_mock.randrange.called is False
+    assert trace_id_generator_mock.get_hex_id.called is expect_trace_random_call
+    assert span_id_generator_mock.get_hex_id.called is False
 
 
 @pytest.mark.parametrize(
@@ -645,11 +695,11 @@ def test_response_headers_regular_response(
     _param_combinations,
     ids=_abbreviate_id,
 )
-@mock.patch.object(RequestIdRequestMixin, "_traceid_random", autospec=True)
-@mock.patch.object(RequestIdRequestMixin, "_spanid_random", autospec=True)
+@mock.patch.object(RequestIdRequestMixin, "_trace_id_generator", autospec=True)
+@mock.patch.object(RequestIdRequestMixin, "_span_id_generator", autospec=True)
 def test_response_headers_error_response(
-    spanid_random_mock,
-    traceid_random_mock,
+    span_id_generator_mock,
+    trace_id_generator_mock,
     app,
     extra_config,
     extra_req_headers,
@@ -667,7 +717,7 @@ def test_response_headers_error_response(
     request_id_init_app(app)
     client = app.test_client()
 
-    traceid_random_mock.randrange.side_effect = assert_args_and_return(_GENERATED_TRACE_VALUE, 1 << 128)
+    trace_id_generator_mock.get_hex_id.side_effect = assert_args_and_return(_GENERATED_TRACE_HEX, 128)
 
     @app.route('/')
     def error_route():
@@ -678,5 +728,278 @@ def test_response_headers_error_response(
         assert response.status_code == 500
         assert dict(response.headers) == AnySupersetOf(expected_resp_headers)
 
-    assert traceid_random_mock.randrange.called is expect_trace_random_call
-    assert spanid_random_mock.randrange.called is False
+    assert trace_id_generator_mock.get_hex_id.called is expect_trace_random_call
+    assert span_id_generator_mock.get_hex_id.called is False
+
+
+def test_extra_log_context_computed_once_per_request(app):
+    request_id_init_app(app)
+
+    with app.test_request_context(headers=(("X-B3-TraceId", "from-header"), ("X-B3-Sampled", "1"),)):
+        with mock.patch.object(
+            RequestIdRequestMixin,
+            "_read_header_values",
+            autospec=True,
+            side_effect=RequestIdRequestMixin._read_header_values,
+        ) as read_header_values:
+            first_context = request.get_extra_log_context()
+            for _ in range(5):
+                assert request.get_extra_log_context() is first_context
+
+        assert first_context == AnySupersetOf({"trace_id": "from-header", "is_sampled": "1"})
+        # a single pass reading all five values
+        assert read_header_values.call_count == 1
+
+
+def test_extra_log_context_rebuilt_if_trace_values_change(app):
+    request_id_init_app(app)
+
+    with app.test_request_context(headers=(("X-B3-TraceId", "from-header"),)):
+        assert request.get_extra_log_context() == AnySupersetOf({"trace_id": "from-header", "is_sampled": "0"})
+
+        request._is_sampled = True
+
+        assert request.get_extra_log_context() == AnySupersetOf({"trace_id": "from-header", "is_sampled": "1"})
+
+
+class TestRequestSampler:
+    @pytest.mark.parametrize("rate,random_value,expected", (
+        (0., 0., False),
+        (1., 0.99, True),
+        (0.1, 0.05, True),
+        (0.1, 0.15, False),
+    ))
+    def test_should_sample(self, rate, random_value, expected):
+        with mock.patch("dmutils.request_id.random", return_value=random_value):
+            assert RequestSampler(rate=rate).should_sample("foo") is expected
+
+    def test_endpoint_rates(self):
+        sampler = RequestSampler(rate=1., endpoint_rates={"status": 0.})
+        assert sampler.should_sample("status") is False
+        assert sampler.should_sample("other") is True
+
+    def test_should_tail_sample(self):
+        assert RequestSampler().should_tail_sample(100) is False
+        assert RequestSampler(slow_threshold=2.).should_tail_sample(1.5) is False
+        assert RequestSampler(slow_threshold=2.).should_tail_sample(2.5) is True
+
+
+def _create_sampling_app(app, **config):
+    app.config.update(config)
+    request_id_init_app(app)
+
+    @app.route("/status")
+    def status():
+        return "ok"
+
+    @app.route("/other")
+    def other():
+        return "ok"
+
+    return app
+
+
+@pytest.mark.parametrize("headers,path,expected_is_sampled", (
+    ({}, "/other", True),
+    ({}, "/status", False),
+    # upstream decisions are respected
+    ({"X-B3-Sampled": "0"}, "/other", False),
+    ({"X-B3-Sampled": "1"}, "/status", True),
+    ({"X-B3-Flags": "1"}, "/status", True),
+))
+def test_request_sampler_used_without_sampling_header(app, headers, path, expected_is_sampled):
+    _create_sampling_app(app, DM_SAMPLING_RATE=1., DM_SAMPLING_ENDPOINT_RATES={"status": 0.})
+
+    with app.test_request_context(path, headers=headers):
+        app.preprocess_request()
+        assert request.is_sampled is expected_is_sampled
+        assert request.get_onwards_request_headers().get("X-B3-Sampled") == (
+            None if "X-B3-Flags" in headers else ("1" if expected_is_sampled else "0")
+        )
+
+
+def test_no_request_sampler_by_default(app):
+    _create_sampling_app(app)
+
+    with app.test_request_context("/other"):
+        assert request.is_sampled is None
+        assert request.tail_sampling_enabled is False
+        assert request.apply_tail_sampling(100) is None
+
+
+@pytest.mark.parametrize("headers,duration_real,expected_is_sampled", (
+    ({}, 0.5, False),
+    ({}, 1.5, True),
+    ({"X-B3-Sampled": "0"}, 1.5, True),
+))
+def test_tail_sampling(app, headers, duration_real, expected_is_sampled):
+    _create_sampling_app(app, DM_SAMPLING_SLOW_THRESHOLD=1.)
+
+    with app.test_request_context("/other", headers=headers):
+        assert request.is_sampled is False
+        assert request.tail_sampling_enabled is True
+        assert request.apply_tail_sampling(duration_real) is expected_is_sampled
+        assert request.get_extra_log_context()["is_sampled"] == ("1" if expected_is_sampled else "0")
+
+
+def test_header_plan_compiled_at_init_app(app):
+    app.config["DM_TRACE_ID_HEADERS"] = ("DM-Request-ID", "X-B3-TraceId",)
+    app.config["DM_IS_SAMPLED_HEADERS"] = ("X-B3-Sampled", "Content-Type",)
+    request_id_init_app(app)
+
+    assert app.request_class._header_plan == RequestIdHeaderPlan(
+        trace_id_headers=("DM-Request-ID", "X-B3-TraceId",),
+        span_id_headers=("X-B3-SpanId",),
+        parent_span_id_headers=("X-B3-ParentSpanId",),
+        is_sampled_headers=("X-B3-Sampled", "Content-Type",),
+        debug_flag_headers=("X-B3-Flags",),
+        environ_keys=(
+            ("HTTP_DM_REQUEST_ID", "HTTP_X_B3_TRACEID",),
+            ("HTTP_X_B3_SPANID",),
+            ("HTTP_X_B3_PARENTSPANID",),
+            ("HTTP_X_B3_SAMPLED", "CONTENT_TYPE",),
+            ("HTTP_X_B3_FLAGS",),
+        ),
+        w3c_trace_context=False,
+    )
+
+    # later config changes have no effect
+    app.config["DM_TRACE_ID_HEADERS"] = ("Something-Else",)
+    with app.test_request_context(headers=(("x-b3-traceid", "from-header"), ("Content-Type", "1"),)):
+        assert request.trace_id == "from-header"
+        assert request.is_sampled is True
+
+
+_TRACEPARENT_TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+_TRACEPARENT_SPAN_ID = "00f067aa0ba902b7"
+
+
+@pytest.mark.parametrize("headers,expected_trace_id,expected_span_id,expected_is_sampled,expected_tracestate", (
+    (
+        {"traceparent": f"00-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-01", "tracestate": "foo=bar"},
+        _TRACEPARENT_TRACE_ID,
+        _TRACEPARENT_SPAN_ID,
+        True,
+        "foo=bar",
+    ),
+    (
+        {"traceparent": f"00-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-00"},
+        _TRACEPARENT_TRACE_ID,
+        _TRACEPARENT_SPAN_ID,
+        False,
+        None,
+    ),
+    (
+        # future versions may add fields
+        {"traceparent": f"cc-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-03-what-the-future-holds"},
+        _TRACEPARENT_TRACE_ID,
+        _TRACEPARENT_SPAN_ID,
+        True,
+        None,
+    ),
+    (
+        # b3 headers take precedence
+        {
+            "traceparent": f"00-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-01",
+            "X-B3-TraceId": "b3-trace-id",
+            "X-B3-Sampled": "0",
+        },
+        "b3-trace-id",
+        _TRACEPARENT_SPAN_ID,
+        False,
+        None,
+    ),
+    *(
+        (
+            {"traceparent": invalid_traceparent, "tracestate": "foo=bar"},
+            _GENERATED_TRACE_HEX,
+            None,
+            None,
+            None,
+        ) for invalid_traceparent in (
+            f"ff-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-01",
+            f"00-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-01-extra",
+            f"00-{'0' * 32}-{_TRACEPARENT_SPAN_ID}-01",
+            f"00-{_TRACEPARENT_TRACE_ID}-{'0' * 16}-01",
+            f"00-{_TRACEPARENT_TRACE_ID.upper()}-{_TRACEPARENT_SPAN_ID}-01",
+            "garbage",
+        )
+    ),
+))
+@mock.patch.object(RequestIdRequestMixin, "_trace_id_generator", autospec=True)
+@mock.patch.object(RequestIdRequestMixin, "_span_id_generator", autospec=True)
+def test_w3c_trace_context(
+    span_id_generator_mock,
+    trace_id_generator_mock,
+    app,
+    headers,
+    expected_trace_id,
+    expected_span_id,
+    expected_is_sampled,
+    expected_tracestate,
+):
+    app.config["DM_W3C_TRACE_CONTEXT"] = True
+    request_id_init_app(app)
+
+    trace_id_generator_mock.get_hex_id.side_effect = assert_args_and_return(_GENERATED_TRACE_HEX, 128)
+    span_id_generator_mock.get_hex_id.side_effect = assert_args_and_return(_GENERATED_SPAN_HEX, 64)
+
+    with app.test_request_context(headers=headers):
+        assert request.trace_id == expected_trace_id
+        assert request.span_id == expected_span_id
+        assert request.is_sampled == expected_is_sampled
+        assert request.tracestate == expected_tracestate
+
+        onwards_request_headers = request.get_onwards_request_headers()
+        if expected_trace_id == "b3-trace-id":
+            # not representable as a traceparent
+            assert "traceparent" not in onwards_request_headers
+        else:
+            assert onwards_request_headers["traceparent"] == (
+                f"00-{expected_trace_id}-{_GENERATED_SPAN_HEX}-{'01' if expected_is_sampled else '00'}"
+            )
+        assert onwards_request_headers.get("tracestate") == (
+            expected_tracestate if "traceparent" in onwards_request_headers else None
+        )
+
+
+def test_w3c_trace_context_disabled_by_default(app):
+    request_id_init_app(app)
+
+    with app.test_request_context(headers={
+        "traceparent": f"00-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-01",
+        "tracestate": "foo=bar",
+    }):
+        assert request.trace_id != _TRACEPARENT_TRACE_ID
+        assert request.span_id is None
+        assert request.is_sampled is None
+        assert request.tracestate is None
+        assert "traceparent" not in request.get_onwards_request_headers()
+
+
+def test_w3c_traceparent_from_64_bit_b3_trace_id(app):
+    app.config["DM_W3C_TRACE_CONTEXT"] = True
+    request_id_init_app(app)
+
+    with app.test_request_context(headers={"X-B3-TraceId": "a3ce929d0e0e4736", "X-B3-SpanId": _TRACEPARENT_SPAN_ID}):
+        assert request.get_onwards_request_headers()["traceparent"] == AnyStringMatching(
+            r"00-0000000000000000a3ce929d0e0e4736-[0-9a-f]{16}-00"
+        )
+
+
+@pytest.mark.parametrize("w3c_trace_context", (False, True))
+def test_w3c_traceresponse_header(app, w3c_trace_context):
+    app.config["DM_W3C_TRACE_CONTEXT"] = w3c_trace_context
+    request_id_init_app(app)
+
+    @app.route('/')
+    def index():
+        return 'ok'
+
+    response = app.test_client().get('/', headers={
+        "traceparent": f"00-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-01",
+    })
+
+    assert response.headers.get("traceresponse") == (
+        f"00-{_TRACEPARENT_TRACE_ID}-{_TRACEPARENT_SPAN_ID}-01" if w3c_trace_context else None
+    )
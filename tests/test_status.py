@@ -256,3 +256,23 @@ def test_get_app_status(app,
     if not ignore_dependencies:
         for check in additional_checks_extended:
             assert check.call_args_list == [mock.call()]
+
+
+@mock.patch('dmutils.status.get_disk_space_status', return_value=('OK', 90))
+@mock.patch('dmutils.status.get_circuit_breaker_statuses')
+def test_get_app_status_includes_circuit_breakers(get_circuit_breaker_statuses, disk_space_status, app):
+    get_circuit_breaker_statuses.return_value = {
+        "Mailchimp": {"state": "open", "calls": 20, "failure_rate": 0.6, "slow_call_rate": 0.1},
+    }
+
+    with app.app_context(), app.test_request_context():
+        response, status_code = get_app_status(ignore_dependencies=True)
+
+    assert status_code == 200
+    assert json.loads(response.data) == {
+        "status": "ok",
+        "disk": "OK (90% free)",
+        "circuit_breakers": {
+            "Mailchimp": {"state": "open", "calls": 20, "failure_rate": 0.6, "slow_call_rate": 0.1},
+        },
+    }
@@ -4,13 +4,17 @@ from dmtestutils.comparisons import RestrictedAny, AnySupersetOf, AnyStringMatch
 from collections import OrderedDict
 from contextlib import contextmanager
 from itertools import chain, product
+import asyncio
+import contextvars
 import json
 import logging
 import mock
 from numbers import Number
+import os
 import random
 import re
 import sys
+import threading
 import time
 
 from flask import request
@@ -208,6 +212,7 @@ def _expect_log(
                                 (lambda st: lambda val: st * 0.95 < val < st * 1.5)(sleep_time)
                             ),
                             "duration_process": mock.ANY,
+                            "duration_process_clock": "process",
                             **(inject_context or {}),
                         },
                     )
@@ -264,6 +269,7 @@ def _expect_log(
                         "keyes": "House Of",
                         "duration_real": RestrictedAny(lambda value: 0.48 < value < 0.6),
                         "duration_process": RestrictedAny(lambda value: isinstance(value, Number)),
+                        "duration_process_clock": "process",
                     },
                 )],
             ),
@@ -292,6 +298,7 @@ def _expect_log(
                     extra={
                         "duration_real": RestrictedAny(lambda value: 0.18 < value < 0.35),
                         "duration_process": RestrictedAny(lambda value: isinstance(value, Number)),
+                        "duration_process_clock": "process",
                     },
                 )],
             ),
@@ -383,6 +390,7 @@ def test_logged_duration_mock_logger(
                             (lambda st: lambda val: st * 0.95 < val < st * 1.5)(sleep_time)
                         ),
                         "duration_process": RestrictedAny(lambda value: isinstance(value, Number)),
+                        "duration_process_clock": "process",
                         **(inject_context or {}),
                         **(
                             {
@@ -443,6 +451,7 @@ def test_logged_duration_mock_logger(
                     "key": "D#",
                     "duration_real": RestrictedAny(lambda value: 0.48 < value < 0.6),
                     "duration_process": RestrictedAny(lambda value: isinstance(value, Number)),
+                    "duration_process_clock": "process",
                     "name": "flask.app.foobar",
                 }),),
             ),
@@ -481,6 +490,7 @@ def test_logged_duration_mock_logger(
                         ),
                         "duration_real": RestrictedAny(lambda value: 0.18 < value < 0.35),
                         "duration_process": RestrictedAny(lambda value: isinstance(value, Number)),
+                        "duration_process_clock": "process",
                         "name": "flask.app.foobar",
                     }),
                 ),
@@ -551,7 +561,7 @@ def test_logged_duration_for_external_request_always_logs_on_error(*args):
         10,
         'Exception from call to Test (Desc) after {duration_real}s',
         exc_info=True,
-        extra={'duration_real': mock.ANY, 'duration_process': mock.ANY}
+        extra={'duration_real': mock.ANY, 'duration_process': mock.ANY, 'duration_process_clock': 'process'}
     )
 
 
@@ -564,3 +574,392 @@ def test_logged_duration_for_external_request_does_not_call_when_not_an_error(*a
         pass
 
     assert logger_mock.log.called is False
+
+
+@mock.patch('dmutils.timing.has_request_context', return_value=True)
+@mock.patch('dmutils.timing.exceeds_slow_external_call_threshold', return_value=True)
+def test_logged_duration_for_external_request_describes_calling_function(*args):
+    logger_mock = mock.Mock()
+
+    def subscribe_to_newsletter():
+        with timing.logged_duration_for_external_request('Test', logger=logger_mock):
+            pass
+
+    with mock.patch("inspect.stack") as inspect_stack:
+        subscribe_to_newsletter()
+        subscribe_to_newsletter()
+
+    assert inspect_stack.called is False
+    assert logger_mock.log.call_args_list == 2 * [mock.call(
+        10,
+        'Call to Test (subscribe_to_newsletter) executed in {duration_real}s',
+        exc_info=False,
+        extra={'duration_real': mock.ANY, 'duration_process': mock.ANY, 'duration_process_clock': 'process'}
+    )]
+
+
+class TestDurationHistograms:
+    def setup(self):
+        self.registry_patch = mock.patch("dmutils.timing._duration_histogram_registry", None)
+        self.registry_patch.start()
+
+    def teardown(self):
+        self.registry_patch.stop()
+
+    def test_duration_histogram_registry_collect(self):
+        registry = timing.DurationHistogramRegistry(buckets=(0.5, 0.1, 1.0))
+        assert registry.buckets == (0.1, 0.5, 1.0)
+
+        for duration in (0.05, 0.1, 0.3, 0.7, 2.0):
+            registry.observe(("foo", "bar"), duration)
+        registry.observe(("foo", "baz"), 0.3)
+
+        assert registry.collect() == {
+            ("foo", "bar"): ([2, 3, 4, 5], pytest.approx(3.15)),
+            ("foo", "baz"): ([0, 1, 1, 1], pytest.approx(0.3)),
+        }
+
+    def test_duration_histogram_registry_merges_threads(self):
+        registry = timing.DurationHistogramRegistry(buckets=(1.0,))
+
+        def observe_many():
+            for _ in range(1000):
+                registry.observe(("foo", ""), 0.5)
+
+        threads = [threading.Thread(target=observe_many) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(registry._shards) == 4
+        assert registry.collect() == {("foo", ""): ([4000, 4000], pytest.approx(2000.0))}
+
+    def test_duration_histogram_registry_merges_finished_threads_shards(self):
+        registry = timing.DurationHistogramRegistry(buckets=(1.0,))
+        registry.observe(("foo", ""), 0.5)
+
+        for _ in range(3):
+            thread = threading.Thread(target=registry.observe, args=(("foo", ""), 2.0))
+            thread.start()
+            thread.join()
+            assert registry.collect() == {("foo", ""): (mock.ANY, mock.ANY)}
+            # only this (live) thread's shard is kept
+            assert len(registry._shards) == 1
+
+        registry.observe(("foo", "bar"), 0.5)
+        assert registry.collect() == {
+            ("foo", ""): ([1, 4], pytest.approx(6.5)),
+            ("foo", "bar"): ([1, 1], pytest.approx(0.5)),
+        }
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+    def test_duration_histogram_registry_forked_child_starts_empty(self):
+        registry = timing.DurationHistogramRegistry(buckets=(1.0,))
+        registry.observe(("foo", ""), 0.5)
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child
+            try:
+                registry.observe(("foo", ""), 2.0)
+                os.write(write_fd, repr(registry.collect()).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as pipe:
+            assert pipe.read() == repr({("foo", ""): ([0, 1], 2.0)})
+
+        assert registry.collect() == {("foo", ""): ([1, 1], 0.5)}
+
+    def test_logged_duration_does_not_record_unless_enabled(self):
+        assert timing.get_duration_histogram_registry() is None
+
+        with timing.logged_duration(logger=mock.Mock(), condition=lambda log_context: False):
+            pass
+
+        assert timing.get_duration_histogram_registry() is None
+
+    def test_logged_duration_records_when_enabled(self):
+        registry = timing.enable_duration_histograms()
+        assert timing.enable_duration_histograms() is registry
+        assert timing.get_duration_histogram_registry() is registry
+
+        logger = logging.getLogger("foo.bar")
+        # recorded whether or not anything gets logged
+        with timing.logged_duration(logger=logger, condition=lambda log_context: False):
+            pass
+        with timing.logged_duration(logger=logger, condition=lambda log_context: True, histogram_label="baz"):
+            pass
+
+        collected = registry.collect()
+        assert sorted(collected) == [("foo.bar", ""), ("foo.bar", "baz")]
+        assert collected[("foo.bar", "baz")][0][-1] == 1
+
+    @mock.patch('dmutils.timing.has_request_context', return_value=False)
+    def test_logged_duration_for_external_request_labels_with_service(self, *args):
+        registry = timing.enable_duration_histograms()
+
+        with timing.logged_duration_for_external_request('Test', 'Desc', logger=logging.getLogger("foo.bar")):
+            pass
+
+        assert sorted(registry.collect()) == [("foo.bar", "Test")]
+
+
+class TestSpanTree:
+    def teardown(self):
+        timing.pop_span_tree()
+
+    def test_spans_not_collected_by_default(self):
+        with timing.logged_duration(logger=mock.Mock(), condition=lambda log_context: False):
+            pass
+
+        assert timing.pop_span_tree() is None
+
+    def test_nested_spans(self):
+        logger = logging.getLogger("foo.bar")
+        timing.start_span_tree()
+
+        now = 1000
+
+        def _sleep(seconds):
+            nonlocal now
+            now += seconds
+
+        with mock.patch("time.perf_counter", side_effect=lambda: now):
+            with timing.logged_duration(logger=logger, condition=lambda log_context: False):
+                _sleep(1)
+                with timing.logged_duration(logger=logger, condition=lambda log_context: False, histogram_label="a"):
+                    _sleep(2)
+                    with timing.logged_duration(
+                        logger=logger,
+                        condition=lambda log_context: False,
+                        histogram_label="b",
+                    ):
+                        _sleep(4)
+                with pytest.raises(ValueError):
+                    with timing.logged_duration(
+                        logger=logger,
+                        condition=lambda log_context: False,
+                        histogram_label="c",
+                    ):
+                        _sleep(8)
+                        raise ValueError
+            with timing.logged_duration(logger=logger, condition=lambda log_context: False):
+                _sleep(16)
+
+        assert timing.pop_span_tree() == [
+            {"id": 1, "parent_id": None, "name": "foo.bar", "duration_real": 15, "duration_self": 1},
+            {"id": 2, "parent_id": 1, "name": "foo.bar:a", "duration_real": 6, "duration_self": 2},
+            {"id": 3, "parent_id": 2, "name": "foo.bar:b", "duration_real": 4, "duration_self": 4},
+            {"id": 4, "parent_id": 1, "name": "foo.bar:c", "duration_real": 8, "duration_self": 8},
+            {"id": 5, "parent_id": None, "name": "foo.bar", "duration_real": 16, "duration_self": 16},
+        ]
+        assert timing.pop_span_tree() is None
+
+    def test_max_spans(self):
+        logger = logging.getLogger("foo.bar")
+        timing.start_span_tree(max_spans=2)
+
+        with timing.logged_duration(logger=logger, condition=lambda log_context: False, histogram_label="a"):
+            with timing.logged_duration(logger=logger, condition=lambda log_context: False, histogram_label="b"):
+                pass
+            for _ in range(3):
+                with timing.logged_duration(logger=logger, condition=lambda log_context: False, histogram_label="c"):
+                    with timing.logged_duration(logger=logger, condition=lambda log_context: False):
+                        pass
+
+        assert timing.pop_span_tree(with_dropped_count=True) == ([
+            AnySupersetOf({"id": 1, "parent_id": None, "name": "foo.bar:a"}),
+            AnySupersetOf({"id": 2, "parent_id": 1, "name": "foo.bar:b"}),
+        ], 6)
+        assert timing.pop_span_tree(with_dropped_count=True) == (None, 0)
+
+
+class TestLoggedDurationClock:
+    def _log_context(self, **kwargs):
+        with timing.logged_duration(logger=mock.Mock(), condition=lambda log_context: False, **kwargs) as log_context:
+            pass
+        return log_context
+
+    @pytest.mark.skipif(not hasattr(time, "thread_time"), reason="thread_time not supported on this platform")
+    def test_thread_clock(self):
+        with mock.patch("time.thread_time", side_effect=(10., 12.5)) as thread_time:
+            with mock.patch("time.process_time") as process_time:
+                log_context = self._log_context(clock=timing.CLOCK_THREAD)
+
+        assert thread_time.call_count == 2
+        assert process_time.called is False
+        assert log_context == AnySupersetOf({"duration_process": 2.5, "duration_process_clock": "thread"})
+
+    @pytest.mark.skipif(not hasattr(time, "thread_time"), reason="thread_time not supported on this platform")
+    def test_default_clock(self):
+        with mock.patch("dmutils.timing.DEFAULT_CLOCK", timing.CLOCK_THREAD):
+            assert self._log_context()["duration_process_clock"] == "thread"
+            assert self._log_context(clock=timing.CLOCK_PROCESS)["duration_process_clock"] == "process"
+
+    def test_thread_clock_falls_back_to_process_clock_when_unsupported(self):
+        with mock.patch.dict("dmutils.timing._clock_functions", clear=True, process=time.process_time):
+            with mock.patch("time.process_time", side_effect=(10., 11.)):
+                log_context = self._log_context(clock=timing.CLOCK_THREAD)
+
+        assert log_context == AnySupersetOf({"duration_process": 1., "duration_process_clock": "process"})
+
+    def test_unknown_clock(self):
+        with pytest.raises(ValueError):
+            self._log_context(clock="thraed")
+
+        async def time_block():
+            async with timing.async_logged_duration(logger=mock.Mock(), clock="thraed"):
+                pass
+
+        with pytest.raises(ValueError):
+            asyncio.new_event_loop().run_until_complete(time_block())
+
+
+class TestAsyncLoggedDuration:
+    def teardown(self):
+        timing.clear_captured_request_context()
+        timing.pop_span_tree()
+
+    def test_async_with(self):
+        logger = mock.Mock()
+
+        async def fetch():
+            async with timing.async_logged_duration(
+                logger=logger,
+                message="Fetched {key} in {duration_real}s",
+                condition=None,
+            ) as log_context:
+                log_context["key"] = "foo"
+                await asyncio.sleep(0.01)
+
+        asyncio.new_event_loop().run_until_complete(fetch())
+
+        assert logger.log.call_args_list == [mock.call(
+            logging.DEBUG,
+            "Fetched {key} in {duration_real}s",
+            exc_info=False,
+            extra={
+                "key": "foo",
+                "duration_real": RestrictedAny(lambda value: value >= 0.01),
+                "duration_process": RestrictedAny(lambda value: isinstance(value, Number)),
+                "duration_process_clock": "process",
+            },
+        )]
+
+    def test_decorator_with_exception(self):
+        logger = mock.Mock()
+
+        @timing.async_logged_duration(logger=logger, condition=None)
+        async def fetch():
+            raise ValueError("Boo")
+
+        with pytest.raises(ValueError):
+            asyncio.new_event_loop().run_until_complete(fetch())
+
+        assert logger.log.call_args_list == [mock.call(
+            logging.DEBUG,
+            "Block raised ValueError in {duration_real}s of real-time",
+            exc_info=True,
+            extra=mock.ANY,
+        )]
+
+    def test_cannot_reenter(self):
+        block = timing.async_logged_duration(logger=mock.Mock())
+
+        async def reenter():
+            async with block:
+                async with block:
+                    pass
+
+        with pytest.raises(RuntimeError):
+            asyncio.new_event_loop().run_until_complete(reenter())
+
+    @pytest.mark.parametrize("is_sampled", (False, True))
+    def test_concurrent_tasks_on_another_thread_see_captured_request(self, app, is_sampled):
+        logger = mock.Mock()
+        results = []
+
+        async def fetch(key):
+            async with timing.async_logged_duration(logger=logger, histogram_label=key) as log_context:
+                await asyncio.sleep(0.01)
+            results.append((key, timing.request_is_sampled(log_context)))
+
+        async def fetch_all():
+            await asyncio.gather(fetch("a"), fetch("b"))
+
+        def run_loop():
+            asyncio.new_event_loop().run_until_complete(fetch_all())
+
+        with app.test_request_context("/"):
+            request.is_sampled = is_sampled
+            timing.capture_request_context()
+
+            # (on python 3.6 the loop's tasks will share the context the thread is run in)
+            thread = threading.Thread(target=contextvars.copy_context().run, args=(run_loop,))
+            thread.start()
+            thread.join()
+
+        assert sorted(results) == [("a", is_sampled), ("b", is_sampled)]
+        assert logger.log.call_count == (2 if is_sampled else 0)
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="asyncio tasks only get their own contexts from python 3.7")
+    def test_concurrent_tasks_spans(self):
+        async def fetch(key):
+            async with timing.async_logged_duration(logger=mock.Mock(), histogram_label=key):
+                await asyncio.sleep(0.01)
+
+        async def fetch_all():
+            await asyncio.gather(fetch("a"), fetch("b"))
+
+        timing.start_span_tree()
+        asyncio.new_event_loop().run_until_complete(fetch_all())
+        spans = timing.pop_span_tree()
+
+        # both top-level spans, despite having run concurrently
+        assert sorted((span["name"][-1], span["parent_id"]) for span in spans) == [("a", None), ("b", None)]
+
+    def test_no_spans_without_task_contexts(self):
+        logger = mock.Mock(spec_set=("name", "log",))
+        logger.name = "foo"
+
+        async def fetch():
+            async with timing.async_logged_duration(logger=logger, histogram_label="a"):
+                with timing.logged_duration(logger=logger, histogram_label="b"):
+                    pass
+
+        with mock.patch("dmutils.timing._async_spans_supported", False):
+            timing.start_span_tree()
+            asyncio.new_event_loop().run_until_complete(fetch())
+            spans = timing.pop_span_tree()
+
+        assert [(span["name"], span["parent_id"]) for span in spans] == [("foo:b", None)]
+
+    def test_no_captured_request(self):
+        timing.capture_request_context()
+        assert timing.request_is_sampled({}) is False
+        assert timing.request_context_and_any_of_slow_call_or_sampled_request_or_exception_in_stack(
+            {"duration_real": 10}
+        ) is False
+
+    def test_async_logged_duration_for_external_request_describes_calling_function(self, app):
+        logger = mock.Mock()
+
+        async def subscribe_to_newsletter():
+            async with timing.async_logged_duration_for_external_request('Test', logger=logger):
+                pass
+
+        with app.test_request_context("/"):
+            request.is_sampled = True
+            asyncio.new_event_loop().run_until_complete(subscribe_to_newsletter())
+
+        assert logger.log.call_args_list == [mock.call(
+            logging.DEBUG,
+            'Call to Test (subscribe_to_newsletter) executed in {duration_real}s',
+            exc_info=False,
+            extra=mock.ANY,
+        )]